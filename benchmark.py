@@ -0,0 +1,294 @@
+""" Offline parser benchmarks on saved HTML pages.
+
+Usage:
+    py benchmark.py page.html [page.html ...]    compare product parse CPU before/after ProductPage
+    py benchmark.py replay [fixtures_dir]         replay pages saved with RECORD_PAGES=1 through the parsers
+    py benchmark.py scale [fixtures_dir]          parse recorded product pages with 1..cores parse processes
+"""
+import functools
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import ExitStack
+from unittest import mock
+
+import scrapy
+from bs4 import BeautifulSoup
+from lxml import html as lxml_html
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from selenium.webdriver.common.by import By
+
+import browserSession
+import config
+import linksParser
+import productDetailsParser
+import reviewPage
+import reviewParser
+from pageRecorder import fixture_files, load_fixtures, read_fixture
+from parseEngine import ParseEngine
+from productPage import ProductPage
+from scheduler import SCHEDULER
+
+
+def legacy_product_parse(html, image_steps=5):
+    """ The parses one product used to cost: a soup and a Selector for the card,
+    separate soups for breadcrumbs, characteristics and JSON-LD, and an html.parser soup per viewer image. """
+    BeautifulSoup(html, 'lxml')
+    scrapy.Selector(text=html)
+    for _ in range(3):
+        BeautifulSoup(html, 'lxml')
+    for _ in range(image_steps):
+        BeautifulSoup(html, 'html.parser')
+
+
+def product_page_parse(html):
+    """ One lxml parse with every field extracted from it. """
+    ProductPage(html).to_item()
+
+
+def cpu_ms_per_page(func, pages, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        for html in pages:
+            func(html)
+    return (time.process_time() - start) * 1000 / (repeat * len(pages))
+
+
+def bench_product_parse(pages, repeat=5):
+    """ Print parse CPU per product for the old and the single-parse approach. """
+    before = cpu_ms_per_page(legacy_product_parse, pages, repeat)
+    after = cpu_ms_per_page(product_page_parse, pages, repeat)
+    print(f"Product pages: {len(pages)}, repeats: {repeat}")
+    print(f"  before (multiple soups):  {before:8.1f} ms CPU / product")
+    print(f"  after (ProductPage):      {after:8.1f} ms CPU / product")
+    print(f"  speedup:                  {before / after:8.1f}x")
+    return before, after
+
+
+class StubElement:
+    """ WebElement look-alike backed by an lxml node. """
+
+    def __init__(self, node):
+        self._node = node
+
+    @property
+    def text(self):
+        return ' '.join(self._node.text_content().split())
+
+    def get_attribute(self, name):
+        return self._node.get(name)
+
+    def find_element(self, by, value):
+        found = self.find_elements(by, value)
+        if not found:
+            raise NoSuchElementException(f"{by}={value}")
+        return found[0]
+
+    def find_elements(self, by, value):
+        return _find(self._node, by, value)
+
+    def click(self):
+        pass
+
+    def is_displayed(self):
+        return True
+
+    def is_enabled(self):
+        return True
+
+
+def _find(node, by, value):
+    if by == By.XPATH:
+        found = node.xpath(value)
+    elif by == By.CSS_SELECTOR:
+        found = node.cssselect(value)
+    elif by == By.CLASS_NAME:
+        found = node.cssselect('.' + value)
+    elif by == By.ID:
+        found = node.cssselect('#' + value)
+    elif by == By.TAG_NAME:
+        found = node.iter(value)
+    else:
+        raise ValueError(f"Unsupported locator: {by}")
+    return [StubElement(element) for element in found if isinstance(element, lxml_html.HtmlElement)]
+
+
+class StubDriver(StubElement):
+    """ Offline driver that "navigates" between recorded pages. Clicks and scripts do nothing. """
+
+    def __init__(self, pages):
+        self._pages = pages
+        self.current_url = None
+        self.page_source = None
+        super().__init__(None)
+
+    def get(self, url):
+        self.current_url = url
+        self.page_source = self._pages.get(url, '<html></html>')
+        self._node = lxml_html.document_fromstring(self.page_source)
+
+    @property
+    def title(self):
+        found = self._node.xpath('//title')
+        return found[0].text_content() if found else ''
+
+    def execute_script(self, script, *args):
+        # The only script whose result the parsers use: markup of the opinions after a DOM position
+        if script == reviewParser.OPINIONS_HTML_JS:
+            selector, start = args
+            return [lxml_html.tostring(node, encoding='unicode') for node in self._node.cssselect(selector)[start:]]
+        return None
+
+    def quit(self):
+        pass
+
+
+class _NoWait:
+    """ WebDriverWait replacement: a recorded page never changes, so check the condition once. """
+
+    def __init__(self, driver, timeout=None, *args, **kwargs):
+        self._driver = driver
+
+    def until(self, method, message=''):
+        try:
+            value = method(self._driver)
+        except NoSuchElementException:
+            value = None
+        if not value:
+            raise TimeoutException(message)
+        return value
+
+
+def _timed(func, stats, name):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats[name].append(time.perf_counter() - start)
+    return wrapper
+
+
+def _offline(stack, stats):
+    """ Remove scheduler delays and waits from the parsers and time every field extractor. """
+    stack.enter_context(mock.patch.object(SCHEDULER, 'wait', lambda stage: None))
+    stack.enter_context(mock.patch.object(SCHEDULER, 'record', lambda stage, latency, *args, **kwargs: None))
+    for module in (productDetailsParser, reviewParser, browserSession):
+        stack.enter_context(mock.patch.object(module, 'WebDriverWait', _NoWait))
+    stack.enter_context(mock.patch.object(config, 'RECORD_PAGES', False))
+
+    extractors = {
+        productDetailsParser: ('wait_for_gallery', 'scroll_to_characteristics'),
+        reviewParser: ('parse_opinion_ratings', 'parse_product_details', 'extract_media_urls',
+                       'parse_comments', '_safe_element_text', 'parse_reviews_snapshot'),
+        reviewPage: ('parse_opinion_ratings', 'parse_product_details', 'parse_opinion_texts',
+                     'extract_media_urls', 'parse_comment_nodes'),
+    }
+    for module, names in extractors.items():
+        for name in names:
+            timed = _timed(getattr(module, name), stats, f'{module.__name__}.{name}')
+            stack.enter_context(mock.patch.object(module, name, timed))
+
+    for field in ('id', 'images', 'name', 'price_discounted', 'price_original', 'rating', 'number_of_reviews',
+                  'brand_name', 'description', 'categories', 'characteristics', 'drivers'):
+        prop = ProductPage.__dict__[field]
+        timed = functools.cached_property(_timed(prop.func, stats, f'ProductPage.{field}'))
+        timed.__set_name__(ProductPage, field)
+        stack.enter_context(mock.patch.object(ProductPage, field, timed))
+    stack.enter_context(mock.patch.object(
+        ProductPage, '__init__', _timed(ProductPage.__init__, stats, 'ProductPage (lxml parse)')))
+
+
+def replay(fixtures_dir=None, repeat=1):
+    """ Run recorded pages through the parsers with a stub driver and report speed and memory. """
+    fixtures = load_fixtures(fixtures_dir)
+    if not fixtures:
+        print(f"No fixtures in {fixtures_dir or config.FIXTURES_DIR}. Record some with RECORD_PAGES=1.")
+        return None
+
+    driver = StubDriver({url: html for _, url, html in fixtures})
+    stats = defaultdict(list)
+    pages = defaultdict(lambda: [0, 0.0])
+
+    with tempfile.TemporaryDirectory() as tmp, ExitStack() as stack:
+        _offline(stack, stats)
+        tracemalloc.start()
+        for run in range(repeat):
+            reviews_file = os.path.join(tmp, f'reviews-{run}.jsonl')
+            for kind, url, _ in fixtures:
+                start = time.perf_counter()
+                if kind == 'product':
+                    productDetailsParser.parse_characteristics_page(driver, url)
+                elif kind == 'reviews':
+                    driver.get(url)
+                    reviewParser.parse_reviews(driver, reviews_file)
+                elif kind == 'category':
+                    driver.get(url)
+                    linksParser.get_urls_from_page(driver)
+                else:
+                    # Characteristics pages are only parsed together with their product card
+                    continue
+                pages[kind][0] += 1
+                pages[kind][1] += time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print(f"Replayed {len(fixtures)} pages x {repeat}")
+    for kind, (count, seconds) in sorted(pages.items()):
+        print(f"  {kind:<10} {count:6d} pages  {count / seconds:8.1f} pages/s")
+    print("Extractors:")
+    for name, timings in sorted(stats.items(), key=lambda entry: -sum(entry[1])):
+        print(f"  {name:<36} {len(timings):6d} calls  {sum(timings) * 1000 / len(timings):8.2f} ms/call")
+    print(f"Peak memory: {peak / 1024 / 1024:.1f} MB")
+    return {'pages': dict(pages), 'extractors': dict(stats), 'peak_memory': peak}
+
+
+def bench_parse_scaling(fixtures_dir=None, chunksize=None):
+    """ Parse the recorded product pages with 1, 2, 4... parse processes up to the core count.
+    Pages are read from disk as the workers take them, so the corpus never has to fit in memory. """
+    fixtures = fixture_files(fixtures_dir, kind='product')
+    if not fixtures:
+        print(f"No product fixtures in {fixtures_dir or config.FIXTURES_DIR}. Record some with RECORD_PAGES=1.")
+        return None
+
+    cores = os.cpu_count() or 1
+    counts = sorted({2 ** power for power in range(cores.bit_length()) if 2 ** power <= cores} | {cores})
+    urls = [url for _, url, _ in fixtures]
+
+    results = {}
+    for workers in counts:
+        engine = ParseEngine(workers, processes=True)
+        pages = (read_fixture(path, binary=True) for _, _, path in fixtures)
+        start = time.perf_counter()
+        parsed = sum(1 for item in engine.map(productDetailsParser.parse_product_html, pages, urls,
+                                              chunksize=chunksize) if item)
+        seconds = time.perf_counter() - start
+        engine.close()
+        results[workers] = len(fixtures) / seconds
+        print(f"  {workers:3d} processes  {parsed:6d} pages  {results[workers]:8.1f} pages/s  "
+              f"x{results[workers] / results[counts[0]]:.2f}")
+    return results
+
+
+def load_pages(filenames):
+    pages = []
+    for filename in filenames:
+        with open(filename, 'r', encoding='utf-8') as f:
+            pages.append(f.read())
+    return pages
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    if sys.argv[1] == 'replay':
+        replay(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif sys.argv[1] == 'scale':
+        bench_parse_scaling(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        bench_product_parse(load_pages(sys.argv[1:]))
@@ -0,0 +1,233 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+import undetected_chromedriver as uc
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+import config
+import metrics
+from scheduler import SCHEDULER, is_blocked
+
+# undetected_chromedriver patches the chromedriver binary on start,
+# so two sessions must never be launched at the same time.
+_start_lock = threading.Lock()
+
+
+def create_driver(profile_name=None):
+    """ Start a Chrome session, optionally with its own profile directory. """
+    options = uc.ChromeOptions()
+    options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
+
+    user_data_dir = None
+    if profile_name:
+        user_data_dir = os.path.abspath(os.path.join(config.PROFILES_DIR, profile_name))
+        os.makedirs(user_data_dir, exist_ok=True)
+
+    with _start_lock:
+        driver = uc.Chrome(options=options, user_data_dir=user_data_dir)
+
+    if config.BLOCK_RESOURCES:
+        block_resources(driver)
+    return driver
+
+
+def block_resources(driver, patterns=None):
+    """ Stop Chrome from downloading URLs matching the patterns; the DOM and attributes stay intact. """
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': patterns or config.BLOCKED_URLS})
+
+
+def is_alive(driver):
+    """ Check that the browser and chromedriver still respond. """
+    if driver is None:
+        return False
+    try:
+        driver.current_url
+        return True
+    except WebDriverException:
+        return False
+
+
+def quit_driver(driver):
+    """ Close the browser, ignoring errors from an already dead session. """
+    if driver is None:
+        return
+    try:
+        driver.quit()
+    except Exception as e:
+        print(f"Error closing driver: {e}")
+
+
+def open_page(driver, url, stage, ready=None, timeout=15):
+    """ Load a page when the stage's scheduler slot comes, wait until the `ready` locator is present
+    and report the load time back. Returns False when the site answered with a captcha page. """
+    SCHEDULER.wait(stage)
+    start = time.monotonic()
+    driver.get(url)
+
+    loaded = True
+    if ready:
+        try:
+            WebDriverWait(driver, timeout).until(EC.presence_of_element_located(ready))
+        except TimeoutException:
+            loaded = False
+            metrics.inc('timeouts', stage)
+
+    # Only a page without the expected content is worth the full page_source transfer
+    blocked = is_blocked(driver.title) or (not loaded and is_blocked(driver.page_source))
+    SCHEDULER.record(stage, time.monotonic() - start, blocked=blocked)
+    return not blocked
+
+
+class _Slot:
+    """ One browser of the pool with its own profile directory. """
+
+    def __init__(self, profile_name):
+        self.profile_name = profile_name
+        self.driver = None
+        self.pages = 0
+        self.base_memory = None
+
+
+def browser_rss_mb(driver):
+    """ Resident memory of a browser in MB: chromedriver, Chrome and every renderer and helper process
+    they started. None when the processes can't be read. """
+    # undetected_chromedriver starts Chrome itself, so it isn't a child of chromedriver
+    roots = [getattr(driver, 'browser_pid', None)]
+    service = getattr(driver, 'service', None)
+    if getattr(service, 'process', None) is not None:
+        roots.append(service.process.pid)
+
+    processes = {}
+    for pid in filter(None, roots):
+        try:
+            root = psutil.Process(pid)
+            for process in [root] + root.children(recursive=True):
+                processes[process.pid] = process
+        except psutil.Error:
+            continue
+
+    total = 0
+    for process in processes.values():
+        try:
+            total += process.memory_info().rss
+        except psutil.Error:
+            # Renderers come and go between listing and reading them
+            continue
+    return total / 1024 / 1024 if total else None
+
+
+class BrowserPool:
+    """ Chrome sessions leased to workers and reused across pages.
+
+    A browser is restarted when it crashed, after `max_pages` pages or when the resident memory of
+    its processes grew by more than `max_memory_growth` MB since its first page. """
+
+    def __init__(self, size=None, max_pages=None, max_memory_growth=None, profile_prefix='worker'):
+        # Without a profile prefix every browser gets a temporary profile
+        self.size = size or config.WORKERS
+        self.max_pages = max_pages or config.BROWSER_MAX_PAGES
+        self.max_memory_growth = max_memory_growth or config.BROWSER_MAX_MEMORY_GROWTH
+        self._free = queue.LifoQueue()
+        for index in range(self.size):
+            self._free.put(_Slot(f"{profile_prefix}-{index}" if profile_prefix else None))
+        self._leased = {}
+        self._lock = threading.Lock()
+
+    def lease(self):
+        """ Take a live browser, waiting until one is free. """
+        slot = self._free.get()
+        try:
+            if not is_alive(slot.driver):
+                self._restart(slot)
+        except Exception:
+            self._free.put(slot)
+            raise
+        with self._lock:
+            self._leased[id(slot.driver)] = slot
+        return slot.driver
+
+    def release(self, driver, pages=1):
+        """ Give a browser back after `pages` pages, recycling it if it crashed or wore out. """
+        with self._lock:
+            slot = self._leased.pop(id(driver))
+        slot.pages += pages
+
+        if not is_alive(driver):
+            print(f"Browser {slot.profile_name or 'session'} crashed, it will be restarted")
+            metrics.inc('browser_restarts', 'crash')
+            quit_driver(driver)
+            slot.driver = None
+        elif slot.pages >= self.max_pages:
+            metrics.inc('browser_restarts', 'pages')
+            quit_driver(driver)
+            slot.driver = None
+        else:
+            memory = browser_rss_mb(driver)
+            if memory is not None:
+                metrics.gauge('browser_rss_mb', slot.profile_name or f'session-{id(slot)}', round(memory, 1))
+            if slot.base_memory is None:
+                slot.base_memory = memory
+            elif memory is not None and memory - slot.base_memory > self.max_memory_growth:
+                print(f"Browser {slot.profile_name or 'session'} grew by {memory - slot.base_memory:.0f} MB, restarting")
+                metrics.inc('browser_restarts', 'memory')
+                quit_driver(driver)
+                slot.driver = None
+        self._free.put(slot)
+
+    @contextmanager
+    def driver(self):
+        driver = self.lease()
+        try:
+            yield driver
+        finally:
+            self.release(driver)
+
+    def _restart(self, slot):
+        quit_driver(slot.driver)
+        slot.driver = None
+        slot.driver = create_driver(slot.profile_name)
+        slot.pages = 0
+        slot.base_memory = None
+
+    def close(self):
+        """ Quit every idle browser. """
+        while True:
+            try:
+                slot = self._free.get_nowait()
+            except queue.Empty:
+                break
+            quit_driver(slot.driver)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(size=None, profile_prefix='worker'):
+    """ Return the browser pool shared by every stage of the process.
+    The arguments only matter for the call that creates it. """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool(size, profile_prefix=profile_prefix)
+        return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+atexit.register(close_pool)
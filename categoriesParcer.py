@@ -1,5 +1,15 @@
-import requests
+import hashlib
 import json
+import os
+import time
+from datetime import datetime
+
+import requests
+
+import config
+import metrics
+from crawlState import get_state
+from httpSession import create_session
 
 BASE_URL = "https://restapi.dns-shop.ru/v1"
 HEADERS = {
@@ -7,30 +17,115 @@ HEADERS = {
     "origin": "https://www.dns-shop.ru",
 }
 
-def get_cities():
+class CachedApiClient:
+    """Клиент REST API с общей сессией и кэшем ответов на диске.
+
+    Пока ответ моложе API_CACHE_TTL, запрос не отправляется. Устаревший ответ перепроверяется
+    условным запросом (If-None-Match / If-Modified-Since): на 304 берётся кэш. Если API недоступно,
+    возвращается последний сохранённый ответ."""
+
+    def __init__(self, cache_dir=None, ttl=None):
+        self.cache_dir = cache_dir or config.API_CACHE_DIR
+        self.ttl = config.API_CACHE_TTL if ttl is None else ttl
+        self.session = create_session()
+        self.session.headers.update(HEADERS)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _cache_file(self, url, headers):
+        key = json.dumps([url, sorted(headers.items())], ensure_ascii=False)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '.json')
+
+    def get_data(self, url, headers=None):
+        """Поле data ответа; None, если получить его не удалось ни из API, ни из кэша."""
+        headers = headers or {}
+        cache_file = self._cache_file(url, headers)
+        cached = None
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if time.time() - cached['fetched_at'] < self.ttl:
+                metrics.inc('cache_hits', 'categories')
+                return cached['data']
+
+        conditional = {}
+        if cached and cached.get('etag'):
+            conditional['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            conditional['If-Modified-Since'] = cached['last_modified']
+
+        start = time.monotonic()
+        try:
+            response = self.session.get(url, headers={**headers, **conditional}, timeout=config.HTTP_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"Ошибка запроса {url}: {e}")
+            metrics.inc('request_errors', 'categories')
+            return cached['data'] if cached else None
+        metrics.inc('requests', 'categories')
+        metrics.observe('fetch_seconds', 'categories', time.monotonic() - start)
+
+        if response.status_code == 304 and cached:
+            # Не изменилось: продлеваем срок жизни кэша
+            data = cached['data']
+        elif response.status_code == 200:
+            data = response.json().get("data", [])
+            cached = {'url': url, 'etag': response.headers.get('ETag'),
+                      'last_modified': response.headers.get('Last-Modified'), 'data': data}
+        else:
+            metrics.inc('http_errors', 'categories')
+            print(f"Ошибка получения {url}: {response.status_code}")
+            return cached['data'] if cached else None
+
+        cached['fetched_at'] = time.time()
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(cached, f, ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
+        return data
+
+    def close(self):
+        self.session.close()
+
+
+def get_cities(client=None):
     """Получает список городов и их идентификаторы."""
-    url = f"{BASE_URL}/get-city-list"
-    response = requests.get(url, headers=HEADERS)
-
-    if response.status_code == 200:
-        cities = response.json().get("data", [])
-        return cities
-    else:
-        print(f"Ошибка получения списка городов: {response.status_code}")
-        return []
+    client = client or CachedApiClient()
+    return client.get_data(f"{BASE_URL}/get-city-list") or []
 
-def get_categories(city_id="4186730a-779c-11e0-80d3-001517c526f0"):
+def get_categories(city_id="4186730a-779c-11e0-80d3-001517c526f0", client=None):
     """Получает категории для указанного города."""
-    url = f"{BASE_URL}/get-menu"
-    headers = {**HEADERS, "cityid": city_id}
-    response = requests.get(url, headers=headers)
-
-    if response.status_code == 200:
-        categories = response.json().get("data", [])
-        return categories
-    else:
-        print(f"Ошибка получения категорий для cityId={city_id}: {response.status_code}")
-        return []
+    client = client or CachedApiClient()
+    categories = client.get_data(f"{BASE_URL}/get-menu", {"cityid": city_id})
+    if categories is None:
+        print(f"Ошибка получения категорий для cityId={city_id}")
+    return categories or []
+
+def iter_leaves(tree):
+    """Конечные категории (без childs) дерева get-menu, в том же порядке, что и generate_urls_from_json."""
+    items = tree if isinstance(tree, list) else [tree]
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        if not item.get('childs'):
+            yield item
+        else:
+            yield from iter_leaves(item['childs'])
+
+def _leaf_fingerprints(tree):
+    # Лист меняется, если меняется что-то кроме его (пустого) списка потомков
+    return {
+        item['url']: hashlib.sha1(json.dumps({k: v for k, v in item.items() if k != 'childs'},
+                                             ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+        for item in iter_leaves(tree) if item.get('url')
+    }
+
+def diff_category_trees(old_tree, new_tree):
+    """Сравнивает конечные категории двух деревьев по url: новые, изменившиеся и исчезнувшие."""
+    old, new = _leaf_fingerprints(old_tree or []), _leaf_fingerprints(new_tree)
+    return {
+        'added': [url for url in new if url not in old],
+        'changed': [url for url in new if url in old and new[url] != old[url]],
+        'removed': [url for url in old if url not in new],
+    }
 
 def save_to_json(data, filename):
     """Сохраняет данные в JSON файл."""
@@ -38,17 +133,68 @@ def save_to_json(data, filename):
         json.dump(data, f, ensure_ascii=False, indent=4)
     print(f"Данные сохранены в {filename}")
 
+def load_json(filename):
+    """Читает JSON файл; None, если его нет."""
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_category_diff(old_tree, new_tree, filename=None):
+    """Сохраняет разницу деревьев категорий и сбрасывает прогресс изменившихся категорий,
+    чтобы linksParser обошёл их заново. Новые и изменившиеся категории копятся в pending,
+    пока linksParser их не обойдёт, поэтому повторный запуск не теряет необойдённые."""
+    filename = filename or config.CATEGORIES_DIFF_FILE
+    diff = diff_category_trees(old_tree, new_tree)
+    state = get_state()
+    for url in diff['changed']:
+        state.reset_category(category_template(url))
+
+    previous = load_json(filename) or {}
+    removed = set(diff['removed'])
+    pending = [url for url in dict.fromkeys(pending_leaf_urls(previous) + diff['added'] + diff['changed'])
+               if url not in removed]
+    save_to_json({'generated_at': datetime.now().isoformat(timespec='seconds'), **diff, 'pending': pending},
+                 filename)
+    print(f"Категорий: новых {len(diff['added'])}, изменившихся {len(diff['changed'])}, "
+          f"исчезнувших {len(diff['removed'])}, ждут обхода {len(pending)}")
+    return diff
+
+def pending_leaf_urls(diff):
+    """Url новых и изменившихся категорий, которые linksParser ещё не обошёл."""
+    if not diff:
+        return []
+    # Файлы без pending записаны до накопления: в них только разница последнего запуска
+    return diff['pending'] if 'pending' in diff else diff['added'] + diff['changed']
+
+def category_template(url):
+    """Шаблон адреса страниц категории, как его строит generate_urls_from_json."""
+    return 'https://www.dns-shop.ru' + url + '?p={page}'
+
 def main():
+    metrics.start()
+    client = CachedApiClient()
+
     # Получаем список городов
-    cities = get_cities()
-    save_to_json(cities, "cities.json")
-    print("Список городов сохранён в cities.json")
+    with metrics.stage('categories'):
+        cities = get_cities(client)
+    if cities:
+        save_to_json(cities, "cities.json")
+        print("Список городов сохранён в cities.json")
 
     # Устанавливаем cityId для Москвы
     moscow_city_id = "30b7c1f3-03fb-11dc-95ee-00151716f9f5"
 
     # Получаем категории для Москвы
-    categories = get_categories(city_id=moscow_city_id)
+    with metrics.stage('categories'):
+        categories = get_categories(city_id=moscow_city_id, client=client)
+    client.close()
+    if not categories:
+        # Пустой ответ не должен затирать известное дерево
+        print("Категории не получены, categories.json не изменён")
+        return
+
+    save_category_diff(load_json("categories.json"), categories)
     save_to_json(categories, "categories.json")
     print("Категории сохранены в categories.json")
 
@@ -0,0 +1,127 @@
+""" Concurrent category link discovery over HTTP.
+
+Pagination pages of all categories are fetched at the same time, limited by a global
+concurrency cap and a per-host token bucket (CRAWL_CONCURRENCY, CRAWL_RATE). The bucket is the only
+rate limit here: outcomes still go to the scheduler's "links" stage, but its slots are not waited for.
+"""
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+from bs4 import BeautifulSoup
+
+import config
+from crawlState import get_state
+from httpSession import create_session, fetch_html, is_listing_page
+from linksParser import extract_product_urls, has_next_page, last_page_number, save_listing, save_new_urls
+from pageRecorder import record_page
+
+
+class TokenBucket:
+    """ Allows `rate` requests per second on average, with bursts up to `capacity`. """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class CategoryCrawler:
+
+    def __init__(self, concurrency=None, rate=None):
+        self.concurrency = concurrency or config.CRAWL_CONCURRENCY
+        self.rate = rate or config.CRAWL_RATE
+        self.session = create_session(pool_size=self.concurrency)
+        self._semaphore = None
+        self._buckets = {}
+        self.new_urls = 0
+
+    def _bucket(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.rate)
+        return self._buckets[host]
+
+    async def fetch(self, url):
+        """ Download a page once the concurrency limit and the host's rate limit allow it.
+        Returns None for failed requests and for captcha or block pages, even when served with 200. """
+        async with self._semaphore:
+            await self._bucket(url).acquire()
+            html = await asyncio.to_thread(fetch_html, self.session, url, 'links', False)
+        record_page('category', url, html)
+        if not html or not is_listing_page(html):
+            if html:
+                print(f"No catalog on {url}, leaving the category progress where it was.")
+            return None
+        # Parse off the event loop so other downloads keep going
+        return await asyncio.to_thread(BeautifulSoup, html, 'lxml')
+
+    def _save(self, soup, url_template):
+        self.new_urls += len(save_new_urls(extract_product_urls(soup), url_template))
+        save_listing(soup, url_template)
+
+    async def _crawl_page(self, url_template, page):
+        """ Save links of one page. Returns (has next page, last page number) or None if it failed. """
+        soup = await self.fetch(url_template.format(page=page))
+        if soup is None:
+            return None
+        self._save(soup, url_template)
+        return has_next_page(soup), last_page_number(soup)
+
+    async def crawl_category(self, url_template):
+        state = get_state()
+        last_page, done = state.category_progress(url_template)
+        if done:
+            return
+
+        # The first unparsed page tells how many pages the category has
+        page = last_page + 1
+        info = await self._crawl_page(url_template, page)
+        if info is None:
+            return
+        has_next, last = info
+
+        while has_next:
+            state.save_category_page(url_template, page)
+
+            # All pages the widget knows about are fetched at once; without a page count, one by one
+            batch = list(range(page + 1, max(last or 0, page + 1) + 1))
+            results = await asyncio.gather(*(self._crawl_page(url_template, number) for number in batch))
+
+            # Progress only moves over pages without gaps, so a failed page is retried next run
+            for number, info in zip(batch, results):
+                if info is None:
+                    state.save_category_page(url_template, page)
+                    return
+                page = number
+            has_next, last = results[-1]
+
+        state.save_category_page(url_template, page, done=True)
+
+    async def run(self, url_templates):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(self.crawl_category(url) for url in url_templates))
+
+
+def crawl_categories(url_templates, concurrency=None, rate=None):
+    """ Collect product links of all categories concurrently. Returns the number of new links. """
+    crawler = CategoryCrawler(concurrency, rate)
+    try:
+        asyncio.run(crawler.run(url_templates))
+    finally:
+        crawler.session.close()
+    print(f'Total {crawler.new_urls} new links collected from {len(url_templates)} categories.')
+    return crawler.new_urls
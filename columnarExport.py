@@ -0,0 +1,218 @@
+""" Export crawler output to Parquet tables partitioned by category.
+
+Usage:
+    py columnarExport.py [export_dir]
+
+Tables (each under export_dir/<table>/category=<name>/part-0.parquet):
+    products         one row per product, lists kept as list columns
+    characteristics  long format: product_id, group, title, value
+    reviews          one row per review, joined to its product through product_url
+    ratings          long format: opinion_id, aspect, value
+    comments         one row per review comment
+
+Records are read one at a time from the storage backend (the JSON Lines files, or crawl_data.db with
+STORAGE=sqlite) and written in batches. Only the category and id of every product are kept in memory,
+to partition and link the reviews, so memory grows with the number of products, not with the output size.
+Requires pyarrow, pinned in requirements.txt.
+"""
+import os
+import shutil
+import sys
+from urllib.parse import quote
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+import config
+from jsonSink import close_sink, read_jsonl
+from sqliteStore import get_store
+
+UNKNOWN_CATEGORY = 'unknown'
+
+
+def _schemas():
+    strings = pa.list_(pa.string())
+    return {
+        'products': pa.schema([
+            ('id', pa.string()), ('url', pa.string()), ('name', pa.string()), ('brand_name', pa.string()),
+            ('price_discounted', pa.int64()), ('price_original', pa.int64()), ('rating', pa.float64()),
+            ('number_of_reviews', pa.int64()), ('description', pa.string()),
+            ('categories', pa.list_(pa.struct([('name', pa.string()), ('url', pa.string())]))),
+            ('images', strings), ('drivers', strings),
+        ]),
+        'characteristics': pa.schema([
+            ('product_id', pa.string()), ('group', pa.string()), ('title', pa.string()), ('value', pa.string()),
+        ]),
+        'reviews': pa.schema([
+            ('opinion_id', pa.string()), ('product_url', pa.string()), ('product_id', pa.string()),
+            ('username', pa.string()), ('date', pa.string()), ('advantages', pa.string()),
+            ('disadvantages', pa.string()), ('comment', pa.string()), ('likes', pa.int64()),
+            ('media', strings), ('additions', pa.map_(pa.string(), pa.string())),
+        ]),
+        'ratings': pa.schema([
+            ('opinion_id', pa.string()), ('aspect', pa.string()), ('value', pa.int64()),
+        ]),
+        'comments': pa.schema([
+            ('opinion_id', pa.string()), ('username', pa.string()), ('date', pa.string()),
+            ('comment_text', pa.string()), ('likes', pa.int64()),
+        ]),
+    }
+
+
+def product_category(item):
+    """ Leaf category name of a product: the last breadcrumb. """
+    categories = item.get('categories') or []
+    return (categories[-1].get('name') if categories else None) or UNKNOWN_CATEGORY
+
+
+class PartitionedWriter:
+    """ Buffers rows per category and appends them to one Parquet file per partition. """
+
+    def __init__(self, root, schema, batch_size):
+        self.root = root
+        self.schema = schema
+        self.batch_size = batch_size
+        self._buffers = {}
+        self._writers = {}
+        self.rows = 0
+
+    def write(self, category, row):
+        buffer = self._buffers.setdefault(category, [])
+        buffer.append(row)
+        self.rows += 1
+        if len(buffer) >= self.batch_size:
+            self._flush(category)
+
+    def _flush(self, category):
+        rows = self._buffers.pop(category, None)
+        if not rows:
+            return
+        if category not in self._writers:
+            # Hive-style directory names, URI-encoded the way pyarrow datasets decode them
+            directory = os.path.join(self.root, f"category={quote(category, safe='')}")
+            os.makedirs(directory, exist_ok=True)
+            self._writers[category] = pq.ParquetWriter(os.path.join(directory, 'part-0.parquet'), self.schema)
+        self._writers[category].write_table(pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        for category in list(self._buffers):
+            self._flush(category)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def export_items(items, tables, categories):
+    """ Write products and characteristics; remember every product's category and id by URL. """
+    for item in items:
+        category = product_category(item)
+        categories[item.get('url')] = (category, item.get('id'))
+        tables['products'].write(category, {
+            'id': item.get('id'),
+            'url': item.get('url'),
+            'name': item.get('name'),
+            'brand_name': item.get('brand_name'),
+            'price_discounted': _int(item.get('price_discounted')),
+            'price_original': _int(item.get('price_original')),
+            'rating': item.get('rating'),
+            'number_of_reviews': _int(item.get('number_of_reviews')),
+            'description': item.get('description'),
+            'categories': [{'name': category.get('name'), 'url': category.get('url')}
+                           for category in item.get('categories') or []],
+            'images': item.get('images') or [],
+            'drivers': item.get('drivers') or [],
+        })
+        for group, specs in (item.get('characteristics') or {}).items():
+            for spec in specs:
+                tables['characteristics'].write(category, {
+                    'product_id': item.get('id'), 'group': group, 'title': spec.get('title'), 'value': spec.get('value'),
+                })
+
+
+def export_reviews(reviews, tables, categories):
+    """ Write reviews with their ratings and comments, partitioned by the category of their product. """
+    for review in reviews:
+        category, product_id = categories.get(review.get('product_url'), (UNKNOWN_CATEGORY, None))
+        opinion_id = review.get('opinion_id')
+        tables['reviews'].write(category, {
+            'opinion_id': opinion_id,
+            'product_url': review.get('product_url'),
+            'product_id': product_id,
+            'username': review.get('username'),
+            'date': review.get('date'),
+            'advantages': review.get('advantages'),
+            'disadvantages': review.get('disadvantages'),
+            'comment': review.get('comment'),
+            'likes': _int(review.get('likes')),
+            'media': review.get('media') or [],
+            'additions': list((review.get('additions') or {}).items()),
+        })
+        for aspect, value in (review.get('rating') or {}).items():
+            tables['ratings'].write(category, {'opinion_id': opinion_id, 'aspect': aspect, 'value': _int(value)})
+        for comment in review.get('comments') or []:
+            tables['comments'].write(category, {
+                'opinion_id': opinion_id,
+                'username': comment.get('username'),
+                'date': comment.get('date'),
+                'comment_text': comment.get('comment_text'),
+                'likes': _int(comment.get('likes')),
+            })
+
+
+def _records(items_file, reviews_file):
+    """ Items and reviews from the JSON Lines files given, else from the configured storage. """
+    if items_file is None and reviews_file is None and config.STORAGE != 'jsonl':
+        if config.STORAGE != 'sqlite':
+            raise RuntimeError(f"Columnar export can't read STORAGE={config.STORAGE}")
+        store = get_store()
+        return store.records('products'), store.records('reviews')
+
+    items_file = items_file or config.ITEMS_FILE
+    reviews_file = reviews_file or config.REVIEWS_FILE
+    # Buffered records of a running crawl must reach the files first
+    close_sink(items_file)
+    close_sink(reviews_file)
+    return read_jsonl(items_file), read_jsonl(reviews_file)
+
+
+def export(export_dir=None, items_file=None, reviews_file=None, batch_size=None):
+    """ Convert items and reviews into partitioned Parquet tables. Returns rows per table.
+    Without file names the records come from the STORAGE backend. """
+    if pa is None:
+        raise RuntimeError("Columnar export needs pyarrow: pip install -r requirements.txt")
+    export_dir = export_dir or config.EXPORT_DIR
+    batch_size = batch_size or config.EXPORT_BATCH
+    items, reviews = _records(items_file, reviews_file)
+
+    # A re-export replaces the tables; stale partitions would otherwise be read along with the new ones
+    for name in _schemas():
+        shutil.rmtree(os.path.join(export_dir, name), ignore_errors=True)
+    tables = {
+        name: PartitionedWriter(os.path.join(export_dir, name), schema, batch_size)
+        for name, schema in _schemas().items()
+    }
+    categories = {}
+    try:
+        export_items(items, tables, categories)
+        export_reviews(reviews, tables, categories)
+    finally:
+        for table in tables.values():
+            table.close()
+
+    rows = {name: table.rows for name, table in tables.items()}
+    print(f"Exported to {export_dir}: " + ', '.join(f"{name} {count}" for name, count in rows.items()))
+    return rows
+
+
+if __name__ == '__main__':
+    export(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,167 @@
+"""Runtime settings. Every value can be overridden through environment variables (see README)."""
+import os
+
+# Number of parallel Chrome sessions used by productDetailsParser
+WORKERS = int(os.getenv("WORKERS", 1))
+
+# Product URLs taken ahead of the one being saved; bounds the memory of the product pipeline
+PIPELINE_BUFFER = int(os.getenv("PIPELINE_BUFFER", 32))
+
+# Threads that parse page snapshots while the browsers load the next pages; 0 parses in the browser's thread
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", 0))
+# Captured snapshots waiting for a parse thread; a browser that gets ahead waits for a free place
+PARSE_QUEUE = int(os.getenv("PARSE_QUEUE", 8))
+# Parse in PARSE_WORKERS processes instead of threads, so parsing isn't held to one core by the GIL
+PARSE_PROCESSES = os.getenv("PARSE_PROCESSES", "0") == "1"
+# Pages sent to a parse process in one round trip when a recorded corpus is parsed in bulk
+PARSE_CHUNK = int(os.getenv("PARSE_CHUNK", 16))
+
+# Directory that holds a separate Chrome profile for every worker
+PROFILES_DIR = os.getenv("PROFILES_DIR", "profiles")
+
+# Restart a pooled browser after this many pages or when its processes' resident memory grew by this many MB
+BROWSER_MAX_PAGES = int(os.getenv("BROWSER_MAX_PAGES", 50))
+BROWSER_MAX_MEMORY_GROWTH = float(os.getenv("BROWSER_MAX_MEMORY_GROWTH", 300))
+
+# Block image bytes, fonts, media and trackers in Chrome. Patterns use "*" wildcards (DevTools Network.setBlockedURLs);
+# the site's own scripts stay allowed so the characteristics and review widgets still work
+BLOCK_RESOURCES = os.getenv("BLOCK_RESOURCES", "0") == "1"
+BLOCKED_URLS = [pattern.strip() for pattern in os.getenv("BLOCKED_URLS", ",".join([
+    "*.jpg*", "*.jpeg*", "*.png*", "*.gif*", "*.webp*", "*.avif*", "*.svg*", "*.ico*",
+    "*.woff*", "*.ttf*", "*.otf*", "*.eot*",
+    "*.mp4*", "*.webm*", "*.m3u8*",
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*mc.yandex.ru*",
+    "*top-fwz1.mail.ru*", "*vk.com/rtrg*", "*connect.facebook.net*", "*criteo.*", "*tiktok.com*",
+])).split(",") if pattern.strip()]
+
+# How many times a URL is retried after the browser crashed on it
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", 2))
+
+# Crawler output: append-only JSON Lines files and their pretty JSON copies
+ITEMS_FILE = os.getenv("ITEMS_FILE", "items.jsonl")
+REVIEWS_FILE = os.getenv("REVIEWS_FILE", "reviews.jsonl")
+ITEMS_JSON = os.getenv("ITEMS_JSON", "items.json")
+REVIEWS_JSON = os.getenv("REVIEWS_JSON", "reviews.json")
+
+# Where products and reviews go: "jsonl" (files above) or "sqlite" (STORAGE_DB with indexes and upserts)
+STORAGE = os.getenv("STORAGE", "jsonl")
+STORAGE_DB = os.getenv("STORAGE_DB", "crawl_data.db")
+
+# fsync output files after this many records
+FSYNC_EVERY = int(os.getenv("FSYNC_EVERY", 50))
+
+# Rebuild items.json / reviews.json from the JSON Lines files at the end of a run
+COMPACT_OUTPUT = os.getenv("COMPACT_OUTPUT", "1") == "1"
+
+# Parquet export (columnarExport.py): output directory and rows buffered per partition before a write
+EXPORT_DIR = os.getenv("EXPORT_DIR", "export")
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", 5000))
+
+# SQLite file with crawl progress used to resume an interrupted run
+STATE_DB = os.getenv("STATE_DB", "crawl_state.db")
+
+# How product pages are fetched: "browser" (Selenium) or "http" (requests, browser as fallback)
+FETCH_MODE = os.getenv("FETCH_MODE", "browser")
+
+# In "http" mode, open the page in the browser when the HTML has no image slider
+BROWSER_IMAGES = os.getenv("BROWSER_IMAGES", "1") == "1"
+
+# Full-size gallery images saved per product
+MAX_IMAGES = int(os.getenv("MAX_IMAGES", 5))
+
+# HTTP connection pool size and request timeout in seconds
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 10))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 15))
+
+# Save every fetched product, review and category page for offline replay (benchmark.py replay)
+RECORD_PAGES = os.getenv("RECORD_PAGES", "0") == "1"
+FIXTURES_DIR = os.getenv("FIXTURES_DIR", "fixtures")
+
+# Keep every fetched page in a zstd-compressed, content-addressed archive for re-parsing (pageArchive.py)
+ARCHIVE_PAGES = os.getenv("ARCHIVE_PAGES", "0") == "1"
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_LEVEL = int(os.getenv("ARCHIVE_LEVEL", 10))
+# Pages of a kind archived before a compression dictionary is trained on them, and its size in bytes
+ARCHIVE_TRAIN_AFTER = int(os.getenv("ARCHIVE_TRAIN_AFTER", 200))
+ARCHIVE_DICT_SIZE = int(os.getenv("ARCHIVE_DICT_SIZE", 112640))
+# Where `pageArchive.py reparse` writes the rebuilt items and reviews
+REPARSE_DIR = os.getenv("REPARSE_DIR", "reparsed")
+
+# Local port serving /metrics and /metrics.json during a run; 0 turns the endpoint off
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+# JSON summary of counters and latency histograms written when a run ends; empty to skip it
+METRICS_FILE = os.getenv("METRICS_FILE", "metrics.json")
+# Comma-separated stages to run under cProfile (links, product, reviews, categories)
+PROFILE_STAGES = os.getenv("PROFILE_STAGES", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "cprofile")
+
+# How reviews are read: "snapshot" (one page_source parsed with lxml) or "webdriver" (element by element)
+REVIEW_MODE = os.getenv("REVIEW_MODE", "snapshot")
+
+# Where reviews come from: "browser" (the reviews page in Chrome) or "api" (the widget's XHR endpoints)
+REVIEW_SOURCE = os.getenv("REVIEW_SOURCE", "browser")
+REVIEWS_API_URL = os.getenv(
+    "REVIEWS_API_URL", "https://www.dns-shop.ru/opinion/get-opinions/?code={product_code}&p={page}"
+)
+COMMENTS_API_URL = os.getenv(
+    "COMMENTS_API_URL", "https://www.dns-shop.ru/opinion/get-comments/?opinionId={opinion_id}"
+)
+# Products whose reviews are fetched at the same time in "api" mode
+REVIEWS_API_WORKERS = int(os.getenv("REVIEWS_API_WORKERS", 4))
+
+# categoriesParcer: cached REST API responses are reused for API_CACHE_TTL seconds, then revalidated
+API_CACHE_DIR = os.getenv("API_CACHE_DIR", "api_cache")
+API_CACHE_TTL = int(os.getenv("API_CACHE_TTL", 24 * 3600))
+# New, changed and removed leaf categories found by categoriesParcer since the previous menu
+CATEGORIES_DIFF_FILE = os.getenv("CATEGORIES_DIFF_FILE", "categories_diff.json")
+# linksParser walks only the leaf categories that are new or changed in CATEGORIES_DIFF_FILE
+CHANGED_CATEGORIES_ONLY = os.getenv("CHANGED_CATEGORIES_ONLY", "0") == "1"
+
+# How linksParser walks categories: "browser" (one Chrome, page by page) or "async" (concurrent HTTP)
+LINKS_MODE = os.getenv("LINKS_MODE", "browser")
+# "async" mode: requests in flight at once and requests per second per host
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", 8))
+CRAWL_RATE = float(os.getenv("CRAWL_RATE", 2))
+
+# Also save price, rating and review count of every catalog card while collecting links
+EMIT_LISTING = os.getenv("EMIT_LISTING", "0") == "1"
+LISTING_FILE = os.getenv("LISTING_FILE", "listing.jsonl")
+
+# Shared work queue (workQueue.py): database, seconds a leased task stays hidden, idle poll interval
+QUEUE_DB = os.getenv("QUEUE_DB", "work_queue.db")
+QUEUE_VISIBILITY = float(os.getenv("QUEUE_VISIBILITY", 900))
+QUEUE_IDLE_WAIT = float(os.getenv("QUEUE_IDLE_WAIT", 10))
+# Coordinator (py workQueue.py serve): workers on other hosts set QUEUE_URL, e.g. http://10.0.0.5:8765,
+# and send QUEUE_TOKEN with every call
+QUEUE_URL = os.getenv("QUEUE_URL", "")
+QUEUE_HOST = os.getenv("QUEUE_HOST", "127.0.0.1")
+QUEUE_PORT = int(os.getenv("QUEUE_PORT", 8765))
+QUEUE_TOKEN = os.getenv("QUEUE_TOKEN", "")
+
+# Re-crawl mode: linksParser walks every category again for listing records, productDetailsParser
+# compares them with the fingerprints and deep-parses only the products that changed
+REFRESH = os.getenv("REFRESH", "0") == "1"
+
+
+def _stage_budgets(defaults):
+    """ Parse STAGE_DELAYS like "product=1:120:5:1:10,links=0.5:60:3:0.5:5" over the defaults. """
+    budgets = dict(defaults)
+    for entry in filter(None, os.getenv("STAGE_DELAYS", "").split(",")):
+        stage, values = entry.split("=")
+        budgets[stage.strip()] = tuple(float(value) for value in values.split(":"))
+    return budgets
+
+
+# Adaptive pacing per stage, in seconds: (min delay, max delay, start delay, step, target latency).
+# The delay drops by `step` after every fast answer and is multiplied by DELAY_BACKOFF on 403/429 or a captcha
+STAGE_BUDGETS = _stage_budgets({
+    "links": (0.5, 60, 3, 0.5, 5),
+    "product": (1, 120, 5, 1, 10),
+    "reviews": (0.5, 60, 2, 0.5, 5),
+    "reviews_api": (0.2, 60, 1, 0.2, 3),
+    "default": (1, 60, 3, 0.5, 10),
+})
+DELAY_BACKOFF = float(os.getenv("DELAY_BACKOFF", 2))
+# "worker": every worker thread waits the stage delay between its own requests (the rate grows with WORKERS);
+# "stage": all requests of a stage are spaced by the delay, one site-wide cap whatever WORKERS is
+PACING = os.getenv("PACING", "worker")
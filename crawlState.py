@@ -0,0 +1,159 @@
+import sqlite3
+import threading
+from datetime import datetime
+
+import config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS categories (
+    url TEXT PRIMARY KEY,
+    last_page INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS product_urls (
+    url TEXT PRIMARY KEY,
+    category_url TEXT,
+    added_at TEXT
+);
+CREATE TABLE IF NOT EXISTS products (
+    url TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    product_id TEXT PRIMARY KEY,
+    url TEXT,
+    hash TEXT NOT NULL,
+    number_of_reviews INTEGER,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS review_cursors (
+    product_url TEXT PRIMARY KEY,
+    pages INTEGER NOT NULL DEFAULT 0,
+    last_opinion_id TEXT,
+    done INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT
+);
+"""
+
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+class CrawlState:
+    """ Progress of every crawl stage, kept in SQLite so a killed run can resume. """
+
+    def __init__(self, filename=None):
+        self.filename = filename or config.STATE_DB
+        # Queue workers share the file: WAL lets them read while one writes, the timeout waits out the writer
+        self._conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).fetchall()
+
+    # Categories
+
+    def category_progress(self, url):
+        """ Return (last parsed page, done flag) for a category URL template. """
+        rows = self._execute("SELECT last_page, done FROM categories WHERE url = ?", (url,))
+        return (rows[0][0], bool(rows[0][1])) if rows else (0, False)
+
+    def save_category_page(self, url, page, done=False):
+        self._execute(
+            "INSERT INTO categories (url, last_page, done, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET last_page = excluded.last_page, done = excluded.done, "
+            "updated_at = excluded.updated_at",
+            (url, page, int(done), _now()),
+        )
+
+    def reset_category(self, url):
+        """ Forget the progress of a category so its pages are crawled again. """
+        self._execute("DELETE FROM categories WHERE url = ?", (url,))
+
+    # Product URLs
+
+    def add_product_urls(self, urls, category_url=None):
+        """ Remember product URLs and return only the ones seen for the first time. """
+        new_urls = []
+        with self._lock, self._conn:
+            for url in urls:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO product_urls (url, category_url, added_at) VALUES (?, ?, ?)",
+                    (url, category_url, _now()),
+                )
+                if cursor.rowcount:
+                    new_urls.append(url)
+        return new_urls
+
+    def count_product_urls(self):
+        return self._execute("SELECT COUNT(*) FROM product_urls")[0][0]
+
+    # Products
+
+    def is_product_done(self, url):
+        return bool(self._execute("SELECT 1 FROM products WHERE url = ? AND status = 'done'", (url,)))
+
+    def set_product_status(self, url, status):
+        self._execute(
+            "INSERT INTO products (url, status, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at",
+            (url, status, _now()),
+        )
+
+    # Fingerprints
+
+    def fingerprint(self, product_id):
+        """ Return (hash, number of reviews) saved for a product id, or None. """
+        rows = self._execute("SELECT hash, number_of_reviews FROM fingerprints WHERE product_id = ?", (product_id,))
+        return rows[0] if rows else None
+
+    def save_fingerprint(self, product_id, url, fingerprint, number_of_reviews):
+        self._execute(
+            "INSERT INTO fingerprints (product_id, url, hash, number_of_reviews, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(product_id) DO UPDATE SET url = excluded.url, hash = excluded.hash, "
+            "number_of_reviews = excluded.number_of_reviews, updated_at = excluded.updated_at",
+            (product_id, url, fingerprint, number_of_reviews, _now()),
+        )
+
+    # Reviews
+
+    def review_cursor(self, product_url):
+        """ Return (loaded "Load More" pages, last opinion id, done flag) for a product. """
+        rows = self._execute(
+            "SELECT pages, last_opinion_id, done FROM review_cursors WHERE product_url = ?", (product_url,)
+        )
+        return (rows[0][0], rows[0][1], bool(rows[0][2])) if rows else (0, None, False)
+
+    def save_review_cursor(self, product_url, pages, last_opinion_id=None, done=False):
+        self._execute(
+            "INSERT INTO review_cursors (product_url, pages, last_opinion_id, done, updated_at) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(product_url) DO UPDATE SET pages = excluded.pages, "
+            "last_opinion_id = COALESCE(excluded.last_opinion_id, review_cursors.last_opinion_id), "
+            "done = excluded.done, updated_at = excluded.updated_at",
+            (product_url, pages, last_opinion_id, int(done), _now()),
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_state():
+    """ Return the crawl state shared by every stage of the process. """
+    global _state
+    with _state_lock:
+        if _state is None:
+            _state = CrawlState()
+        return _state
@@ -0,0 +1,64 @@
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import config
+import metrics
+from scheduler import SCHEDULER, is_blocked
+
+HEADERS = {
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
+    "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "accept-language": "ru-RU,ru;q=0.9,en;q=0.8",
+}
+
+
+def create_session(pool_size=None):
+    """ Create an HTTP session with a keep-alive connection pool and retries on server errors. """
+    pool_size = pool_size or config.HTTP_POOL_SIZE
+    session = requests.Session()
+    session.headers.update(HEADERS)
+
+    retry = Retry(total=2, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_html(session, url, stage=None, pace=True):
+    """ Download a page. Returns None when the site didn't answer with 200.
+    With a stage the request is paced by the scheduler and its outcome reported back;
+    `pace=False` only reports it, for callers that limit their rate themselves. """
+    if stage and pace:
+        SCHEDULER.wait(stage)
+    start = time.monotonic()
+    try:
+        response = session.get(url, timeout=config.HTTP_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Ошибка запроса {url}: {e}")
+        metrics.inc('request_errors', stage)
+        if stage:
+            SCHEDULER.record(stage, time.monotonic() - start, status=None)
+        return None
+
+    if stage:
+        SCHEDULER.record(stage, time.monotonic() - start, response.status_code,
+                         blocked=is_blocked(response.text, response.status_code))
+    if response.status_code == 200:
+        return response.text
+    else:
+        print(f"Ошибка получения {url}: {response.status_code}")
+        return None
+
+
+def is_product_page(html):
+    """ Check that the server returned the product card and not an anti-bot stub. """
+    return 'product-card-top__code' in html
+
+
+def is_listing_page(html):
+    """ Check that the server returned a catalog page with product cards and not an anti-bot stub. """
+    return 'catalog-product' in html and not is_blocked(html)
@@ -0,0 +1,171 @@
+import atexit
+import json
+import os
+import sys
+import textwrap
+import threading
+
+import config
+
+
+class JsonlSink:
+    """ Append-only JSON Lines writer. Records are flushed at once and fsync'ed in batches. """
+
+    def __init__(self, filename, fsync_every=None):
+        self.filename = filename
+        self.fsync_every = fsync_every or config.FSYNC_EVERY
+        self._file = open(filename, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._unsynced = 0
+
+        # A crash may leave half a line at the end; start the next record on a new one
+        if self._file.tell() and not _ends_with_newline(filename):
+            self._file.write("\n")
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            self._sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _ends_with_newline(filename):
+    with open(filename, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def get_sink(filename):
+    """ Return the shared sink for a file, so every writer in the process appends through it. """
+    with _sinks_lock:
+        sink = _sinks.get(filename)
+        if sink is None:
+            import_legacy_json(filename)
+            sink = _sinks[filename] = JsonlSink(filename)
+        return sink
+
+
+def close_sink(filename):
+    with _sinks_lock:
+        sink = _sinks.pop(filename, None)
+    if sink:
+        sink.close()
+
+
+@atexit.register
+def close_sinks():
+    with _sinks_lock:
+        for sink in _sinks.values():
+            sink.close()
+        _sinks.clear()
+
+
+def read_jsonl(filename):
+    """ Yield records from a JSON Lines file, skipping a line cut off by a crash. """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Warning: skipping broken line {number} in {filename}")
+
+
+def legacy_json(jsonl_filename):
+    """ The JSON array an output file was kept in before the JSON Lines sink, None for other files. """
+    return {config.ITEMS_FILE: config.ITEMS_JSON, config.REVIEWS_FILE: config.REVIEWS_JSON}.get(jsonl_filename)
+
+
+def _load_json_array(json_filename):
+    if not os.path.exists(json_filename) or not os.path.getsize(json_filename):
+        return []
+    with open(json_filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def import_legacy_json(jsonl_filename):
+    """ Start a missing JSON Lines file from the records of its legacy JSON array, so data saved by
+    earlier runs is neither written again nor lost by the next compact(). Returns the records imported. """
+    json_filename = legacy_json(jsonl_filename)
+    if json_filename is None or os.path.exists(jsonl_filename):
+        return 0
+    records = _load_json_array(json_filename)
+    if not records:
+        return 0
+
+    tmp_filename = jsonl_filename + '.tmp'
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_filename, jsonl_filename)
+    print(f"Imported {len(records)} records from {json_filename} into {jsonl_filename}")
+    return len(records)
+
+
+def _record_key(record):
+    return record.get('opinion_id') or record.get('id') or record.get('url') or json.dumps(record, sort_keys=True)
+
+
+def compact(jsonl_filename, json_filename):
+    """ Rebuild a pretty JSON array from a JSON Lines file without loading it into memory.
+    A JSON file holding records the JSON Lines file lacks is left untouched instead of being cut down. """
+    if not os.path.exists(jsonl_filename):
+        print(f"Info: {jsonl_filename} does not exist, {json_filename} is left untouched.")
+        return 0
+
+    close_sink(jsonl_filename)
+    tmp_filename = json_filename + '.tmp'
+    count = 0
+    keys = set()
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for record in read_jsonl(jsonl_filename):
+            f.write(',\n' if count else '\n')
+            f.write(textwrap.indent(json.dumps(record, ensure_ascii=False, indent=4), '    '))
+            keys.add(_record_key(record))
+            count += 1
+        f.write('\n]' if count else ']')
+
+    # Only the keys of the old array are kept; it may hold records saved before the JSON Lines file
+    missing = sum(_record_key(record) not in keys for record in _load_json_array(json_filename))
+    if missing:
+        os.remove(tmp_filename)
+        print(f"Warning: {json_filename} has {missing} records missing from {jsonl_filename}, "
+              f"it is left untouched. Move it away to rebuild it from {jsonl_filename}.")
+        return 0
+    os.replace(tmp_filename, json_filename)
+    print(f"Compacted {count} records from {jsonl_filename} into {json_filename}")
+    return count
+
+
+if __name__ == '__main__':
+    compact(sys.argv[1], sys.argv[2])
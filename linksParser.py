@@ -1,15 +1,23 @@
 import json
 import os
-import sys
-import undetected_chromedriver as uc
+import re
+from datetime import datetime
 from bs4 import BeautifulSoup
-from random import randint
-from time import sleep as pause
+from selenium.webdriver.common.by import By
 
+import config
+import metrics
+from browserSession import close_pool, get_pool, open_page
+from categoriesParcer import category_template, iter_leaves, load_json, pending_leaf_urls, save_to_json
+from crawlState import get_state
+from jsonSink import get_sink, read_jsonl
+from pageRecorder import record_page
+from productPage import BASE_URL, clean_price
 
-def get_urls_from_page(driver):
-    """ Collects all product links on the current page. """
-    soup = BeautifulSoup(driver.page_source, 'lxml')
+
+@metrics.timed('extract_product_urls')
+def extract_product_urls(soup):
+    """ Collects all product links from a parsed catalog page. """
     elements = soup.find_all('a', class_="catalog-product__name ui-link ui-link_black")
     return list(map(
         lambda element: 'https://www.dns-shop.ru' + element.get("href"),
@@ -17,36 +25,158 @@ def get_urls_from_page(driver):
     ))
 
 
-def get_all_category_page_urls(driver, url_to_parse):
-    """ Get category URL and parse links from it. """
-    page = 1
+def _review_count(text):
+    """ Review counter of a listing card: "12", "1.2k" or "1,2 тыс.". """
+    match = re.search(r'(\d+(?:[.,]\d+)?)\s*(k|к|тыс)?', text or '')
+    if not match:
+        return None
+    number = float(match.group(1).replace(',', '.'))
+    return int(round(number * 1000)) if match.group(2) else int(number)
+
+
+@metrics.timed('parse_listing_cards')
+def parse_listing_cards(soup, category_url=None):
+    """ Lightweight product records (price, rating, review count) from the cards of a catalog page.
+    Prices are only present when the page was rendered by a browser, which loads them via XHR. """
+    scraped_at = datetime.now().isoformat(timespec='seconds')
+    records = []
+    for card in soup.select('div.catalog-product'):
+        link = card.select_one('a.catalog-product__name')
+        if link is None or not link.get('href'):
+            continue
+
+        price = card.select_one('.product-buy__price')
+        # The old price is a nested span, so only the block's own text is the current price
+        price_discounted = clean_price(''.join(price.find_all(string=True, recursive=False))) if price else None
+        previous = card.select_one('.product-buy__prev')
+        rating = card.select_one('a.catalog-product__rating')
+        counter = rating.find('span') if rating else None
+
+        records.append({
+            "id": card.get('data-code'),
+            "url": BASE_URL + link['href'],
+            "name": link.get_text(' ', strip=True),
+            "price_discounted": price_discounted,
+            "price_original": (clean_price(previous.get_text()) if previous else None) or price_discounted,
+            "rating": float(rating['data-rating']) if rating and rating.get('data-rating') else None,
+            "number_of_reviews": _review_count(counter.get_text()) if counter else None,
+            "category_url": category_url,
+            "scraped_at": scraped_at,
+        })
+    return records
+
+
+def emit_listing():
+    """ Whether listing records are saved: with EMIT_LISTING, and always in REFRESH mode, which compares them. """
+    return config.EMIT_LISTING or config.REFRESH
+
+
+def save_listing(soup, category_url):
+    """ Append the listing records of a catalog page to LISTING_FILE when emit_listing() is on. """
+    if not emit_listing():
+        return 0
+    records = parse_listing_cards(soup, category_url)
+    sink = get_sink(config.LISTING_FILE)
+    for record in records:
+        sink.write(record)
+    metrics.inc('saved', 'listing', len(records))
+    return len(records)
+
+
+def latest_listing(filename=None):
+    """ The newest listing record of every product URL in LISTING_FILE, as {url: record}. """
+    listing = {}
+    for record in read_jsonl(filename or config.LISTING_FILE):
+        # Records are appended as pages are crawled, so a later one is newer
+        listing[record['url']] = record
+    return listing
+
+
+def get_urls_from_page(driver):
+    """ Collects all product links on the current page. """
+    return extract_product_urls(BeautifulSoup(driver.page_source, 'lxml'))
+
+
+def has_next_page(soup):
+    """ Check for "Next page" button. """
+    next_button = soup.find('a', class_="pagination-widget__page-link pagination-widget__page-link_next")
+    return bool(next_button) and 'disabled' not in next_button.get('class', [])
+
+
+def last_page_number(soup):
+    """ Highest page number shown in the pagination widget, None if the widget has none. """
+    numbers = [int(item['data-page-number']) for item in soup.select('[data-page-number]')
+               if item['data-page-number'].isdigit()]
+    for link in soup.select('a.pagination-widget__page-link[href]'):
+        match = re.search(r'[?&]p=(\d+)', link['href'])
+        if match:
+            numbers.append(int(match.group(1)))
+    return max(numbers) if numbers else None
+
+
+def save_new_urls(page_urls, category_url):
+    """ Append links not seen before to urls.txt and return them. """
+    page_urls = get_state().add_product_urls(page_urls, category_url)
+    with open('urls.txt', 'a') as file:
+        for link in page_urls:
+            file.write(link + "\n")
+    metrics.inc('saved', 'links', len(page_urls))
+    return page_urls
+
+
+def get_all_category_page_urls(driver, url_to_parse, on_page=None):
+    """ Get category URL and parse links from it.
+    `on_page` gets every product link of each page, before the page counts as parsed. """
+    state = get_state()
+    last_page, done = state.category_progress(url_to_parse)
+    if done:
+        print('Category already parsed, skipping.')
+        return []
+
+    # Continue after the last page saved by an interrupted run
+    page = last_page + 1
     urls = []
 
     while True:
         url = url_to_parse.format(page=page)
-        driver.get(url)
-        pause(randint(2, 4))
+        # Listing prices arrive by XHR after the cards, so wait for them when they are saved
+        ready = (By.CLASS_NAME, 'product-buy__price' if emit_listing() else 'catalog-product__name')
+        if not open_page(driver, url, 'links', ready=ready):
+            # Keep the progress so the next run starts from this page
+            print(f"Captcha on {url}, stopping category.")
+            break
 
-        soup = BeautifulSoup(driver.page_source, 'lxml')
+        html = driver.page_source
+        record_page('category', url, html)
+        soup = BeautifulSoup(html, 'lxml')
 
-        # Get links from current page
-        page_urls = get_urls_from_page(driver)
-        with open('urls.txt', 'a') as file:
-            for link in page_urls:
-                file.write(link + "\n")
-        urls += page_urls
+        # Get links from current page, skipping ones already in urls.txt
+        page_urls = extract_product_urls(soup)
+        if on_page is not None:
+            on_page(page_urls)
+        urls += save_new_urls(page_urls, url_to_parse)
+        save_listing(soup, url_to_parse)
 
-        # Check for "Next page" button
-        next_button = soup.find('a', class_="pagination-widget__page-link pagination-widget__page-link_next")
-        if not next_button or 'disabled' in next_button.get('class', []):
+        if not has_next_page(soup):
+            state.save_category_page(url_to_parse, page, done=True)
             break
 
+        state.save_category_page(url_to_parse, page)
         page += 1
 
-    print(f'Total {len(urls)} links collected from category.')
+    print(f'Total {len(urls)} new links collected from category.')
     return urls
 
 
+def seed_state_from_file(file_path='urls.txt'):
+    """ Register links from an existing urls.txt so they are not written twice. """
+    state = get_state()
+    if state.count_product_urls() or not os.path.exists(file_path):
+        return
+    with open(file_path, 'r') as file:
+        state.add_product_urls(line.strip() for line in file if line.strip())
+
+
 def get_links_from_json(file_path="categories.json"):
     """Extracts links from categories.json."""
     if not os.path.exists(file_path):
@@ -60,57 +190,73 @@ def get_links_from_json(file_path="categories.json"):
     return links
 
 
-def generate_urls_from_json(json_data):
-    urls_to_parse = []
+def generate_urls_from_json(json_data, leaf_urls=None):
+    """ Page URL templates of the leaf categories of a get-menu tree.
+    With `leaf_urls` only the leaves with those category URLs are taken. """
+    return [
+        category_template(item['url']) for item in iter_leaves(json_data)
+        if leaf_urls is None or item['url'] in leaf_urls
+    ]
 
-    def process_item(item):
-        # Если у элемента нет childs или childs - пустой список
-        if not item.get('childs'):
-            base_url = 'https://www.dns-shop.ru'
-            full_url = base_url + item['url'] + '?p={page}'
-            urls_to_parse.append(full_url)
 
-    def process_childs(data):
-        # Если data - список, обрабатываем каждый элемент
-        if isinstance(data, list):
-            for item in data:
-                # Сначала обрабатываем текущий элемент
-                process_item(item)
+def changed_leaf_urls(diff_file=None):
+    """ Category URLs that categoriesParcer found new or changed and that are not crawled yet,
+    None when there is no diff yet. """
+    diff = load_json(diff_file or config.CATEGORIES_DIFF_FILE)
+    return None if diff is None else set(pending_leaf_urls(diff))
 
-                # Затем рекурсивно обрабатываем его вложенные подкатегории
-                if item.get('childs'):
-                    process_childs(item['childs'])
-        # Если data - словарь, обрабатываем его как элемент
-        elif isinstance(data, dict):
-            process_item(data)
-            if data.get('childs'):
-                process_childs(data['childs'])
 
-    # Начинаем обработку с корня JSON
-    process_childs(json_data)
+def consume_changed_leaves(diff_file=None):
+    """ Drop the categories crawled to their last page from the pending ones of the diff. """
+    diff_file = diff_file or config.CATEGORIES_DIFF_FILE
+    diff = load_json(diff_file)
+    if diff is None:
+        return
+    state = get_state()
+    pending = [url for url in pending_leaf_urls(diff) if not state.category_progress(category_template(url))[1]]
+    if pending != diff.get('pending'):
+        save_to_json({**diff, 'pending': pending}, diff_file)
 
-    return urls_to_parse
 
 def main():
-    driver = uc.Chrome()
+    metrics.start()
+    seed_state_from_file()
 
     # Parse the JSON data from the provided document
     with open('categories.json', 'r', encoding='utf-8') as file:
         data = json.load(file)
 
-    # Generate URLs
-    urls_to_parse = generate_urls_from_json(data)
+    # Generate URLs, only for the categories that changed since the previous menu when asked to
+    leaf_urls = changed_leaf_urls() if config.CHANGED_CATEGORIES_ONLY else None
+    if config.CHANGED_CATEGORIES_ONLY and leaf_urls is None:
+        print(f"{config.CATEGORIES_DIFF_FILE} not found, crawling every category")
+    urls_to_parse = generate_urls_from_json(data, leaf_urls)
+    if config.REFRESH:
+        # A refresh compares fresh listing cards, so categories finished before are walked again
+        state = get_state()
+        for url in urls_to_parse:
+            state.reset_category(url)
 
     # Print the generated URLs
     print("URLs to parse:")
     for url in urls_to_parse:
         print(url)
 
+    if config.LINKS_MODE == 'async':
+        # Imported here: categoryCrawler builds on this module
+        from categoryCrawler import crawl_categories
+        crawl_categories(urls_to_parse)
+        consume_changed_leaves()
+        print('Link parsing complete!')
+        return
+
     # Example of how you might use these URLs in your scraping script
+    pool = get_pool(1, profile_prefix='links')
     all_product_urls = []
     for index, url in enumerate(urls_to_parse):
         print(f'Getting all links from category {index + 1}:')
-        parsed_url = get_all_category_page_urls(driver, url)
+        with pool.driver() as driver, metrics.stage('links'):
+            parsed_url = get_all_category_page_urls(driver, url)
         all_product_urls.extend(parsed_url)
 
     print("Writing all links to urls.txt:")
@@ -118,9 +264,10 @@ def main():
     #     for link in all_product_urls:
     #         file.write(link + "\n")
 
-    driver.quit()
+    close_pool()
+    consume_changed_leaves()
     print('Link parsing complete!')
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,6 +1,8 @@
+import metrics
 import productDetailsParser, linksParser
 
 def main():
+    metrics.start()
     linksParser.main()
     productDetailsParser.main()
 
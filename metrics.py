@@ -0,0 +1,275 @@
+""" Crawl metrics: counters, latency histograms and gauges per stage and per extractor.
+
+    fetch_seconds{stage}        page loads and HTTP requests, as reported to the scheduler
+    pacing_seconds{stage}       time spent waiting for the scheduler slot
+    stage_seconds{stage}        whole stage calls (a product card, the reviews of a product, a category)
+    extractor_seconds{name}     single extractors (ProductPage fields, review parsing, listing cards)
+    requests/captchas/http_errors/timeouts/errors_total{stage}, saved_total{kind}
+    browser_rss_mb{browser}, browser_restarts_total{reason}
+
+start() serves them on http://127.0.0.1:METRICS_PORT/metrics (Prometheus text) and /metrics.json
+and writes the same JSON to METRICS_FILE when the run ends. Stages listed in PROFILE_STAGES run
+under cProfile; the stats are dumped to PROFILE_DIR/<stage>-<pid>.prof (open with pstats or snakeviz).
+Parse worker processes (PARSE_PROCESSES=1) keep their own extractor timings, which are not collected.
+"""
+import atexit
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+import config
+
+# Upper bounds of the latency buckets, seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(BUCKETS) if value <= bound), len(BUCKETS))
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count else None,
+            'max': round(self.max, 6),
+            'buckets': {str(bound): count for bound, count in zip(BUCKETS + ('+Inf',), self.counts)},
+        }
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = datetime.now()
+        self._start = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, label=None, amount=1):
+        with self._lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + amount
+
+    def observe(self, name, label, seconds):
+        with self._lock:
+            histogram = self.histograms.get((name, label))
+            if histogram is None:
+                histogram = self.histograms[(name, label)] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, label, value):
+        with self._lock:
+            self.gauges[(name, label)] = value
+
+    def summary(self):
+        """ Everything collected so far as a JSON-ready dict: {metric: {label: value}}. """
+        def grouped(entries, convert):
+            result = {}
+            for (name, label), value in sorted(entries.items(), key=lambda entry: (entry[0][0], str(entry[0][1]))):
+                result.setdefault(name, {})[label or ''] = convert(value)
+            return result
+
+        with self._lock:
+            return {
+                'started_at': self.started_at.isoformat(timespec='seconds'),
+                'elapsed_seconds': round(time.monotonic() - self._start, 3),
+                'counters': grouped(self.counters, lambda value: value),
+                'histograms': grouped(self.histograms, Histogram.to_dict),
+                'gauges': grouped(self.gauges, lambda value: value),
+            }
+
+    def prometheus(self):
+        """ The metrics in the Prometheus text format. """
+        lines = []
+        with self._lock:
+            for (name, label), value in sorted(self.counters.items(), key=str):
+                lines.append(f"dns_{name}_total{_labels(name, label)} {value}")
+            for (name, label), value in sorted(self.gauges.items(), key=str):
+                lines.append(f"dns_{name}{_labels(name, label)} {value}")
+            for (name, label), histogram in sorted(self.histograms.items(), key=str):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f"dns_{name}_bucket{_labels(name, label, le=bound)} {cumulative}")
+                lines.append(f"dns_{name}_sum{_labels(name, label)} {histogram.sum}")
+                lines.append(f"dns_{name}_count{_labels(name, label)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+# Label name of each metric; the rest are labelled by stage
+LABEL_NAMES = {'extractor_seconds': 'name', 'saved': 'kind', 'browser_rss_mb': 'browser',
+               'browser_restarts': 'reason'}
+
+
+def _labels(name, label, **extra):
+    pairs = ([(LABEL_NAMES.get(name, 'stage'), label)] if label is not None else []) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{str(value)}"' for key, value in pairs) + '}'
+
+
+METRICS = Metrics()
+
+
+def inc(name, label=None, amount=1):
+    METRICS.inc(name, label, amount)
+
+
+def observe(name, label, seconds):
+    METRICS.observe(name, label, seconds)
+
+
+def gauge(name, label, value):
+    METRICS.gauge(name, label, value)
+
+
+def timed(name):
+    """ Decorator recording every call of an extractor in extractor_seconds{name}. """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                METRICS.observe('extractor_seconds', name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# Profiling
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+_active = threading.local()
+
+
+def _profiled_stages():
+    return {stage.strip() for stage in config.PROFILE_STAGES.split(',') if stage.strip()}
+
+
+@contextmanager
+def _profile(stage):
+    # Only one profiler can run in a thread, so a stage nested in a profiled one is part of its profile
+    if stage not in _profiled_stages() or getattr(_active, 'profiling', False):
+        yield
+        return
+
+    # One profiler per stage and thread, switched on for every call, so a long run doesn't pile them up
+    with _profiles_lock:
+        profile = _profiles.setdefault((stage, threading.get_ident()), cProfile.Profile())
+    _active.profiling = True
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _active.profiling = False
+
+
+def dump_profiles():
+    """ Merge the profiles of every stage and write them to PROFILE_DIR. Returns the files written. """
+    with _profiles_lock:
+        profiles = {}
+        for (stage, _), profile in _profiles.items():
+            profiles.setdefault(stage, []).append(profile)
+        _profiles.clear()
+
+    filenames = []
+    for stage, stage_profiles in profiles.items():
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        stats = pstats.Stats(stage_profiles[0])
+        for profile in stage_profiles[1:]:
+            stats.add(profile)
+        filename = os.path.join(config.PROFILE_DIR, f"{stage}-{os.getpid()}.prof")
+        stats.dump_stats(filename)
+        filenames.append(filename)
+        print(f"Profile of stage {stage} ({len(stage_profiles)} threads) saved to {filename}")
+    return filenames
+
+
+@contextmanager
+def stage(name):
+    """ Time a stage call, count its errors and profile it when the stage is in PROFILE_STAGES. """
+    start = time.perf_counter()
+    try:
+        with _profile(name):
+            yield
+    except Exception:
+        METRICS.inc('errors', name)
+        raise
+    finally:
+        METRICS.observe('stage_seconds', name, time.perf_counter() - start)
+
+
+# Reporting
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def write_summary(filename=None):
+    filename = filename or config.METRICS_FILE
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(METRICS.summary(), f, ensure_ascii=False, indent=2)
+    print(f"Run metrics saved to {filename}")
+
+
+def _finish():
+    dump_profiles()
+    if config.METRICS_FILE:
+        write_summary()
+
+
+def serve(port=None):
+    """ Serve the metrics from a background thread on localhost. """
+    from flask import Flask, Response, jsonify
+
+    app = Flask(__name__)
+    # Scrapers poll the endpoint; their requests would drown the crawl output
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    @app.route('/metrics')
+    def prometheus():
+        return Response(METRICS.prometheus(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/metrics.json')
+    def summary():
+        return jsonify(METRICS.summary())
+
+    port = port or config.METRICS_PORT
+    thread = threading.Thread(target=app.run, kwargs={'host': '127.0.0.1', 'port': port}, daemon=True)
+    thread.start()
+    print(f"Metrics on http://127.0.0.1:{port}/metrics")
+    return thread
+
+
+def start():
+    """ Start the metrics endpoint if METRICS_PORT is set and write the run summary at exit. Idempotent. """
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    if config.METRICS_PORT:
+        serve()
+    atexit.register(_finish)
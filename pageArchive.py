@@ -0,0 +1,298 @@
+""" Compressed archive of every fetched page, for re-parsing without re-crawling (ARCHIVE_PAGES=1).
+
+Usage:
+    py pageArchive.py reparse [out_dir] [before]    rebuild items and reviews from the archived pages
+    py pageArchive.py train                         (re)train the compression dictionaries
+    py pageArchive.py stats                         pages, objects and sizes per kind
+
+Pages are stored once per content under ARCHIVE_DIR/objects/<sha256[:2]>/<sha256>.zst and indexed
+in ARCHIVE_DIR/index.db by kind, URL and fetch time, so re-fetching an unchanged page costs an index
+row only. Product cards fetched over HTTP are kept as 'product_http', so reparse prefers the browser
+snapshot of a product. A characteristics page fetched for a card without them is indexed with its
+product URL and parsed with that card. DNS pages share most of their markup, so after ARCHIVE_TRAIN_AFTER pages of a kind a zstd
+dictionary is trained on them; later pages of that kind are compressed with it. Pages stored before
+keep their plain zstd frames, every object knows which dictionary it needs.
+"""
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from itertools import repeat
+
+import zstandard
+
+import config
+from jsonSink import compact, get_sink, close_sink
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dictionaries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    data BLOB NOT NULL,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS objects (
+    sha TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    dictionary_id INTEGER,
+    size INTEGER NOT NULL,
+    stored_size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    url TEXT NOT NULL,
+    product_url TEXT,
+    fetched_at TEXT NOT NULL,
+    sha TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_url ON pages (url, fetched_at);
+CREATE INDEX IF NOT EXISTS pages_kind ON pages (kind, fetched_at);
+"""
+
+
+class PageArchive:
+
+    def __init__(self, directory=None, level=None, train_after=None, dictionary_size=None):
+        self.directory = directory or config.ARCHIVE_DIR
+        self.level = level or config.ARCHIVE_LEVEL
+        self.train_after = train_after or config.ARCHIVE_TRAIN_AFTER
+        self.dictionary_size = dictionary_size or config.ARCHIVE_DICT_SIZE
+        os.makedirs(os.path.join(self.directory, 'objects'), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(self.directory, 'index.db'), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        self._dictionaries = {}
+        # zstd contexts are not thread-safe: one per thread and dictionary
+        self._contexts = threading.local()
+
+    def _path(self, sha):
+        return os.path.join(self.directory, 'objects', sha[:2], sha + '.zst')
+
+    # Dictionaries
+
+    def _dictionary(self, dictionary_id):
+        with self._lock:
+            if dictionary_id not in self._dictionaries:
+                row = self._conn.execute("SELECT data FROM dictionaries WHERE id = ?", (dictionary_id,)).fetchone()
+                self._dictionaries[dictionary_id] = zstandard.ZstdCompressionDict(row[0])
+            return self._dictionaries[dictionary_id]
+
+    def _current_dictionary(self, kind):
+        # Called under the lock
+        return self._conn.execute("SELECT MAX(id) FROM dictionaries WHERE kind = ?", (kind,)).fetchone()[0]
+
+    def _compressor(self, dictionary_id):
+        compressors = self._contexts.__dict__.setdefault('compressors', {})
+        if dictionary_id not in compressors:
+            dictionary = self._dictionary(dictionary_id) if dictionary_id else None
+            compressors[dictionary_id] = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+        return compressors[dictionary_id]
+
+    def _decompressor(self, dictionary_id):
+        decompressors = self._contexts.__dict__.setdefault('decompressors', {})
+        if dictionary_id not in decompressors:
+            dictionary = self._dictionary(dictionary_id) if dictionary_id else None
+            decompressors[dictionary_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        return decompressors[dictionary_id]
+
+    def train(self, kind, samples=None):
+        """ Train a dictionary for a kind on its latest pages. Returns its id, None with too few samples. """
+        with self._lock:
+            shas = [row[0] for row in self._conn.execute(
+                "SELECT sha FROM objects WHERE kind = ? ORDER BY rowid DESC LIMIT ?",
+                (kind, samples or self.train_after),
+            )]
+        if len(shas) < 10:
+            return None
+        try:
+            dictionary = zstandard.train_dictionary(self.dictionary_size, [self.get(sha) for sha in shas])
+        except zstandard.ZstdError as e:
+            print(f"Archive: no dictionary for {kind} pages: {e}")
+            return None
+        with self._lock, self._conn:
+            dictionary_id = self._conn.execute(
+                "INSERT INTO dictionaries (kind, data, created_at) VALUES (?, ?, ?)",
+                (kind, dictionary.as_bytes(), datetime.now().isoformat(timespec='seconds')),
+            ).lastrowid
+        print(f"Archive: trained a {len(dictionary.as_bytes()) // 1024} KB dictionary on {len(shas)} {kind} pages")
+        return dictionary_id
+
+    # Pages
+
+    def put(self, kind, url, html, product_url=None, fetched_at=None):
+        """ Archive a fetched page. Returns the sha256 of its content. """
+        data = html.encode('utf-8') if isinstance(html, str) else html
+        sha = hashlib.sha256(data).hexdigest()
+        fetched_at = fetched_at or datetime.now().isoformat(timespec='seconds')
+
+        with self._lock:
+            known = self._conn.execute("SELECT 1 FROM objects WHERE sha = ?", (sha,)).fetchone()
+            dictionary_id = None if known else self._current_dictionary(kind)
+        if not known:
+            compressed = self._compressor(dictionary_id).compress(data)
+            path = self._path(sha)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(compressed)
+            os.replace(tmp_path, path)
+
+        with self._lock, self._conn:
+            if not known:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO objects (sha, kind, dictionary_id, size, stored_size) VALUES (?, ?, ?, ?, ?)",
+                    (sha, kind, dictionary_id, len(data), len(compressed)),
+                )
+            self._conn.execute(
+                "INSERT INTO pages (kind, url, product_url, fetched_at, sha) VALUES (?, ?, ?, ?, ?)",
+                (kind, url, product_url, fetched_at, sha),
+            )
+            untrained = not known and dictionary_id is None and self._conn.execute(
+                "SELECT COUNT(*) FROM objects WHERE kind = ?", (kind,)).fetchone()[0] == self.train_after
+
+        if untrained:
+            self.train(kind)
+        return sha
+
+    def get(self, sha):
+        """ Raw bytes of an archived page. """
+        with self._lock:
+            dictionary_id = self._conn.execute(
+                "SELECT dictionary_id FROM objects WHERE sha = ?", (sha,)).fetchone()[0]
+        with open(self._path(sha), 'rb') as f:
+            return self._decompressor(dictionary_id).decompress(f.read())
+
+    def latest(self, kind, before=None):
+        """ (url, product_url, fetched_at, sha) of the newest snapshot of every URL of a kind,
+        fetched before the `before` ISO timestamp if given. """
+        with self._lock:
+            return self._conn.execute(
+                # Rows are added as pages are fetched, so the highest id of a URL is its newest snapshot
+                "SELECT url, product_url, fetched_at, sha FROM pages WHERE id IN ("
+                "SELECT MAX(id) FROM pages WHERE kind = ? AND fetched_at < ? GROUP BY url) ORDER BY id",
+                (kind, before or '9999'),
+            ).fetchall()
+
+    def history(self, url):
+        """ (fetched_at, sha) of every snapshot of a URL, oldest first. """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT fetched_at, sha FROM pages WHERE url = ? ORDER BY fetched_at, id", (url,)).fetchall()
+
+    def kinds(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT DISTINCT kind FROM objects ORDER BY kind")]
+
+    def stats(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT objects.kind, (SELECT COUNT(*) FROM pages WHERE pages.kind = objects.kind), COUNT(*), "
+                "SUM(size), SUM(stored_size) FROM objects GROUP BY objects.kind ORDER BY objects.kind"
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def get_archive():
+    """ Return the page archive shared by every stage of the process. """
+    global _archive
+    with _archive_lock:
+        if _archive is None:
+            _archive = PageArchive()
+        return _archive
+
+
+# Re-parsing
+
+def _pages(archive, snapshots):
+    for _, _, _, sha in snapshots:
+        yield archive.get(sha)
+
+
+def _characteristics_pages(archive, products, before=None):
+    # Cards fetched over HTTP without characteristics come with a separate characteristics page
+    shas = {product_url: sha for _, product_url, _, sha in archive.latest('characteristics', before)}
+    for url, *_ in products:
+        yield archive.get(shas[url]) if url in shas else None
+
+
+def reparse(out_dir=None, before=None, archive=None):
+    """ Rebuild items and reviews from the newest archived snapshot of every page, without fetching.
+    Writes <out_dir>/items.jsonl and reviews.jsonl with their JSON arrays. Returns (items, reviews). """
+    # Imported here: the parsers import pageRecorder, which hooks into this module
+    from parseEngine import ParseEngine
+    from productDetailsParser import parse_product_html, serializable_item
+    from reviewPage import parse_opinions
+
+    archive = archive or get_archive()
+    out_dir = out_dir or config.REPARSE_DIR
+    os.makedirs(out_dir, exist_ok=True)
+    items_file = os.path.join(out_dir, 'items.jsonl')
+    reviews_file = os.path.join(out_dir, 'reviews.jsonl')
+    for filename in (items_file, reviews_file):
+        close_sink(filename)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    # Pages go to the parse processes as the compressed store hands them out: bytes, in chunks
+    engine = ParseEngine(config.PARSE_WORKERS or os.cpu_count(), processes=True)
+    try:
+        # Browser snapshots have everything scripts load; a card only ever fetched over HTTP is parsed from that
+        products = archive.latest('product', before)
+        in_browser = {url for url, *_ in products}
+        products += [snapshot for snapshot in archive.latest('product_http', before) if snapshot[0] not in in_browser]
+        items = 0
+        sink = get_sink(items_file)
+        for item in engine.map(parse_product_html, _pages(archive, products), [url for url, *_ in products],
+                               repeat(None), _characteristics_pages(archive, products, before)):
+            if item and item.get('id'):
+                sink.write(serializable_item(item))
+                items += 1
+
+        review_pages = archive.latest('reviews', before)
+        seen = set()
+        sink = get_sink(reviews_file)
+        for (url, product_url, _, _), reviews in zip(review_pages, engine.map(parse_opinions,
+                                                                             _pages(archive, review_pages))):
+            for review in reviews:
+                if review['opinion_id'] not in seen:
+                    seen.add(review['opinion_id'])
+                    review['product_url'] = product_url or url
+                    sink.write(review)
+    finally:
+        engine.close()
+
+    compact(items_file, os.path.join(out_dir, 'items.json'))
+    compact(reviews_file, os.path.join(out_dir, 'reviews.json'))
+    print(f"Reparsed {items} products from {len(products)} pages and {len(seen)} reviews "
+          f"from {len(review_pages)} pages into {out_dir}")
+    return items, len(seen)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('reparse', 'train', 'stats'):
+        print(__doc__)
+        sys.exit(1)
+
+    page_archive = get_archive()
+    if sys.argv[1] == 'reparse':
+        reparse(*sys.argv[2:4], archive=page_archive)
+    elif sys.argv[1] == 'train':
+        for page_kind in page_archive.kinds():
+            page_archive.train(page_kind)
+    else:
+        for page_kind, pages, objects, size, stored_size in page_archive.stats():
+            print(f"{page_kind:<10} {pages:7d} pages  {objects:7d} objects  "
+                  f"{size / 1024 / 1024:9.1f} MB -> {stored_size / 1024 / 1024:7.1f} MB  x{size / stored_size:.1f}")
+    page_archive.close()
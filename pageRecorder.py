@@ -0,0 +1,63 @@
+import hashlib
+import os
+from datetime import datetime
+
+import config
+from jsonSink import get_sink, read_jsonl
+
+INDEX_FILE = 'index.jsonl'
+
+
+def recording():
+    """ Whether fetched pages are kept at all, so callers can skip taking a snapshot just for it. """
+    return config.RECORD_PAGES or config.ARCHIVE_PAGES
+
+
+def record_page(kind, url, html, product_url=None):
+    """ Save a fetched page to the compressed archive when ARCHIVE_PAGES is on
+    and as an offline fixture when RECORD_PAGES is on. """
+    if not html:
+        return None
+    if config.ARCHIVE_PAGES:
+        # Imported here: the archive is only needed when it is on
+        from pageArchive import get_archive
+        get_archive().put(kind, url, html, product_url)
+    if not config.RECORD_PAGES:
+        return None
+
+    directory = os.path.join(config.FIXTURES_DIR, kind)
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(kind, hashlib.sha1(url.encode('utf-8')).hexdigest()[:16] + '.html')
+
+    # Later snapshots of the same URL (e.g. after "Load More") replace the earlier one
+    with open(os.path.join(config.FIXTURES_DIR, filename), 'w', encoding='utf-8') as f:
+        f.write(html)
+    get_sink(os.path.join(config.FIXTURES_DIR, INDEX_FILE)).write({
+        'kind': kind,
+        'url': url,
+        'file': filename,
+        'recorded_at': datetime.now().isoformat(timespec='seconds'),
+    })
+    return filename
+
+
+def fixture_files(fixtures_dir=None, kind=None):
+    """ Return the recorded pages as (kind, url, path) without reading them, one per URL. """
+    fixtures_dir = fixtures_dir or config.FIXTURES_DIR
+    latest = {}
+    for entry in read_jsonl(os.path.join(fixtures_dir, INDEX_FILE)):
+        if kind is None or entry['kind'] == kind:
+            latest[(entry['kind'], entry['url'])] = entry['file']
+
+    return [(page_kind, url, os.path.join(fixtures_dir, filename)) for (page_kind, url), filename in latest.items()
+            if os.path.exists(os.path.join(fixtures_dir, filename))]
+
+
+def read_fixture(path, binary=False):
+    with open(path, 'rb') if binary else open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def load_fixtures(fixtures_dir=None, kind=None, binary=False):
+    """ Return recorded pages as (kind, url, html), one per URL; `binary` keeps the HTML as UTF-8 bytes. """
+    return [(page_kind, url, read_fixture(path, binary)) for page_kind, url, path in fixture_files(fixtures_dir, kind)]
@@ -0,0 +1,116 @@
+""" Parse workers for captured page snapshots.
+
+Browsers only navigate and take snapshots; the extractors run here, so one page is parsed while
+the browser already waits for the next one. Jobs wait in a queue of PARSE_QUEUE entries at most:
+a browser that captures faster than pages are parsed is held back instead of piling up HTML.
+With PARSE_WORKERS=0 every job runs at once in the calling thread, as before.
+
+lxml releases the GIL only in parts of the parse, so with PARSE_PROCESSES=1 the workers are
+processes and parsing uses every core. Jobs then must be module-level functions whose arguments
+and results pickle; pages travel as UTF-8 bytes, which lxml parses without decoding them first.
+The processes are started by a fork server (spawned on Windows), never forked from the crawler
+itself: a fork copies locks held by its browser and HTTP threads and the child can deadlock on them.
+"""
+import atexit
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+import config
+
+
+def _process_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _run_chunk(func, chunk):
+    # Runs in the worker: one round trip for the whole chunk
+    return [func(*args) for args in chunk]
+
+
+class ParseEngine:
+
+    def __init__(self, workers=None, queue_size=None, processes=None):
+        self.workers = config.PARSE_WORKERS if workers is None else workers
+        self.processes = config.PARSE_PROCESSES if processes is None else processes
+        self.queue_size = queue_size or config.PARSE_QUEUE
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        if not self.workers:
+            self._pool = None
+        elif self.processes:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=_process_context())
+        else:
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='parse')
+
+    def payload(self, html):
+        """ The form a page is best handed to a job in: bytes for worker processes, as is otherwise. """
+        if self.processes and self._pool is not None and isinstance(html, str):
+            return html.encode('utf-8')
+        return html
+
+    def submit(self, func, *args):
+        """ Queue a parse job and return its future; blocks while the queue is full. """
+        if self._pool is None:
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        self._slots.acquire()
+        future = self._pool.submit(func, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def map(self, func, *iterables, chunksize=None):
+        """ Like map(), in order, with the calls sent to the workers in chunks of `chunksize`.
+        At most PARSE_QUEUE chunks are in flight, so a long input is never read into memory at once. """
+        calls = zip(*iterables)
+        if self._pool is None:
+            for args in calls:
+                yield func(*args)
+            return
+
+        chunksize = chunksize or config.PARSE_CHUNK
+        pending = deque()
+        while True:
+            chunk = list(islice(calls, chunksize))
+            if chunk:
+                pending.append(self.submit(_run_chunk, func, chunk))
+            # Keep the workers busy, but hand results out as soon as the oldest chunk is done
+            while pending and (not chunk or len(pending) >= self.queue_size or pending[0].done()):
+                yield from pending.popleft().result()
+            if not chunk:
+                return
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """ Return the parse engine shared by every stage of the process. """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ParseEngine()
+        return _engine
+
+
+def close_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.close()
+            _engine = None
+
+
+atexit.register(close_engine)
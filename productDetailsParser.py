@@ -1,353 +1,445 @@
+import atexit
 import sys
-import json
-import scrapy
-import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
-from selenium import webdriver
 from selenium.common import TimeoutException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from random import randint
-from time import sleep as pause
-import undetected_chromedriver as uc
-from bs4 import BeautifulSoup
 from tqdm import tqdm
-from reviewParser import parse_reviews
+
+import config
+import metrics
+from browserSession import close_pool, get_pool, is_alive, open_page
+from crawlState import get_state
+from httpSession import create_session, fetch_html, is_product_page
+from jsonSink import compact, get_sink
+from linksParser import latest_listing
+from pageRecorder import record_page
+from parseEngine import get_engine
+from productPage import ProductPage, product_fingerprint
+from reviewApi import fetch_product_reviews
+from reviewParser import parse_product_reviews
+from sqliteStore import get_store
+
+# Comment requests of all workers in REVIEW_SOURCE=api mode, started with the first product that needs it
+_comments_pool = None
+_comments_pool_lock = threading.Lock()
+
+
+def get_comments_pool():
+    global _comments_pool
+    with _comments_pool_lock:
+        if _comments_pool is None:
+            _comments_pool = ThreadPoolExecutor(config.REVIEWS_API_WORKERS, thread_name_prefix='comments')
+        return _comments_pool
+
+
+@atexit.register
+def close_comments_pool():
+    global _comments_pool
+    with _comments_pool_lock:
+        if _comments_pool is not None:
+            _comments_pool.shutdown()
+            _comments_pool = None
 
 TEST_URL = "https://www.dns-shop.ru/product/a67afeaff7bbd9cb/robot-pylesos-dreame-x40-ultra-complete-belyj/"
 
-def save_to_json(data, filename="items.json"):
-    """Save data to JSON file."""
+def serializable_item(item):
+    """Drop values that can't or shouldn't be written to JSON."""
+    serializable = {}
+    for key, value in item.items():
+        # Пропускаем несериализуемые объекты
+        if not callable(value) and value is not None:
+            # Для списков проверяем вложенные элементы
+            if isinstance(value, list):
+                value = [subitem for subitem in value if not callable(subitem) and subitem is not None]
+            serializable[key] = value
+    return serializable
+
+
+def save_item(item, filename=None):
+    """Save one product: upsert it in SQLite with STORAGE=sqlite, otherwise append it to the items JSON Lines file."""
     try:
-        # Создаем копию данных для сериализации
-        serializable_data = []
-        for item in data:
-            serializable_item = {}
-            for key, value in item.items():
-                # Пропускаем несериализуемые объекты
-                if not callable(value) and value is not None:
-                    # Для списков проверяем вложенные элементы
-                    if isinstance(value, list):
-                        serializable_list = []
-                        for subitem in value:
-                            if not callable(subitem) and subitem is not None:
-                                serializable_list.append(subitem)
-                        serializable_item[key] = serializable_list
-                    else:
-                        serializable_item[key] = value
-            serializable_data.append(serializable_item)
-
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(serializable_data, f, ensure_ascii=False, indent=4)
-        print(f"Data successfully saved to {filename}")
+        if config.STORAGE == 'sqlite' and filename is None:
+            get_store().save_item(serializable_item(item))
+        else:
+            get_sink(filename or config.ITEMS_FILE).write(serializable_item(item))
     except Exception as e:
         print(f"Error saving data to JSON: {e}")
         # Для отладки можно вывести более подробную информацию
         import traceback
         traceback.print_exc()
 
-def clean_price(price_str):
-
-    if not price_str:
-        return None
-
-# Remove non-digit characters
-    cleaned_price = ''.join(char for char in price_str if char.isdigit())
-
-    try:
-        return int(cleaned_price)
-    except ValueError:
-        return None
-
-def parse_breadcrumbs(driver):
-    soup = BeautifulSoup(driver.page_source, 'lxml')
-
-    # Find the breadcrumb list
-    breadcrumb_list = soup.find('ol', class_='breadcrumb-list')
-
-    # If no breadcrumb list found, return empty list
-    if not breadcrumb_list:
-        return []
-
-    # Parse categories
-    categories = []
-    for item in breadcrumb_list.find_all('li', class_='breadcrumb-list__item'):
-        # Skip the last item (current page)
-        if 'breadcrumb_last' in item.get('class', []):
-            continue
-
-        # Find the link
-        link = item.find('a', class_='ui-link')
-        if link:
-            categories.append({
-                'url': f"https://www.dns-shop.ru{link.get('href', '')}",
-                'name': link.find('span').text.strip()
-            })
-
-    if len(categories) > 2:
-        categories = categories[1:-1]
-
-    return categories
-
-
-def parse_characteristics(driver):
-
+def scroll_to_characteristics(driver):
+    """Scroll to the characteristics block so the page renders it."""
     try:
         characteristics_element = WebDriverWait(driver, 10).until(
             EC.presence_of_element_located((By.CLASS_NAME, 'product-card__characteristics'))
         )
         driver.execute_script("arguments[0].scrollIntoView(true);", characteristics_element)
+        return True
     except Exception as e:
         print(f"Не удалось найти или прокрутить до 'product-characteristics-content': {e}")
-        return {}
-
-    soup = BeautifulSoup(driver.page_source, 'lxml')
-    characteristics = {}
+        return False
 
-    # Находим основной контейнер с характеристиками
-    content = soup.find('div', class_='product-characteristics-content')
-    if not content:
-        return characteristics
 
-    # Проходим по всем группам характеристик
-    groups = content.find_all('div', class_='product-characteristics__group')
-    for group in groups:
-        group_name = group.find('div', class_='product-characteristics__group-title').text.strip()
-        characteristics[group_name] = []
-
-        # Проходим по всем характеристикам в группе
-        items = group.find_all('li', class_='product-characteristics__spec')
-        for item in items:
-            title_element = item.find('span', class_='product-characteristics__spec-title-content')
-            value_element = item.find('div', class_='product-characteristics__spec-value')
-
-            if title_element and value_element:
-                title = title_element.text.strip()
-                value = value_element.text.strip()
-
-                # Удаляем лишние пробелы и переносы строк
-                title = ' '.join(title.split())
-                value = ' '.join(value.split())
-
-                characteristics[group_name].append({
-                    "title": title,
-                    "value": value
-                })
-
-    return characteristics
-
-
-def extract_images(driver, max_images=5):
-    """Extract images using Selenium"""
-    images = []
-
-    # Сначала найдем и кликнем на миниатюру
+def wait_for_gallery(driver):
+    """Wait until the image slider is rendered, so its thumbnails are in the page source."""
     try:
-        thumbnail = WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.CLASS_NAME, 'product-images-slider__img.tns-complete'))
-        )
-        thumbnail.click()
-
-        # Ждем появления просмотрщика изображений
         WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.CLASS_NAME, 'media-viewer-image__main'))
+            EC.presence_of_element_located((By.CLASS_NAME, 'product-images-slider__img'))
         )
-    except Exception as e:
-        print(f"Error clicking thumbnail: {e}")
-        return []
+        return True
+    except TimeoutException:
+        print("Image slider not found")
+        return False
 
-    while len(images) < max_images:  # Ограничиваем количество фотографий
-        # Get current page source and parse it
-        soup = BeautifulSoup(driver.page_source, 'html.parser')
 
-        # Проверяем наличие контейнера с классом media-viewer-image__main_with-desc
-        if soup.find('div', class_='media-viewer-image__main.media-viewer-image__main_with-desc'):
-            print("Found container with description, stopping parsing")
-            break
+@metrics.timed('extract_images')
+def extract_images(driver, max_images=None):
+    """Full-size image URLs of the open product page, read from the slider markup and JSON-LD."""
+    wait_for_gallery(driver)
+    return ProductPage(driver.page_source).images[:max_images or config.MAX_IMAGES]
 
-        # Find the main media viewer container
-        media_viewer = soup.find('div', class_='media-viewer-image__main')
 
-        if not media_viewer:
-            break
+def parse_product_html(html, url, images=None, characteristics_html=None):
+    """Build a product item from the page HTML, parsed only once."""
+    return _product_item(ProductPage(html, url), url, images, characteristics_html)
 
-        # Find the main image
-        main_img = media_viewer.find('img', class_='media-viewer-image__main-img')
-
-        if main_img and 'src' in main_img.attrs:
-            images.append(main_img['src'])
-            print(f"Found image {len(images)}/{max_images}")
-
-        if len(images) >= max_images:
-            break
-
-        try:
-            right_control = driver.find_element(By.CSS_SELECTOR,
-                                                'div.media-viewer-image__main > div.media-viewer-image__control_right')
-            right_control.click()
-            time.sleep(0.5)
 
-        except Exception as e:
-            print(f"Error clicking or finding next button: {e}")
-            break
+def _product_item(page, url, images=None, characteristics_html=None):
+    item = page.to_item(images, max_images=config.MAX_IMAGES)
 
-    return list(dict.fromkeys(images))
+    if not item['characteristics'] and characteristics_html:
+        item['characteristics'] = ProductPage(characteristics_html, url).characteristics
 
+    return item
 
-def parse_product_data(driver):
-    """Extract rating and review_count"""
-    soup = BeautifulSoup(driver.page_source, 'lxml')
 
-    # Находим JSON-LD скрипт
-    script = soup.find('script', type='application/ld+json')
-    if script:
-        try:
-            data = json.loads(script.string)
+def capture_product_page(driver, url):
+    """Open the product page and return its snapshot once the gallery and characteristics are rendered."""
+    if not open_page(driver, url, 'product', ready=(By.CLASS_NAME, 'product-card-top__code')):
+        raise RuntimeError(f"Captcha instead of the product page {url}")
 
-            rating = data.get('aggregateRating', {}).get('ratingValue')
-            review_count = data.get('aggregateRating', {}).get('reviewCount')
+    wait_for_gallery(driver)
+    scroll_to_characteristics(driver)
 
-            return {
-                "rating": float(rating) if rating else None,
-                "number_of_reviews": int(review_count) if review_count else None
-            }
-        except json.JSONDecodeError:
-            print("Ошибка при парсинге JSON-LD")
+    # Images come from the same snapshot as every other field
+    html = driver.page_source
+    record_page('product', url, html)
+    return html
 
-    return {
-        "rating": None,
-        "number_of_reviews": None
-    }
 
 def parse_characteristics_page(driver, url):
     """Parse product page details."""
-    driver.get(url)
-    pause(randint(10, 13))
+    return parse_product_html(capture_product_page(driver, url), url)
+
+
+def _browser(driver, pool):
+    # The worker's browser, or one leased from the pool just for this page
+    return nullcontext(driver) if driver is not None else pool.driver()
+
+
+def parse_characteristics_page_http(session, url, driver=None, pool=None):
+    """Parse product page details over plain HTTP, using the browser for prices and images missing in the markup.
+    Without a `driver`, a browser is leased from `pool` only when the page needs one.
+    Without either, a card whose prices are loaded by script is returned with no prices."""
+    html = fetch_html(session, url, stage='product')
+    # Kept apart from browser snapshots, which have the prices and images scripts load
+    record_page('product_http', url, html)
+    has_browser = driver is not None or pool is not None
+    if not html or not is_product_page(html):
+        if not has_browser:
+            return None
+        print(f"HTTP fetch failed for {url}, falling back to the browser")
+        with _browser(driver, pool) as browser:
+            return parse_characteristics_page(browser, url)
+
+    # Prices are filled in by a script on most cards; the browser snapshot has them, images included
+    page = ProductPage(html, url)
+    if page.price_discounted is None and has_browser:
+        with _browser(driver, pool) as browser:
+            return parse_characteristics_page(browser, url)
+
+    # Characteristics are rendered on the separate characteristics page when missing in the card
+    characteristics_html = None
+    if 'product-characteristics-content' not in html:
+        characteristics_url = url.rstrip('/') + '/characteristics/'
+        characteristics_html = fetch_html(session, characteristics_url, stage='product')
+        record_page('characteristics', characteristics_url, characteristics_html, product_url=url)
 
-    soup = BeautifulSoup(driver.page_source, 'lxml')
-    selector = scrapy.Selector(text=driver.page_source)
-
-    def logo():
-        json_ld_scripts = selector.xpath(
-            "//script[@type='application/ld+json' and contains(text(), 'Product')]/text()").getall()
-        brand_name = None
-        for script_text in json_ld_scripts:
-            try:
-                json_data = json.loads(script_text)
-                if 'brand' in json_data and isinstance(json_data['brand'], dict):
-                    brand_name = json_data['brand'].get('name')
-                    break
-            except json.JSONDecodeError:
-                continue
-        return brand_name
-
-    def safe_text(soup, tag, class_=None, attribute=None):
-        element = soup.find(tag, class_=class_)
-        return element.get(attribute).strip() if element and attribute else element.text.strip() if element else None
-
-    def safe_list(soup, tag, class_=None, attribute=None):
-        elements = soup.find_all(tag, class_=class_)
-        return [element.get(attribute).strip() if attribute else element.text.strip() for element in elements if element]
-
-    # Extract functions
-    categories = parse_breadcrumbs(driver)
-    images = extract_images(driver)
-    characteristics = parse_characteristics(driver)
-    product_data = parse_product_data(driver)
-
-    # Extract product details
-    item = {
-        "id": selector.xpath("//div[@class='product-card-top__code']/text()").get(),
-        "url": url,
-        "categories": categories,
-        "images": images,
-        "name": safe_text(soup, 'div', class_="product-card-top__name"),
-        "price_discounted": clean_price(selector.xpath("//div[contains(@class, 'product-buy__price_active')]/text()").get()) or 0,
-        "price_original": clean_price(selector.xpath("//span[@class='product-buy__prev']/text()").get()) or
-                          clean_price(selector.xpath("//div[@class='product-buy__price']/text()").get()),
-        "rating": product_data['rating'],
-        "number_of_reviews": product_data['number_of_reviews'],
-        "brand_name": logo(),
-        "description": safe_text(soup, 'div', class_="product-card-description-text"),
-        "characteristics": characteristics,
-        "drivers": safe_list(soup, 'a', class_="product-card-description-drivers__item-link", attribute='href'),
-    }
+    images = []
+    if has_browser and config.BROWSER_IMAGES and 'product-images-slider__img' not in html:
+        with _browser(driver, pool) as browser:
+            if open_page(browser, url, 'product', ready=(By.CLASS_NAME, 'product-card-top__code')):
+                images = extract_images(browser)
+
+    return _product_item(page, url, images, characteristics_html)
+
+
+def parse_product(driver, url, session=None, product=True, reviews=True):
+    """Parse product card and all reviews for a single URL. A refresh passes which of the two to do."""
+    item = parsing = None
+    if product:
+        with metrics.stage('product'):
+            if config.FETCH_MODE == 'http':
+                # Without a browser of its own, the card leases one only for a fallback or images
+                item = parse_characteristics_page_http(session, url, driver, get_pool() if driver is None else None)
+            else:
+                # The card is parsed by the parse engine while the browser goes on to the reviews
+                engine = get_engine()
+                parsing = engine.submit(parse_product_html, engine.payload(capture_product_page(driver, url)), url)
+
+    if not reviews:
+        return parsing.result() if parsing else item
 
-    return item
+    try:
+        with metrics.stage('reviews'):
+            if config.REVIEW_SOURCE == 'api':
+                fetch_product_reviews(session, url, get_comments_pool())
+            else:
+                parse_product_reviews(driver, url)
+    except Exception as e:
+        # A dead browser is handled by the worker, which restarts it and retries the URL
+        if driver is not None and not is_alive(driver):
+            raise
+        print(f"An error occurred: {e}")
+        import traceback
+        traceback.print_exc()
 
-def main():
-    driver = uc.Chrome()
+    return parsing.result() if parsing else item
 
-    # Read URLs from file
-    with open('urls.txt', 'r') as file:
-        urls = list(map(lambda line: line.strip(), file.readlines()))
 
-    parsed_data = []
-    for url in tqdm(urls, ncols=70, unit='товар', colour='blue', file=sys.stdout):
+def _parse_with_retries(worker_id, pool, url, session, plan):
+    """Parse one URL, restarting the browser after a crash. Returns the item or None."""
+    # HTTP cards with API or no reviews need a browser only for a fallback or images, leased on demand
+    lazy = config.FETCH_MODE == 'http' and (config.REVIEW_SOURCE == 'api' or not plan[1])
+    for attempt in range(config.MAX_RETRIES + 1):
+        driver = None
+        if not lazy:
+            try:
+                driver = pool.lease()
+            except Exception as e:
+                # Chrome didn't start; the next attempt leases (and starts) it again
+                print(f"Worker {worker_id}: no browser for {url} (attempt {attempt + 1}): {e}")
+                continue
         try:
-            parsed_data.append(parse_characteristics_page(driver, url))
-            save_to_json(parsed_data)
+            return parse_product(driver, url, session, *plan)
+        except Exception as e:
+            if driver is None or is_alive(driver):
+                print(f"Error parsing {url}: {e}")
+                return None
+            # The pool restarts the crashed browser before leasing it again
+            print(f"Worker {worker_id}: browser failed on {url} (attempt {attempt + 1}): {e}")
+        finally:
+            if driver is not None:
+                pool.release(driver)
+    return None
+
+
+def _worker(worker_id, tasks, results, plans):
+    """Take URLs from the shared queue until the end marker, with a browser leased from the pool per URL.
+    Every URL taken gets a result and the worker always posts its end marker, so the consumer never waits forever."""
+    pool = get_pool()
+    session = create_session() if config.FETCH_MODE == 'http' or config.REVIEW_SOURCE == 'api' else None
 
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, url = task
 
+            item = None
             try:
-                driver.get(url)
-                pause(randint(1, 2))  # Random pause to simulate human behavior
-
-                # Find and extract the reviews page URL
-                rating_link = WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located(
-                        (By.XPATH, '//a[contains(@class, "product-card-top__rating_exists")]'))
-                )
-                reviews_url = rating_link.get_attribute("href")
-                print(f"Reviews URL: {reviews_url}")
-
-                # Navigate directly to reviews page
-                driver.get(reviews_url)
-                pause(randint(1, 2))  # Wait for the reviews page to load
-
-                all_reviews = parse_reviews(driver)
-
-                # Click "Load More" button to get additional reviews
-                while True:
-                    try:
-
-                        load_more_button = WebDriverWait(driver, 5).until(
-                            EC.element_to_be_clickable((By.XPATH,
-                                                        '//button[contains(@class, "button-ui_lg") and contains(@class, "paginator-widget__more")]'))
-                        )
-                        load_more_button.click()
-                        pause(randint(2, 4))  # Wait for new reviews to load
-
-                        parse_reviews(driver)
-
-                    except TimeoutException:
-                        # No more "Load More" button, exit the loop
-                        break
-
-                # Save reviews to JSON
-                save_to_json(all_reviews)
-                print(f'Total reviews parsed: {len(all_reviews)}')
-
+                item = _parse_with_retries(worker_id, pool, url, session, plans.get(url, (True, True)))
             except Exception as e:
-                print(f"An error occurred: {e}")
-                import traceback
-                traceback.print_exc()
+                print(f"Worker {worker_id}: {url} failed: {e}")
             finally:
-                # Ensure driver is closed properly
-                if driver:
-                    try:
-                        driver.quit()
-                    except Exception as quit_error:
-                        print(f"Error closing driver: {quit_error}")
-
-
+                results.put((index, url, item))
+    finally:
+        # The end marker goes first: nothing that fails after it can stall the consumer
+        results.put(None)
+        if session is not None:
+            session.close()
+
+
+def read_urls(filename='urls.txt'):
+    """URL source: stream product links from the file, skipping products finished by a previous run."""
+    state = get_state()
+    with open(filename, 'r') as file:
+        for line in file:
+            url = line.strip()
+            if url and not state.is_product_done(url):
+                yield url
+
+
+def fetch_products(urls, workers=1, plans=None, buffer_size=None):
+    """Fetch and parse stage: parse URLs on `workers` browsers and yield (url, item) in input order.
+    At most `buffer_size` URLs are taken from `urls` ahead of the consumer, so memory stays flat."""
+    plans = plans or {}
+    tasks = queue.Queue()
+    results = queue.Queue()
+    slots = threading.Semaphore(max(buffer_size or config.PIPELINE_BUFFER, workers))
+
+    # An error of the URL source (a missing urls.txt, a broken queue) is raised to the consumer
+    feed_errors = []
+    # Set when every worker is gone, so the feeder stops waiting for a free slot
+    stopped = threading.Event()
+
+    def feed():
+        try:
+            for task in enumerate(urls):
+                slots.acquire()
+                if stopped.is_set():
+                    break
+                tasks.put(task)
         except Exception as e:
-                print(f"Error parsing #url: {e}")
-
-    # Save parsed data
-    driver.quit()
+            feed_errors.append(e)
+        finally:
+            for _ in range(workers):
+                tasks.put(None)
+
+    threads = [threading.Thread(target=feed, daemon=True)] + [
+        threading.Thread(target=_worker, args=(worker_id, tasks, results, plans), daemon=True)
+        for worker_id in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Workers finish out of order, so results wait here until all previous URLs are done
+    pending = {}
+    next_index = 0
+    running = workers
+    while running:
+        result = results.get()
+        if result is None:
+            running -= 1
+            continue
+        index, url, item = result
+        pending[index] = (url, item)
+        while next_index in pending:
+            yield pending.pop(next_index)
+            next_index += 1
+            slots.release()
+
+    stopped.set()
+    slots.release()
+    for thread in threads:
+        thread.join()
+    if feed_errors:
+        raise feed_errors[0]
+    if pending or not tasks.empty():
+        # Only workers killed by something other than an Exception leave URLs behind
+        print(f"Warning: all workers stopped, {len(pending)} parsed products after a gap and "
+              f"the URLs still queued are not saved; the next run picks them up")
+
+
+def normalize_items(results):
+    """Normalize stage: drop values that can't be written to JSON."""
+    for url, item in results:
+        yield url, serializable_item(item) if item else None
+
+
+def save_products(results, plans=None):
+    """Sink stage: save items, their fingerprints and the product statuses. Returns the number of saved items."""
+    plans = plans or {}
+    state = get_state()
+    saved = 0
+    for url, item in results:
+        if item:
+            save_item(item)
+            saved += 1
+            metrics.inc('saved', 'product')
+            if item.get('id'):
+                state.save_fingerprint(item['id'], url, product_fingerprint(item), item.get('number_of_reviews'))
+        # A reviews-only refresh has no item to save
+        reviews_only = not plans.get(url, (True, True))[0]
+        state.set_product_status(url, 'done' if item or reviews_only else 'failed')
+    return saved
+
+
+def run_worker_pool(urls, workers=1, plans=None):
+    """Run the product pipeline: URLs -> fetch and parse -> normalize -> sink, saving items in urls.txt order.
+    `plans` maps a URL to (parse product, harvest reviews); by default both are done."""
+    results = normalize_items(fetch_products(urls, workers, plans))
+    return save_products(tqdm(results, ncols=70, unit='товар', colour='blue', file=sys.stdout), plans)
+
+
+def refresh_check(url, record):
+    """Compare the listing record of a product with its fingerprint.
+    Returns (parse product again, harvest reviews again)."""
+    if record is None or not record.get('id') or record.get('price_discounted') is None:
+        # Not in the listing, or listed without prices (LINKS_MODE=async): can't tell what changed
+        return True, True
+
+    state = get_state()
+    stored = state.fingerprint(record['id'])
+    if stored is None:
+        return True, True
+    stored_hash, stored_reviews = stored
+
+    reviews_grew = (record.get('number_of_reviews') or 0) > (stored_reviews or 0)
+    if reviews_grew:
+        # New opinions come first, so walk the reviews from the start; known ones are skipped by id
+        state.save_review_cursor(url, 0)
+    # Same hash with the old review count means only reviews changed
+    changed = product_fingerprint(record, number_of_reviews=stored_reviews) != stored_hash
+    if reviews_grew and not changed:
+        state.save_fingerprint(record['id'], url, product_fingerprint(record), record.get('number_of_reviews'))
+    return changed, not state.review_cursor(url)[2]
+
+
+def refresh_plans(urls, listing=None):
+    """Check every product against the listing records of the last link crawl, without a request per product.
+    Returns {url: (parse product, harvest reviews)} for the products with something to do."""
+    if listing is None:
+        listing = latest_listing()
+    if not listing:
+        print(f"No listing records in {config.LISTING_FILE}: run linksParser with REFRESH=1 first. "
+              f"Every product is parsed again.")
+
+    plans = {}
+    for url in urls:
+        plan = refresh_check(url, listing.get(url))
+        if any(plan):
+            plans[url] = plan
+    return plans
+
+
+def main(workers=None):
+    workers = workers or config.WORKERS
+    # The parse engine is set up before the metrics and browser threads start
+    get_engine()
+    metrics.start()
+
+    plans = None
+    if config.REFRESH:
+        # Deep-parse only changed products and harvest reviews only where they were added
+        with open('urls.txt', 'r') as file:
+            urls = list(dict.fromkeys(line.strip() for line in file if line.strip()))
+        plans = refresh_plans(urls)
+        urls = [url for url in urls if url in plans]
+        print(f'{sum(plan[0] for plan in plans.values())} products changed, '
+              f'{sum(plan[1] for plan in plans.values())} have new reviews.')
+    else:
+        # Links are streamed from urls.txt, skipping products finished by a previous run
+        urls = read_urls()
+
+    # One pooled browser per worker; Chrome starts on its first lease, which HTTP cards may never need
+    get_pool(workers)
+    run_worker_pool(urls, workers, plans)
+    close_pool()
+    close_comments_pool()
+
+    if config.COMPACT_OUTPUT and config.STORAGE == 'jsonl':
+        compact(config.ITEMS_FILE, config.ITEMS_JSON)
+        compact(config.REVIEWS_FILE, config.REVIEWS_JSON)
     print('Product parsing complete!')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import re
+import threading
+from functools import cached_property
+
+from lxml import html as lxml_html
+
+from metrics import timed
+
+BASE_URL = 'https://www.dns-shop.ru'
+
+# lxml parsers are not shared between threads; one UTF-8 parser per thread
+_parsers = threading.local()
+
+
+def has_class(name):
+    """ XPath condition matching one class token, like BeautifulSoup's class_= search. """
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+@timed('lxml_parse')
+def parse_document(html):
+    """ lxml tree of a page given as str or as UTF-8 bytes, which libxml2 would otherwise have to guess. """
+    if not isinstance(html, bytes):
+        return lxml_html.document_fromstring(html)
+    if not hasattr(_parsers, 'utf8'):
+        _parsers.utf8 = lxml_html.HTMLParser(encoding='utf-8')
+    return lxml_html.document_fromstring(html, parser=_parsers.utf8)
+
+
+def clean_price(price_str):
+
+    if not price_str:
+        return None
+
+# Remove non-digit characters
+    cleaned_price = ''.join(char for char in price_str if char.isdigit())
+
+    try:
+        return int(cleaned_price)
+    except ValueError:
+        return None
+
+
+def product_fingerprint(item, number_of_reviews=None):
+    """ Hash of the fields a re-crawl looks at: prices, rating and review count.
+    These are the fields a catalog listing card shows, so a product item and the listing record of the
+    same product state (linksParser.parse_listing_cards) hash the same. Characteristics are not on the cards.
+    Pass `number_of_reviews` to hash the item as if it had that many reviews. """
+    if number_of_reviews is None:
+        number_of_reviews = item.get('number_of_reviews')
+    # Without a discount a product card has no discounted price and a listing card repeats the current one
+    price = item.get('price_discounted') or item.get('price_original')
+    # The product page and the listing card may round the rating differently
+    rating = round(item['rating'], 1) if item.get('rating') is not None else None
+    fields = [price, item.get('price_original'), rating, number_of_reviews]
+    return hashlib.sha1(json.dumps(fields, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def full_size_image(url):
+    """ Viewer-size URL of a gallery thumbnail: .../fit/200/200/... -> .../fit/wm/0/0/... """
+    return re.sub(r'/(?:fit|crop)/(?:wm/)?\d+/\d+/', '/fit/wm/0/0/', url, count=1)
+
+
+def _image_key(url):
+    """ Thumbnails and JSON-LD links of one photo differ only in the size part; the last two segments match. """
+    return tuple(url.split('?')[0].rsplit('/', 2)[-2:])
+
+
+def _text(element):
+    return element.text_content().strip() if element is not None else None
+
+
+class ProductPage:
+    """ Product page snapshot parsed once with lxml. Every field is read from the same tree and cached. """
+
+    def __init__(self, html, url=None):
+        self.html = html
+        self.url = url
+        self.tree = parse_document(html)
+
+    def _first(self, xpath, node=None):
+        found = (node if node is not None else self.tree).xpath(xpath)
+        return found[0] if found else None
+
+    @cached_property
+    @timed('ProductPage.json_ld')
+    def json_ld(self):
+        """ All JSON-LD blocks of the page. """
+        blocks = []
+        for script_text in self.tree.xpath("//script[@type='application/ld+json']/text()"):
+            try:
+                blocks.append(json.loads(script_text))
+            except json.JSONDecodeError:
+                print("Ошибка при парсинге JSON-LD")
+        return [block for block in blocks if isinstance(block, dict)]
+
+    @cached_property
+    def id(self):
+        return self._first("//div[@class='product-card-top__code']/text()")
+
+    @cached_property
+    @timed('ProductPage.images')
+    def images(self):
+        """ Full-size gallery URLs from the slider thumbnails, then from JSON-LD, without duplicates. """
+        slider = self.tree.xpath(f"//img[{has_class('product-images-slider__img')}]")
+        urls = [full_size_image(img.get('data-src') or img.get('src')) for img in slider
+                if img.get('data-src') or img.get('src')]
+        for block in self.json_ld:
+            image = block.get('image')
+            urls += [image] if isinstance(image, str) else [url for url in image or [] if isinstance(url, str)]
+
+        images = {}
+        for url in urls:
+            images.setdefault(_image_key(url), url)
+        return list(images.values())
+
+    @cached_property
+    def name(self):
+        return _text(self._first(f"//div[{has_class('product-card-top__name')}]"))
+
+    @cached_property
+    def price_discounted(self):
+        # None when the price block is empty: a script fills it in after the page loads
+        return clean_price(self._first("//div[contains(@class, 'product-buy__price_active')]/text()"))
+
+    @cached_property
+    def price_original(self):
+        return (clean_price(self._first("//span[@class='product-buy__prev']/text()")) or
+                clean_price(self._first("//div[@class='product-buy__price']/text()")))
+
+    @cached_property
+    def _aggregate_rating(self):
+        for block in self.json_ld:
+            if isinstance(block.get('aggregateRating'), dict):
+                return block['aggregateRating']
+        return {}
+
+    @cached_property
+    def rating(self):
+        rating = self._aggregate_rating.get('ratingValue')
+        return float(rating) if rating else None
+
+    @cached_property
+    def number_of_reviews(self):
+        review_count = self._aggregate_rating.get('reviewCount')
+        return int(review_count) if review_count else None
+
+    @cached_property
+    def brand_name(self):
+        for block in self.json_ld:
+            if isinstance(block.get('brand'), dict):
+                return block['brand'].get('name')
+        return None
+
+    @cached_property
+    @timed('ProductPage.description')
+    def description(self):
+        return _text(self._first(f"//div[{has_class('product-card-description-text')}]"))
+
+    @cached_property
+    @timed('ProductPage.drivers')
+    def drivers(self):
+        links = self.tree.xpath(f"//a[{has_class('product-card-description-drivers__item-link')}]/@href")
+        return [link.strip() for link in links]
+
+    @cached_property
+    @timed('ProductPage.categories')
+    def categories(self):
+        """ Breadcrumbs without the site root and the product category itself. """
+        categories = []
+        items = self.tree.xpath(
+            f"//ol[{has_class('breadcrumb-list')}]//li[{has_class('breadcrumb-list__item')}]"
+        )
+        for item in items:
+            # Skip the last item (current page)
+            if 'breadcrumb_last' in item.get('class', '').split():
+                continue
+
+            link = self._first(f".//a[{has_class('ui-link')}]", item)
+            if link is not None:
+                categories.append({
+                    'url': f"{BASE_URL}{link.get('href', '')}",
+                    'name': _text(self._first('.//span', link)),
+                })
+
+        if len(categories) > 2:
+            categories = categories[1:-1]
+
+        return categories
+
+    @cached_property
+    @timed('parse_characteristics')
+    def characteristics(self):
+        characteristics = {}
+
+        # Находим основной контейнер с характеристиками
+        content = self._first(f"//div[{has_class('product-characteristics-content')}]")
+        if content is None:
+            return characteristics
+
+        # Проходим по всем группам характеристик
+        for group in content.xpath(f".//div[{has_class('product-characteristics__group')}]"):
+            group_name = _text(self._first(f".//div[{has_class('product-characteristics__group-title')}]", group))
+            characteristics[group_name] = []
+
+            for spec in group.xpath(f".//li[{has_class('product-characteristics__spec')}]"):
+                title = _text(self._first(f".//span[{has_class('product-characteristics__spec-title-content')}]", spec))
+                value = _text(self._first(f".//div[{has_class('product-characteristics__spec-value')}]", spec))
+
+                if title is not None and value is not None:
+                    # Удаляем лишние пробелы и переносы строк
+                    characteristics[group_name].append({
+                        "title": ' '.join(title.split()),
+                        "value": ' '.join(value.split())
+                    })
+
+        return characteristics
+
+    def to_item(self, images=None, max_images=None):
+        return {
+            "id": self.id,
+            "url": self.url,
+            "categories": self.categories,
+            "images": images or self.images[:max_images],
+            "name": self.name,
+            "price_discounted": self.price_discounted,
+            "price_original": self.price_original,
+            "rating": self.rating,
+            "number_of_reviews": self.number_of_reviews,
+            "brand_name": self.brand_name,
+            "description": self.description,
+            "characteristics": self.characteristics,
+            "drivers": self.drivers,
+        }
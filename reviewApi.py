@@ -0,0 +1,168 @@
+""" Review harvesting through the XHR endpoints the reviews widget calls, without a browser.
+
+Records have the same schema as reviewParser.parse_reviews. If DNS changes the widget,
+take the current endpoints from the browser's network tab and set REVIEWS_API_URL / COMMENTS_API_URL.
+"""
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from lxml import html as lxml_html
+from tqdm import tqdm
+
+import config
+import metrics
+from crawlState import get_state
+from httpSession import create_session
+from reviewPage import OPINION_XPATH, parse_comment_nodes, parse_opinion
+from reviewParser import known_opinion_ids, save_reviews
+from scheduler import SCHEDULER, is_blocked
+
+XHR_HEADERS = {
+    "x-requested-with": "XMLHttpRequest",
+    "accept": "application/json, text/html, */*",
+}
+
+
+def product_code(product_url):
+    """ Short product code from a URL like /product/a67afeaff7bbd9cb/slug/. """
+    match = re.search(r'/product/([0-9a-f]+)/', product_url)
+    return match.group(1) if match else None
+
+
+def _find_html(payload):
+    """ Widget endpoints wrap the rendered markup in JSON, usually under data.html. """
+    if isinstance(payload, str):
+        return payload
+    if isinstance(payload, dict):
+        for key in ('html', 'content', 'data'):
+            if key in payload:
+                found = _find_html(payload[key])
+                if found is not None:
+                    return found
+    return None
+
+
+def _get_html(session, url, referer):
+    SCHEDULER.wait('reviews_api')
+    start = time.monotonic()
+    try:
+        response = session.get(url, headers={**XHR_HEADERS, "referer": referer}, timeout=config.HTTP_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Ошибка запроса {url}: {e}")
+        SCHEDULER.record('reviews_api', time.monotonic() - start, status=None)
+        return None
+
+    SCHEDULER.record('reviews_api', time.monotonic() - start, response.status_code,
+                     blocked=is_blocked(response.text, response.status_code))
+    if response.status_code != 200:
+        print(f"Ошибка получения {url}: {response.status_code}")
+        return None
+
+    try:
+        return _find_html(response.json()) or ''
+    except ValueError:
+        return response.text
+
+
+def comment_count(node):
+    """ Number from the "N комментариев" link under an opinion, 0 when there are none. """
+    label = node.xpath(".//div[@data-role='opinion-comments']//a/span")
+    match = re.search(r"\d+", label[0].text_content()) if label else None
+    return int(match.group()) if match else 0
+
+
+def fetch_comments(session, opinion_id, referer):
+    html = _get_html(session, config.COMMENTS_API_URL.format(opinion_id=opinion_id), referer)
+    if not html:
+        return []
+    return parse_comment_nodes(lxml_html.fragment_fromstring(html, create_parent='div'))
+
+
+def fetch_opinions_page(session, product_url, page):
+    """ Return [(review, comment count)] for one page of opinions, or None on a failed request. """
+    url = config.REVIEWS_API_URL.format(product_code=product_code(product_url), page=page)
+    html = _get_html(session, url, product_url)
+    if html is None:
+        return None
+    if not html.strip():
+        return []
+
+    opinions = []
+    for node in lxml_html.fragment_fromstring(html, create_parent='div').xpath('.' + OPINION_XPATH):
+        try:
+            opinions.append((parse_opinion(node), comment_count(node)))
+        except Exception as e:
+            print(f"Error parsing review: {e}")
+    return opinions
+
+
+def fetch_product_reviews(session, product_url, comments_pool):
+    """ Page through the opinions of one product and save the new ones. Returns how many were saved. """
+    state = get_state()
+    pages, last_opinion_id, done = state.review_cursor(product_url)
+    if done:
+        return 0
+
+    # Cursor pages count "Load More" clicks, so API page N follows N - 1 loaded pages
+    page = pages + 1
+    total = 0
+    previous_ids = None
+    while True:
+        opinions = fetch_opinions_page(session, product_url, page)
+        if opinions is None:
+            # Leave the cursor unfinished so the next run retries from this page
+            return total
+
+        ids = [review['opinion_id'] for review, _ in opinions]
+        if not opinions or ids == previous_ids:
+            break
+        previous_ids = ids
+
+        known = known_opinion_ids(config.REVIEWS_FILE)
+        new = [(review, count) for review, count in opinions if review['opinion_id'] not in known]
+        comments = {
+            review['opinion_id']: comments_pool.submit(fetch_comments, session, review['opinion_id'], product_url)
+            for review, count in new if count
+        }
+        for review, _ in new:
+            if review['opinion_id'] in comments:
+                review['comments'] = comments[review['opinion_id']].result()
+
+        saved = save_reviews([review for review, _ in new], product_url)
+        total += len(saved)
+        last_opinion_id = saved[-1]['opinion_id'] if saved else last_opinion_id
+        state.save_review_cursor(product_url, page - 1, last_opinion_id)
+        page += 1
+
+    state.save_review_cursor(product_url, page - 1, last_opinion_id, done=True)
+    return total
+
+
+def _fetch_product_reviews_safe(session, product_url, comments_pool):
+    try:
+        with metrics.stage('reviews'):
+            return fetch_product_reviews(session, product_url, comments_pool)
+    except Exception as e:
+        print(f"Error fetching reviews for {product_url}: {e}")
+        return 0
+
+
+def harvest_reviews(product_urls, workers=None):
+    """ Fetch reviews of many products at once, with at most `workers` products in flight. """
+    workers = workers or config.REVIEWS_API_WORKERS
+    session = create_session(pool_size=workers * 2)
+
+    total = 0
+    with ThreadPoolExecutor(workers) as products_pool, ThreadPoolExecutor(workers) as comments_pool:
+        results = products_pool.map(
+            lambda url: _fetch_product_reviews_safe(session, url, comments_pool), product_urls
+        )
+        for saved in tqdm(results, total=len(product_urls), ncols=70, unit='товар', colour='blue', file=sys.stdout):
+            total += saved
+
+    session.close()
+    print(f'Total new reviews parsed: {total}')
+    return total
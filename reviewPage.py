@@ -0,0 +1,173 @@
+import re
+from datetime import datetime
+
+from lxml import html as lxml_html
+
+from metrics import timed
+from productPage import has_class, parse_document
+
+OPINION_XPATH = f"//div[{has_class('ow-opinion')} and {has_class('ow-opinions__item')}]"
+
+OPINION_ID_RE = re.compile(r'<[^>]*?\bdata-opinion-id="([^"]*)"')
+
+TEXT_FIELDS = {
+    'Достоинства': 'advantages',
+    'Недостатки': 'disadvantages',
+    'Комментарий': 'comment',
+}
+
+
+def convert_date(raw_date):
+    date_iso = datetime.strptime(raw_date, "%d.%m.%Y").strftime("%Y-%m-%d")
+    return date_iso
+
+
+def convert_full_date(date_string):
+    """ Convert Russian full date to a custom datetime format. """
+    month_map = {
+        'января': '01', 'февраля': '02', 'марта': '03', 'апреля': '04',
+        'мая': '05', 'июня': '06', 'июля': '07', 'августа': '08',
+        'сентября': '09', 'октября': '10', 'ноября': '11', 'декабря': '12'
+    }
+
+    try:
+        match = re.match(r'(\d{1,2})\s+(\w+)\s+(\d{4})\s+г\.\s+(\d{1,2}):(\d{2})', date_string)
+        if match:
+            day, month_name, year, hour, minute = match.groups()
+
+            month = month_map.get(month_name, '01')
+
+            return f"{year}-{day.zfill(2)}-{month} {hour.zfill(2)}:{minute}"
+
+        return date_string
+
+    except Exception as e:
+        print(f"Error converting date: {e}")
+        return date_string
+
+
+def _text(node, xpath):
+    """ Whitespace-normalised text of the first match, like WebElement.text. """
+    found = node.xpath(xpath)
+    return ' '.join(found[0].text_content().split()) if found else None
+
+
+def _int(text):
+    return int(text) if text and text.strip().lstrip('-').isdigit() else 0
+
+
+def parse_opinion_ratings(node):
+    ratings = {}
+    for tab in node.xpath('.//div[contains(@class, "opinion-rating-slider__tab")]'):
+        try:
+            category_name = _text(tab, './/span[contains(@class, "opinion-rating-slider__tab-title_name")]').rstrip(': ')
+            rating_value = _text(tab, './/span')
+
+            # Общая оценка показана звёздами
+            if category_name == 'Общая':
+                rating_value = (len(tab.xpath('.//span[@data-state="selected"]')) or
+                                len(tab.xpath('.//div[@data-state="selected"]')))
+
+            ratings[category_name] = int(rating_value)
+        except Exception as e:
+            print(f"Error parsing rating tab: {e}")
+    return ratings
+
+
+def parse_product_details(node):
+    additions = {}
+    for tab in node.xpath('.//div[contains(@class, "opinion-multicard-slider__tab")]'):
+        tab_text = ' '.join(tab.text_content().split())
+        if ':' in tab_text:
+            category, value = tab_text.split(':', 1)
+            additions[category.strip()] = value.strip()
+    return additions
+
+
+def parse_opinion_texts(node):
+    texts = {}
+    for section in node.xpath('.//div[contains(@class, "ow-opinion__text")]'):
+        title = _text(section, ".//div[@class='ow-opinion__text-title']")
+        paragraphs = section.xpath(".//div[@class='ow-opinion__text-desc']/p")
+        if title in TEXT_FIELDS and paragraphs:
+            # Combine all paragraphs into a single string
+            texts[TEXT_FIELDS[title]] = ' '.join(' '.join(p.text_content().split()) for p in paragraphs)
+    return texts
+
+
+def extract_media_urls(node):
+    return node.xpath('.//div[contains(@class, "ow-photos-and-videos")]'
+                      '//a[contains(@class, "ow-photos__link")]'
+                      '//img[contains(@class, "ow-photos__image")]/@data-src')
+
+
+@timed('parse_comments')
+def parse_comment_nodes(node):
+    """ Parse already expanded comments of an opinion. """
+    parsed_comments = []
+    for comment in node.xpath(f".//div[{has_class('comment')}]"):
+        content = comment.xpath(f".//*[{has_class('comment__content')}]")
+        if not content:
+            continue
+        content = content[0]
+        parsed_comments.append({
+            'username': _text(content, f".//*[{has_class('profile-info__name')}]"),
+            'date': convert_full_date(
+                _text(content, f".//span[{has_class('comment__date')} or {has_class('time-info')}]")),
+            'comment_text': _text(content, f".//div[{has_class('comment__message')} or {has_class('message')}]"),
+            'likes': _int(_text(content, f".//span[{has_class('vote-widget__sum')}]")),
+        })
+    return parsed_comments
+
+
+@timed('parse_opinion')
+def parse_opinion(node):
+    """ Build a review record (same schema as reviewParser.parse_reviews) from an opinion node. """
+    texts = parse_opinion_texts(node)
+    return {
+        'opinion_id': node.get('data-opinion-id'),
+        'username': _text(node, './/div[contains(@class, "profile-info__name")]'),
+        'date': convert_date(_text(node, './/span[contains(@class, "ow-opinion__date")]')),
+        'rating': parse_opinion_ratings(node),
+        'additions': parse_product_details(node),
+        'advantages': texts.get('advantages'),
+        'disadvantages': texts.get('disadvantages'),
+        'comment': texts.get('comment'),
+        'media': extract_media_urls(node),
+        'likes': _int(_text(node, './/span[contains(@class, "vote-widget__sum")]')),
+        'comments': parse_comment_nodes(node),
+    }
+
+
+def parse_opinions(html, skip_ids=()):
+    """ Parse every opinion in a page snapshot, skipping known opinion ids. """
+    tree = parse_document(html)
+    reviews = []
+    for node in tree.xpath(OPINION_XPATH):
+        if node.get('data-opinion-id') in skip_ids:
+            continue
+        try:
+            reviews.append(parse_opinion(node))
+        except Exception as e:
+            print(f"Error parsing review: {e}")
+    return reviews
+
+
+def fragment_opinion_id(fragment):
+    """ opinion_id of an outerHTML fragment, read from its opening tag without parsing it. """
+    match = OPINION_ID_RE.match(fragment)
+    return match.group(1) if match else None
+
+
+def parse_opinion_fragments(fragments, skip_ids=()):
+    """ Parse opinions given as separate outerHTML fragments, skipping known opinion ids. """
+    reviews = []
+    for fragment in fragments:
+        node = lxml_html.fragment_fromstring(fragment)
+        if node.get('data-opinion-id') in skip_ids:
+            continue
+        try:
+            reviews.append(parse_opinion(node))
+        except Exception as e:
+            print(f"Error parsing review: {e}")
+    return reviews
@@ -1,12 +1,9 @@
-import os
-import json
 import sys
-from datetime import datetime
 import re
+import threading
 
-import undetected_chromedriver as uc
-from random import randint
-from time import sleep as pause
+import time
+from concurrent.futures import Future
 
 from bs4 import BeautifulSoup
 from selenium.webdriver.common.by import By
@@ -15,6 +12,48 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, NoSuchElementException
 from tqdm import tqdm
 
+import config
+import metrics
+from browserSession import close_pool, get_pool, open_page
+from crawlState import get_state
+from jsonSink import compact, get_sink, import_legacy_json, read_jsonl
+from pageRecorder import record_page, recording
+from parseEngine import get_engine
+from reviewPage import convert_date, convert_full_date, fragment_opinion_id, parse_opinion_fragments
+from scheduler import SCHEDULER
+from sqliteStore import get_store
+
+# Opinion ids already saved, per output file; read from disk once per process
+_known_opinion_ids = {}
+_reviews_file_lock = threading.Lock()
+
+OPINIONS_SELECTOR = 'div.ow-opinion.ow-opinions__item'
+
+# Opens comments of the opinions from the given DOM position on, in one round trip
+EXPAND_COMMENTS_JS = """
+const opinions = Array.from(document.querySelectorAll(arguments[0])).slice(arguments[1]);
+let clicked = 0;
+for (const opinion of opinions) {
+    const link = opinion.querySelector("div[data-role='opinion-comments'] a");
+    const label = link && link.querySelector('span');
+    if (label && /\\d/.test(label.textContent)) {
+        link.click();
+        clicked++;
+    }
+}
+return clicked;
+"""
+
+# Number of opinions from the given DOM position on whose comments are shown
+LOADED_COMMENTS_JS = """
+return Array.from(document.querySelectorAll(arguments[0])).slice(arguments[1])
+    .filter(opinion => opinion.querySelector('div.comment')).length;
+"""
+
+# Markup of the opinions from the given DOM position on
+OPINIONS_HTML_JS = """
+return Array.from(document.querySelectorAll(arguments[0])).slice(arguments[1]).map(opinion => opinion.outerHTML);
+"""
 
 def _safe_element_text(element, by, selector):
     """Safely extract text from an element using various locators."""
@@ -24,10 +63,6 @@ def _safe_element_text(element, by, selector):
     except (NoSuchElementException, AttributeError):
         return None
 
-def convert_date(raw_date):
-    date_iso = datetime.strptime(raw_date, "%d.%m.%Y").strftime("%Y-%m-%d")
-    return date_iso
-
 def parse_product_details(driver, review_element):
     """Parse additional product details (color, size, etc.) from a specific review element."""
     additions = {}
@@ -107,27 +142,6 @@ def parse_review_photos(review_elem):
 
     return photo_urls
 
-def load_existing_reviews(filename):
-    if os.path.exists(filename):
-        try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                if content:
-                    return json.loads(content)
-                else:
-                    print(f"Warning: {filename} is empty. Starting with an empty list.")
-                    return []
-        except json.JSONDecodeError:
-            print(f"Warning: {filename} contains invalid JSON. Starting with an empty list.")
-            return []
-    else:
-        print(f"Info: {filename} does not exist. Starting with an empty list.")
-        return []
-
-def save_to_json(data, filename):
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-
 def load_comments(driver, opinion_id):
     tag = driver.find_element(
         By.XPATH,
@@ -141,8 +155,15 @@ def load_comments(driver, opinion_id):
     if not matches:
         return False
     driver.execute_script("arguments[0].scrollIntoView();", tag)
+    SCHEDULER.wait('reviews')
+    start = time.monotonic()
     driver.execute_script("arguments[0].click();", tag)
-    pause(randint(1, 2))
+    try:
+        WebDriverWait(driver, 5).until(lambda d: d.find_elements(
+            By.XPATH, f"//div[@data-opinion-id='{opinion_id}']//div[contains(@class, 'comment__content')]"))
+    except TimeoutException:
+        pass
+    SCHEDULER.record('reviews', time.monotonic() - start)
     return True
 
 
@@ -158,6 +179,7 @@ def get_review_container(driver, opinion_id):
     return review_container
 
 
+@metrics.timed('parse_comments')
 def parse_comments(driver, opinion_id):
     """Parse comments from the comments list section."""
     review_container = get_review_container(driver, opinion_id)
@@ -208,30 +230,6 @@ def parse_comments(driver, opinion_id):
     return parsed_comments
 
 
-def convert_full_date(date_string):
-    """ Convert Russian full date to a custom datetime format. """
-    month_map = {
-        'января': '01', 'февраля': '02', 'марта': '03', 'апреля': '04',
-        'мая': '05', 'июня': '06', 'июля': '07', 'августа': '08',
-        'сентября': '09', 'октября': '10', 'ноября': '11', 'декабря': '12'
-    }
-
-    try:
-        match = re.match(r'(\d{1,2})\s+(\w+)\s+(\d{4})\s+г\.\s+(\d{1,2}):(\d{2})', date_string)
-        if match:
-            day, month_name, year, hour, minute = match.groups()
-
-            month = month_map.get(month_name, '01')
-
-            return f"{year}-{day.zfill(2)}-{month} {hour.zfill(2)}:{minute}"
-
-        return date_string
-
-    except Exception as e:
-        print(f"Error converting date: {e}")
-        return date_string
-
-
 def extract_media_urls(review_elem):
     """ Extract media URLs from image elements with class 'ow-photos__image loaded' """
     try:
@@ -251,14 +249,120 @@ def extract_media_urls(review_elem):
         print(f"Error extracting media URLs: {e}")
         return []
 
-def parse_reviews(driver, json_filename="reviews.json", existing_reviews=None):
-    """Parse reviews from the current page."""
-    all_reviews = load_existing_reviews(json_filename)
-    existing_opinion_ids = {review.get('opinion_id') for review in all_reviews if review.get('opinion_id')}
+def _use_store(json_filename):
+    return config.STORAGE == 'sqlite' and json_filename == config.REVIEWS_FILE
+
+
+def known_opinion_ids(json_filename):
+    """Ids of reviews already in the output file, kept in memory after the first read.
+    With STORAGE=sqlite the ids are looked up in the database instead."""
+    if _use_store(json_filename):
+        return get_store().opinion_ids
+    with _reviews_file_lock:
+        if json_filename not in _known_opinion_ids:
+            # Reviews saved by runs before the JSON Lines sink are only in reviews.json
+            import_legacy_json(json_filename)
+            _known_opinion_ids[json_filename] = {
+                review.get('opinion_id') for review in read_jsonl(json_filename) if review.get('opinion_id')
+            }
+        return _known_opinion_ids[json_filename]
+
+
+def parse_reviews(driver, json_filename=None, start=0, product_url=None):
+    """Parse reviews loaded on the current page, beginning with the opinion at DOM position `start`.
+    Returns the newly saved reviews and the position to continue from after the next "Load More"."""
+    json_filename = json_filename or config.REVIEWS_FILE
+    existing_opinion_ids = known_opinion_ids(json_filename)
+
+    if config.REVIEW_MODE == 'snapshot':
+        parsed, next_start = parse_reviews_snapshot(driver, existing_opinion_ids, start)
+    else:
+        parsed, next_start = parse_reviews_webdriver(driver, existing_opinion_ids, start)
+
+    if recording():
+        record_page('reviews', driver.current_url, driver.page_source, product_url)
+
+    return save_reviews(parsed, product_url, json_filename), next_start
+
+
+def save_reviews(parsed, product_url=None, json_filename=None):
+    """Write reviews that are not in the output file yet. Returns the ones written."""
+    json_filename = json_filename or config.REVIEWS_FILE
+    existing_opinion_ids = known_opinion_ids(json_filename)
+
+    if _use_store(json_filename):
+        store = get_store()
+        new_reviews = []
+        for review_data in parsed:
+            review_data['product_url'] = product_url
+            if store.save_review(review_data):
+                new_reviews.append(review_data)
+                print(f"Added new review with ID {review_data['opinion_id']} to {store.filename}")
+        metrics.inc('saved', 'reviews', len(new_reviews))
+        return new_reviews
+
+    new_reviews = []
+    with _reviews_file_lock:
+        for review_data in parsed:
+            opinion_id = review_data['opinion_id']
+            if opinion_id not in existing_opinion_ids:
+                review_data['product_url'] = product_url
+                existing_opinion_ids.add(opinion_id)
+                get_sink(json_filename).write(review_data)
+                new_reviews.append(review_data)
+                print(f"Added new review with ID {opinion_id} to {json_filename}")
+
+    metrics.inc('saved', 'reviews', len(new_reviews))
+    return new_reviews
+
+
+def capture_opinions(driver, start=0):
+    """Expand comments of the opinions appended since `start` and return their markup with the next position."""
+    expanded = driver.execute_script(EXPAND_COMMENTS_JS, OPINIONS_SELECTOR, start)
+    if expanded:
+        # Wait until every expanded opinion shows its comments
+        begin = time.monotonic()
+        try:
+            WebDriverWait(driver, 5).until(
+                lambda d: d.execute_script(LOADED_COMMENTS_JS, OPINIONS_SELECTOR, start) >= expanded)
+        except TimeoutException:
+            pass
+        SCHEDULER.record('reviews', time.monotonic() - begin)
+    fragments = driver.execute_script(OPINIONS_HTML_JS, OPINIONS_SELECTOR, start) or []
+    return fragments, start + len(fragments)
+
+
+def parse_reviews_snapshot(driver, skip_ids=(), start=0):
+    """Parse the opinions appended since `start` from their markup, without per-element WebDriver calls."""
+    fragments, next_start = capture_opinions(driver, start)
+    return parse_opinion_fragments(fragments, skip_ids), next_start
+
+
+def submit_reviews(driver, start, product_url):
+    """Capture the opinions appended since `start` and hand the unknown ones to the parse engine.
+    Returns the future of the parsed reviews and the position to continue from."""
+    existing_opinion_ids = known_opinion_ids(config.REVIEWS_FILE)
+    if config.REVIEW_MODE != 'snapshot':
+        # Element-by-element parsing needs the live page, so it can't be deferred
+        parsed, next_start = parse_reviews_webdriver(driver, existing_opinion_ids, start)
+        future = Future()
+        future.set_result(parsed)
+    else:
+        fragments, next_start = capture_opinions(driver, start)
+        # Known opinions are dropped here, so neither they nor the id set travel to the parse workers
+        fragments = [fragment for fragment in fragments if fragment_opinion_id(fragment) not in existing_opinion_ids]
+        future = get_engine().submit(parse_opinion_fragments, fragments)
+    return future, next_start
+
+
+def parse_reviews_webdriver(driver, existing_opinion_ids=(), start=0):
+    """Parse reviews element by element through WebDriver."""
+    new_reviews = []
+    review_elements = []
     try:
         review_elements = driver.find_elements(By.XPATH, "//div[contains(@class, 'ow-opinion  ow-opinions__item')]")
 
-        for review_elem in review_elements:
+        for review_elem in review_elements[start:]:
             try:
                 opinion_id = review_elem.get_attribute('data-opinion-id')
 
@@ -306,88 +410,134 @@ def parse_reviews(driver, json_filename="reviews.json", existing_reviews=None):
                     'comments': parse_comments(driver, opinion_id)
                 }
                 print(review_data)
-
-                if opinion_id not in existing_opinion_ids:
-                    all_reviews.append(review_data)
-                    existing_opinion_ids.add(opinion_id)
-                    save_to_json(all_reviews, json_filename)
-                    print(f"Added new review with ID {opinion_id} to {json_filename}")
+                new_reviews.append(review_data)
             except Exception as e:
                 print(f"Error parsing review: {e}")
 
     except Exception as e:
         print(f"Error in parse_reviews: {e}")
 
-    return all_reviews
+    return new_reviews, max(start, len(review_elements))
 
 def parse_urls_from_file(urls="urls.txt"):
     with open(urls, 'r') as file:
         return [line.strip() for line in file.readlines() if line.strip()]
 
-def main():
-
-    # Set up the webdriver with additional options for stability
-    options = uc.ChromeOptions()
-    options.add_argument('--no-sandbox')
-    options.add_argument('--disable-dev-shm-usage')
-
-    driver = None
-    with open('urls.txt','r') as text:
-        urls = [line.strip() for line in text.readlines() if line.strip()]
-        for url in tqdm(urls, ncols=70, unit='товар', colour='blue', file=sys.stdout):
-            try:
-                driver = uc.Chrome(options=options)
-                driver.get(url)
-                pause(randint(1, 2))  # Random pause to simulate human behavior
+def click_load_more(driver, wait_for_reviews=True):
+    """Click "Load More" under the reviews. Returns False when there is nothing left to load."""
+    try:
+        load_more_button = WebDriverWait(driver, 5).until(
+            EC.element_to_be_clickable((By.XPATH,
+                                        '//button[contains(@class, "button-ui_lg") and contains(@class, "paginator-widget__more")]'))
+        )
+    except TimeoutException:
+        # No more "Load More" button
+        return False
 
-                # Find and extract the reviews page URL
-                rating_link = WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.XPATH, '//a[contains(@class, "product-card-top__rating_exists")]'))
-                )
-                reviews_url = rating_link.get_attribute("href")
-                print(f"Reviews URL: {reviews_url}")
+    SCHEDULER.wait('reviews')
+    start = time.monotonic()
+    loaded = len(driver.find_elements(By.CSS_SELECTOR, OPINIONS_SELECTOR))
+    load_more_button.click()
+    if wait_for_reviews:
+        # Wait for new reviews to be appended
+        try:
+            WebDriverWait(driver, 10).until(
+                lambda d: len(d.find_elements(By.CSS_SELECTOR, OPINIONS_SELECTOR)) > loaded)
+        except TimeoutException:
+            pass
+    SCHEDULER.record('reviews', time.monotonic() - start)
+    return True
 
 
+def parse_product_reviews(driver, url):
+    """Open the reviews page of a product and parse all its reviews."""
+    state = get_state()
+    pages, last_opinion_id, done = state.review_cursor(url)
+    if done:
+        print(f"Reviews already parsed for {url}, skipping.")
+        return 0
 
-                # Navigate directly to reviews page
-                driver.get(reviews_url)
-                pause(randint(1, 2))  # Wait for the reviews page to load
+    if not open_page(driver, url, 'reviews'):
+        raise RuntimeError(f"Captcha instead of the product page {url}")
 
-                all_reviews = parse_reviews(driver)
+    # Find and extract the reviews page URL
+    try:
+        rating_link = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.XPATH, '//a[contains(@class, "product-card-top__rating_exists")]'))
+        )
+    except TimeoutException:
+        print(f"No reviews for {url}")
+        state.save_review_cursor(url, 0, done=True)
+        return 0
+    reviews_url = rating_link.get_attribute("href")
+    print(f"Reviews URL: {reviews_url}")
+
+    # Navigate directly to reviews page
+    if not open_page(driver, reviews_url, 'reviews', ready=(By.CSS_SELECTOR, OPINIONS_SELECTOR)):
+        raise RuntimeError(f"Captcha instead of the reviews page {reviews_url}")
+
+    # Reopen the pages an interrupted run already went through, without parsing each of them
+    loaded = 0
+    while loaded < pages and click_load_more(driver, wait_for_reviews=False):
+        loaded += 1
+
+    # Known opinions are skipped by id, after that only the newly appended ones are parsed.
+    # Each batch is parsed while the browser loads the next one
+    total = 0
+    batch, position = submit_reviews(driver, 0, url)
+    while True:
+        more = click_load_more(driver)
+        new_reviews = save_reviews(batch.result(), url)
+        total += len(new_reviews)
+        last_opinion_id = new_reviews[-1]['opinion_id'] if new_reviews else last_opinion_id
+        state.save_review_cursor(url, loaded, last_opinion_id)
+        if not more:
+            break
+        loaded += 1
+        batch, position = submit_reviews(driver, position, url)
+
+    # One snapshot with every loaded opinion instead of a growing copy per "Load More"
+    if recording():
+        record_page('reviews', driver.current_url, driver.page_source, url)
+
+    state.save_review_cursor(url, loaded, last_opinion_id, done=True)
+    print(f'Total new reviews parsed: {total}')
+    return total
+
+
+def parse_reviews_with_browser(urls):
+    """Harvest reviews by opening every product in Chrome, reusing a pooled browser."""
+    pool = get_pool(1, profile_prefix='reviews')
+    for url in tqdm(urls, ncols=70, unit='товар', colour='blue', file=sys.stdout):
+        try:
+            with pool.driver() as driver, metrics.stage('reviews'):
+                parse_product_reviews(driver, url)
 
-                # Click "Load More" button to get additional reviews
-                while True:
-                    try:
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            import traceback
+            traceback.print_exc()
 
-                        load_more_button = WebDriverWait(driver, 5).until(
-                            EC.element_to_be_clickable((By.XPATH,
-                                                        '//button[contains(@class, "button-ui_lg") and contains(@class, "paginator-widget__more")]'))
-                        )
-                        load_more_button.click()
-                        pause(randint(2, 4))  # Wait for new reviews to load
 
-                        parse_reviews(driver)
+def main():
+    metrics.start()
+    urls = parse_urls_from_file()
 
-                    except TimeoutException:
-                        # No more "Load More" button, exit the loop
-                        break
+    # Skip products whose reviews were harvested by a previous run
+    state = get_state()
+    urls = [url for url in urls if not state.review_cursor(url)[2]]
 
-                # Save reviews to JSON
-                save_to_json(all_reviews)
-                print(f'Total reviews parsed: {len(all_reviews)}')
+    if config.REVIEW_SOURCE == 'api':
+        # Imported here: reviewApi builds on this module
+        from reviewApi import harvest_reviews
+        harvest_reviews(urls)
+    else:
+        parse_reviews_with_browser(urls)
+        close_pool()
 
-            except Exception as e:
-                print(f"An error occurred: {e}")
-                import traceback
-                traceback.print_exc()
-            finally:
-                # Ensure driver is closed properly
-                if driver:
-                    try:
-                        driver.quit()
-                    except Exception as quit_error:
-                        print(f"Error closing driver: {quit_error}")
+    if config.COMPACT_OUTPUT and config.STORAGE == 'jsonl':
+        compact(config.REVIEWS_FILE, config.REVIEWS_JSON)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,106 @@
+""" Adaptive request pacing shared by all crawl stages.
+
+Every stage waits here before a request and reports how it went afterwards. The delay between
+requests of a stage shrinks step by step while the site answers quickly (additive decrease),
+grows by a step on slow answers and is multiplied on 403/429 or captcha pages (multiplicative
+increase), always within the stage's budget (config.STAGE_BUDGETS).
+
+The delay is one per stage, but with PACING=worker every worker thread keeps its own spacing, so
+WORKERS threads make up to WORKERS requests per delay. A block pauses every worker of the stage.
+PACING=stage spaces all requests of a stage by the delay, a cap that doesn't grow with WORKERS.
+"""
+import random
+import re
+import threading
+import time
+
+import config
+import metrics
+
+BLOCK_STATUSES = (403, 429)
+CAPTCHA_MARKERS = ('captcha', 'qrator', 'Проверка браузера', 'Подтвердите, что вы не робот')
+
+
+def is_blocked(html=None, status=None):
+    """ Check for an anti-bot answer: 403/429 or a captcha page (or its title) instead of content. """
+    if status in BLOCK_STATUSES:
+        return True
+    if not html:
+        return False
+    # Anti-bot stubs are small; a real page may mention a captcha in its scripts, so only its title counts
+    if len(html) > 20000:
+        title = re.search(r'<title[^>]*>(.*?)</title>', html, re.S | re.I)
+        html = title.group(1) if title else ''
+    return any(marker.lower() in html.lower() for marker in CAPTCHA_MARKERS)
+
+
+class StageBudget:
+
+    def __init__(self, min_delay, max_delay, start_delay, step, target_latency):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = start_delay
+        self.step = step
+        self.target_latency = target_latency
+        # Next free request slot per pacing lane: a worker thread, or None for the whole stage
+        self.next_slots = {}
+        self.paused_until = 0.0
+
+
+class AdaptiveScheduler:
+
+    def __init__(self, budgets=None, backoff=None, pacing=None):
+        self.budgets = {
+            stage: StageBudget(*limits) for stage, limits in (budgets or config.STAGE_BUDGETS).items()
+        }
+        self.backoff = backoff or config.DELAY_BACKOFF
+        self.per_worker = (pacing or config.PACING) == 'worker'
+        self._lock = threading.Lock()
+
+    def _budget(self, stage):
+        if stage not in self.budgets:
+            self.budgets[stage] = StageBudget(*config.STAGE_BUDGETS['default'])
+        return self.budgets[stage]
+
+    def reserve(self, stage):
+        """ Book the next request slot of a stage and return how many seconds to wait for it. """
+        with self._lock:
+            budget = self._budget(stage)
+            now = time.monotonic()
+            lane = threading.get_ident() if self.per_worker else None
+            # Jitter keeps the requests from looking machine-timed
+            slot = max(now, budget.next_slots.get(lane, 0.0), budget.paused_until)
+            budget.next_slots[lane] = slot + budget.delay * random.uniform(0.8, 1.2)
+            return slot - now
+
+    def wait(self, stage):
+        seconds = self.reserve(stage)
+        metrics.observe('pacing_seconds', stage, max(seconds, 0))
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def record(self, stage, latency, status=200, blocked=False):
+        """ Adjust the stage delay after a request. """
+        metrics.inc('requests', stage)
+        metrics.observe('fetch_seconds', stage, latency)
+        if blocked:
+            metrics.inc('captchas', stage)
+        if status and status >= 400:
+            metrics.inc('http_errors', stage)
+        with self._lock:
+            budget = self._budget(stage)
+            if blocked or status in BLOCK_STATUSES:
+                budget.delay = min(budget.max_delay, max(budget.delay, budget.step) * self.backoff)
+                # Give the site a break before the next request of this stage, from any worker
+                budget.paused_until = max(budget.paused_until, time.monotonic() + budget.delay)
+                print(f"[{stage}] blocked (status {status}), delay raised to {budget.delay:.1f}s")
+            elif latency > budget.target_latency:
+                budget.delay = min(budget.max_delay, budget.delay + budget.step)
+            else:
+                budget.delay = max(budget.min_delay, budget.delay - budget.step)
+
+    def delay(self, stage):
+        return self._budget(stage).delay
+
+
+SCHEDULER = AdaptiveScheduler()
@@ -0,0 +1,194 @@
+""" SQLite storage for products, categories, reviews and comments (STORAGE=sqlite).
+
+Rows are upserted by product id and opinion_id, so a product or review parsed twice stays one row.
+Every record is also kept whole in the `data` column in the same shape as the JSON Lines output.
+"""
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+import config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    category TEXT,
+    name TEXT,
+    brand_name TEXT,
+    price_discounted INTEGER,
+    price_original INTEGER,
+    rating REAL,
+    number_of_reviews INTEGER,
+    data TEXT NOT NULL,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS products_url ON products (url);
+CREATE INDEX IF NOT EXISTS products_category ON products (category);
+
+CREATE TABLE IF NOT EXISTS categories (
+    name TEXT PRIMARY KEY,
+    parent TEXT
+);
+
+CREATE TABLE IF NOT EXISTS reviews (
+    opinion_id TEXT PRIMARY KEY,
+    product_url TEXT,
+    product_id TEXT,
+    category TEXT,
+    username TEXT,
+    date TEXT,
+    likes INTEGER,
+    data TEXT NOT NULL,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS reviews_product_id ON reviews (product_id);
+CREATE INDEX IF NOT EXISTS reviews_product_url ON reviews (product_url);
+CREATE INDEX IF NOT EXISTS reviews_category ON reviews (category);
+
+CREATE TABLE IF NOT EXISTS comments (
+    opinion_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    username TEXT,
+    date TEXT,
+    comment_text TEXT,
+    likes INTEGER,
+    PRIMARY KEY (opinion_id, position)
+);
+"""
+
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+class OpinionIds:
+    """ Set-like view of saved opinion ids that asks the database instead of holding them in memory. """
+
+    def __init__(self, store):
+        self._store = store
+
+    def __contains__(self, opinion_id):
+        return self._store.has_opinion(opinion_id)
+
+    def add(self, opinion_id):
+        # The row itself is written by save_review
+        pass
+
+
+class SqliteStore:
+
+    def __init__(self, filename=None):
+        self.filename = filename or config.STORAGE_DB
+        # Queue workers write to one file; a writer waits for the other instead of failing after 5 s
+        self._conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        self.opinion_ids = OpinionIds(self)
+
+    def _execute(self, sql, params=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).fetchall()
+
+    # Products
+
+    def save_item(self, item):
+        # Breadcrumbs are {url, name} dicts; the tables keep category names
+        categories = [category['name'] for category in item.get('categories') or []]
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO products (id, url, category, name, brand_name, price_discounted, price_original, "
+                "rating, number_of_reviews, data, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET url = excluded.url, category = excluded.category, "
+                "name = excluded.name, brand_name = excluded.brand_name, "
+                "price_discounted = excluded.price_discounted, price_original = excluded.price_original, "
+                "rating = excluded.rating, number_of_reviews = excluded.number_of_reviews, "
+                "data = excluded.data, updated_at = excluded.updated_at",
+                (item.get('id') or item.get('url'), item.get('url'), categories[-1] if categories else None,
+                 item.get('name'), item.get('brand_name'), item.get('price_discounted'), item.get('price_original'),
+                 item.get('rating'), item.get('number_of_reviews'), json.dumps(item, ensure_ascii=False), _now()),
+            )
+            # Reviews are often saved before their product; link them now
+            self._conn.execute(
+                "UPDATE reviews SET product_id = ?, category = ? WHERE product_url = ? AND product_id IS NULL",
+                (item.get('id'), categories[-1] if categories else None, item.get('url')),
+            )
+            # Breadcrumbs give the category tree: every category with its parent
+            for parent, name in zip([None] + categories[:-1], categories):
+                self._conn.execute(
+                    "INSERT INTO categories (name, parent) VALUES (?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET parent = excluded.parent",
+                    (name, parent),
+                )
+
+    def product_by_url(self, url):
+        """ Return (product id, category) of a saved product, or (None, None). """
+        rows = self._execute("SELECT id, category FROM products WHERE url = ?", (url,))
+        return rows[0] if rows else (None, None)
+
+    # Reviews
+
+    def has_opinion(self, opinion_id):
+        return bool(self._execute("SELECT 1 FROM reviews WHERE opinion_id = ?", (opinion_id,)))
+
+    def save_review(self, review):
+        """ Upsert a review with its comments. Returns True if the opinion was not saved before. """
+        product_id, category = self.product_by_url(review.get('product_url'))
+        opinion_id = review['opinion_id']
+        with self._lock, self._conn:
+            new = not self._conn.execute("SELECT 1 FROM reviews WHERE opinion_id = ?", (opinion_id,)).fetchall()
+            self._conn.execute(
+                "INSERT INTO reviews (opinion_id, product_url, product_id, category, username, date, likes, "
+                "data, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(opinion_id) DO UPDATE SET product_url = excluded.product_url, "
+                "product_id = COALESCE(excluded.product_id, reviews.product_id), "
+                "category = COALESCE(excluded.category, reviews.category), username = excluded.username, "
+                "date = excluded.date, likes = excluded.likes, data = excluded.data, updated_at = excluded.updated_at",
+                (opinion_id, review.get('product_url'), product_id, category, review.get('username'),
+                 review.get('date'), review.get('likes'), json.dumps(review, ensure_ascii=False), _now()),
+            )
+            self._conn.execute("DELETE FROM comments WHERE opinion_id = ?", (opinion_id,))
+            self._conn.executemany(
+                "INSERT INTO comments (opinion_id, position, username, date, comment_text, likes) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(opinion_id, position, comment.get('username'), comment.get('date'), comment.get('comment_text'),
+                  comment.get('likes')) for position, comment in enumerate(review.get('comments') or [])],
+            )
+        return new
+
+    # Export
+
+    def records(self, table, batch_size=1000):
+        """ Yield the saved records of 'products' or 'reviews' in insertion order, `batch_size` rows per query,
+        so neither memory nor the lock is held for the whole table. """
+        if table not in ('products', 'reviews'):
+            raise ValueError(f"No records in table {table!r}")
+        last = 0
+        while True:
+            rows = self._execute(f"SELECT rowid, data FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                 (last, batch_size))
+            for last, data in rows:
+                yield json.loads(data)
+            if len(rows) < batch_size:
+                return
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """ Return the SQLite store shared by every stage of the process. """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SqliteStore()
+        return _store
@@ -0,0 +1,89 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import categoriesParcer
+import linksParser
+from categoriesParcer import CachedApiClient, category_template, diff_category_trees, save_category_diff
+from crawlState import CrawlState
+from linksParser import changed_leaf_urls, consume_changed_leaves
+
+
+def menu(*leaves, **names):
+    """ get-menu tree with one parent category over the given leaf URLs. """
+    return [{'title': 'Компьютеры', 'url': '/catalog/pc/', 'childs': [
+        {'title': names.get(url, url), 'url': url, 'childs': []} for url in leaves
+    ]}]
+
+
+def test_diff_compares_leaves():
+    old = menu('/a/', '/b/', '/c/')
+    new = menu('/a/', '/b/', '/d/', **{'/b/': 'Ноутбуки'})
+    # Leaves only: the parent is not a category with pages
+    new[0]['title'] = 'ПК'
+
+    assert diff_category_trees(old, new) == {'added': ['/d/'], 'changed': ['/b/'], 'removed': ['/c/']}
+    assert diff_category_trees(None, old)['added'] == ['/a/', '/b/', '/c/']
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    state = CrawlState(str(tmp_path / 'state.db'))
+    monkeypatch.setattr(categoriesParcer, 'get_state', lambda: state)
+    monkeypatch.setattr(linksParser, 'get_state', lambda: state)
+    yield state
+    state.close()
+
+
+def test_pending_categories_wait_for_links_parser(state, tmp_path):
+    diff_file = str(tmp_path / 'categories_diff.json')
+    assert changed_leaf_urls(diff_file) is None
+    state.save_category_page(category_template('/b/'), 7, done=True)
+
+    save_category_diff(menu('/a/', '/b/'), menu('/a/', '/b/', '/c/', **{'/b/': 'Ноутбуки'}), diff_file)
+    # A changed category is crawled from its first page again
+    assert state.category_progress(category_template('/b/')) == (0, False)
+    assert changed_leaf_urls(diff_file) == {'/b/', '/c/'}
+
+    # linksParser finished one of them; the next menu run keeps the other pending
+    state.save_category_page(category_template('/c/'), 3, done=True)
+    consume_changed_leaves(diff_file)
+    assert changed_leaf_urls(diff_file) == {'/b/'}
+    save_category_diff(menu('/a/', '/b/', '/c/'), menu('/a/', '/b/', '/c/', '/d/'), diff_file)
+    assert changed_leaf_urls(diff_file) == {'/b/', '/d/'}
+
+    # A category that disappeared is not waited for
+    save_category_diff(menu('/a/', '/b/', '/c/', '/d/'), menu('/a/', '/c/', '/d/'), diff_file)
+    assert changed_leaf_urls(diff_file) == {'/d/'}
+
+
+class Response:
+
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._data = data
+
+    def json(self):
+        return {'data': self._data}
+
+
+def test_cache_revalidates_with_etag(tmp_path):
+    client = CachedApiClient(str(tmp_path / 'cache'), ttl=0)
+    client.session.close()
+    sent = []
+    answers = [Response(200, ['menu'], {'ETag': '"v1"'}), Response(304)]
+    client.session.get = lambda url, headers=None, timeout=None: sent.append(headers) or answers.pop(0)
+
+    assert client.get_data('https://api/menu') == ['menu']
+    assert client.get_data('https://api/menu') == ['menu']
+    assert sent[1]['If-None-Match'] == '"v1"'
+
+    # Within the TTL no request is sent
+    fresh = CachedApiClient(str(tmp_path / 'cache'), ttl=3600)
+    assert fresh.get_data('https://api/menu') == ['menu']
+    fresh.close()
+    assert len(sent) == 2
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import categoryCrawler
+from categoryCrawler import CategoryCrawler, TokenBucket
+from crawlState import CrawlState
+
+TEMPLATE = 'https://www.dns-shop.ru/catalog/laptops/?p={page}'
+
+
+def test_token_bucket_rate():
+    async def take(bucket, count):
+        start = time.monotonic()
+        for _ in range(count):
+            await bucket.acquire()
+        return time.monotonic() - start
+
+    # A burst of `capacity`, then one request per 1 / rate seconds
+    assert asyncio.run(take(TokenBucket(20, capacity=2), 2)) < 0.02
+    assert 0.18 < asyncio.run(take(TokenBucket(20, capacity=2), 6)) < 0.5
+
+
+def crawl(tmp_path, monkeypatch, failing):
+    """ Crawl a five-page category whose pages in `failing` can't be fetched. Returns the pages asked for. """
+    state = CrawlState(str(tmp_path / 'state.db'))
+    monkeypatch.setattr(categoryCrawler, 'get_state', lambda: state)
+    crawler = CategoryCrawler(concurrency=4, rate=100)
+    crawler.session.close()
+    asked = []
+
+    async def crawl_page(url_template, page):
+        asked.append(page)
+        return None if page in failing else (page < 5, 5)
+    crawler._crawl_page = crawl_page
+
+    asyncio.run(crawler.run([TEMPLATE]))
+    progress = state.category_progress(TEMPLATE)
+    state.close()
+    return sorted(asked), progress
+
+
+def test_missing_page_is_retried_next_run(tmp_path, monkeypatch):
+    assert crawl(tmp_path, monkeypatch, failing={3}) == ([1, 2, 3, 4, 5], (2, False))
+    assert crawl(tmp_path, monkeypatch, failing=set()) == ([3, 4, 5], (5, True))
+    assert crawl(tmp_path, monkeypatch, failing=set()) == ([], (5, True))
+
+
+def test_missing_first_page_keeps_progress(tmp_path, monkeypatch):
+    assert crawl(tmp_path, monkeypatch, failing={1}) == ([1], (0, False))
@@ -0,0 +1,53 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from columnarExport import export, product_category
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+def test_export_real_items(tmp_path):
+    with open(os.path.join(ROOT, 'items.json'), 'r', encoding='utf-8') as f:
+        items = json.load(f)
+    items_file = tmp_path / 'items.jsonl'
+    items_file.write_text(''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in items), encoding='utf-8')
+    reviews_file = tmp_path / 'reviews.jsonl'
+    reviews_file.write_text(json.dumps({'opinion_id': 'op-1', 'product_url': items[0]['url']}) + '\n')
+
+    rows = export(str(tmp_path / 'export'), str(items_file), str(reviews_file))
+
+    assert rows['products'] == len(items)
+    leaf = product_category(items[0])
+    assert leaf == items[0]['categories'][-1]['name']
+    products = pq.read_table(str(tmp_path / 'export' / 'products')).to_pylist()
+    first = next(row for row in products if row['id'] == items[0]['id'])
+    assert first['categories'] == [{'name': c['name'], 'url': c['url']} for c in items[0]['categories']]
+    assert str(first['category']) == leaf
+    reviews = pq.read_table(str(tmp_path / 'export' / 'reviews')).to_pylist()
+    assert reviews[0]['product_id'] == items[0]['id']
+
+
+def test_export_sqlite_storage(tmp_path, monkeypatch):
+    import config
+    import sqliteStore
+    monkeypatch.setattr(config, 'STORAGE', 'sqlite')
+    store = sqliteStore.SqliteStore(str(tmp_path / 'crawl_data.db'))
+    monkeypatch.setattr(sqliteStore, '_store', store)
+    item = {'id': 'p-1', 'url': 'https://example/p-1', 'categories': [{'name': 'Ноутбуки', 'url': 'u'}]}
+    store.save_item(item)
+    store.save_review({'opinion_id': 'op-1', 'product_url': item['url'], 'comments': [{'username': 'a'}]})
+
+    rows = export(str(tmp_path / 'export'), batch_size=1)
+    store.close()
+
+    assert rows['products'] == 1 and rows['reviews'] == 1 and rows['comments'] == 1
+    reviews = pq.read_table(str(tmp_path / 'export' / 'reviews')).to_pylist()
+    assert reviews[0]['product_id'] == 'p-1'
+    assert str(reviews[0]['category']) == 'Ноутбуки'
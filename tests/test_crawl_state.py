@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import productDetailsParser
+from crawlState import CrawlState
+
+
+@pytest.fixture
+def reopen(tmp_path):
+    """ Open the state file again, as a restarted run does. """
+    states = []
+
+    def open_state():
+        if states:
+            states[-1].close()
+        states.append(CrawlState(str(tmp_path / 'state.db')))
+        return states[-1]
+    yield open_state
+    states[-1].close()
+
+
+def test_progress_survives_a_restart(reopen):
+    state = reopen()
+    state.save_category_page('cat?p={page}', 3)
+    assert state.add_product_urls(['a', 'b']) == ['a', 'b']
+    state.save_review_cursor('a', 2, 'op-7')
+    state.save_review_cursor('a', 3)
+
+    state = reopen()
+    assert state.category_progress('cat?p={page}') == (3, False)
+    assert state.category_progress('other?p={page}') == (0, False)
+    assert state.add_product_urls(['b', 'c']) == ['c']
+    assert state.count_product_urls() == 3
+    # A page without new opinions keeps the last opinion id
+    assert state.review_cursor('a') == (3, 'op-7', False)
+    assert state.review_cursor('b') == (0, None, False)
+
+
+def test_restart_skips_saved_products(reopen, tmp_path, monkeypatch):
+    urls_file = tmp_path / 'urls.txt'
+    urls_file.write_text('a\nb\n\nc\n')
+    saved = []
+    monkeypatch.setattr(productDetailsParser, 'save_item', saved.append)
+    state = reopen()
+    monkeypatch.setattr(productDetailsParser, 'get_state', lambda: state)
+
+    # The run dies after two products; the second one failed to parse
+    productDetailsParser.save_products([('a', {'url': 'a'}), ('b', None)])
+
+    state = reopen()
+    assert list(productDetailsParser.read_urls(str(urls_file))) == ['b', 'c']
+    assert saved == [{'url': 'a'}]
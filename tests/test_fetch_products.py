@@ -0,0 +1,116 @@
+import os
+import random
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import productDetailsParser
+from productDetailsParser import fetch_products
+
+
+@pytest.fixture
+def parse(monkeypatch):
+    """ Replace the browser parse with `parse.func(url)`; no browser or session is started. """
+    monkeypatch.setattr(config, 'FETCH_MODE', 'browser')
+    monkeypatch.setattr(config, 'REVIEW_SOURCE', 'browser')
+    monkeypatch.setattr(productDetailsParser, 'get_pool', lambda: None)
+
+    class Parse:
+        func = staticmethod(lambda url: {'url': url})
+
+    monkeypatch.setattr(productDetailsParser, '_parse_with_retries',
+                        lambda worker_id, pool, url, session, plan: Parse.func(url))
+    return Parse
+
+
+def run(generator, timeout=10):
+    """ Drain a fetch_products generator, failing instead of hanging. """
+    results = []
+    thread = threading.Thread(target=lambda: results.extend(generator), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "fetch_products hangs"
+    return results
+
+
+def test_results_keep_input_order(parse):
+    def slow(url):
+        time.sleep(random.uniform(0, 0.01))
+        return {'url': url}
+    parse.func = slow
+    urls = [f'https://example/{i}' for i in range(40)]
+
+    results = run(fetch_products(urls, workers=4))
+
+    assert [url for url, _ in results] == urls
+    assert all(item == {'url': url} for url, item in results)
+
+
+def test_parse_error_keeps_worker(parse):
+    def failing(url):
+        if url.endswith('/3'):
+            raise ValueError('broken page')
+        return {'url': url}
+    parse.func = failing
+    urls = [f'https://example/{i}' for i in range(8)]
+
+    results = run(fetch_products(urls, workers=1))
+
+    assert [url for url, _ in results] == urls
+    assert results[3][1] is None and results[4][1] == {'url': urls[4]}
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_dead_workers_do_not_hang(parse):
+    def dying(url):
+        if url.endswith('/2'):
+            raise SystemExit
+        return {'url': url}
+    parse.func = dying
+    urls = [f'https://example/{i}' for i in range(6)]
+
+    results = run(fetch_products(urls, workers=1))
+
+    # The URL that killed the worker is reported as failed; the rest stays for the next run
+    assert results == [(urls[0], {'url': urls[0]}), (urls[1], {'url': urls[1]}), (urls[2], None)]
+
+
+def test_urls_are_read_ahead_by_the_buffer_only(parse):
+    taken = []
+
+    def urls():
+        for i in range(100):
+            taken.append(i)
+            yield f'https://example/{i}'
+
+    results = fetch_products(urls(), workers=2, buffer_size=4)
+    next(results)
+    time.sleep(0.05)
+
+    # The buffer, plus the URL the feeder holds while it waits for a free slot
+    assert len(taken) <= 4 + 1 + 1
+    assert len(run(results)) == 99
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_dead_worker_frees_the_buffer(parse):
+    first_failed = threading.Event()
+
+    def dying(url):
+        # The first URL kills its worker; the other keeps parsing
+        if url.endswith('/0') and not first_failed.is_set():
+            first_failed.set()
+            raise SystemExit
+        return {'url': url}
+    parse.func = dying
+    urls = [f'https://example/{i}' for i in range(50)]
+
+    results = run(fetch_products(urls, workers=2, buffer_size=3))
+
+    assert [url for url, _ in results] == urls
+    assert results[0][1] is None and all(item for _, item in results[1:])
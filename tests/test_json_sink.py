@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import jsonSink
+import reviewParser
+from jsonSink import close_sink, compact, get_sink, read_jsonl
+
+
+def legacy_files(tmp_path, monkeypatch, records):
+    jsonl_file, json_file = str(tmp_path / 'reviews.jsonl'), str(tmp_path / 'reviews.json')
+    monkeypatch.setattr(config, 'REVIEWS_FILE', jsonl_file)
+    monkeypatch.setattr(config, 'REVIEWS_JSON', json_file)
+    monkeypatch.setattr(config, 'STORAGE', 'jsonl')
+    monkeypatch.setattr(reviewParser, '_known_opinion_ids', {})
+    with open(json_file, 'w', encoding='utf-8') as f:
+        json.dump(records, f)
+    return jsonl_file, json_file
+
+
+def test_legacy_reviews_are_known_and_kept(tmp_path, monkeypatch):
+    jsonl_file, json_file = legacy_files(tmp_path, monkeypatch, [{'opinion_id': str(i)} for i in range(14)])
+
+    assert reviewParser.known_opinion_ids(jsonl_file) == {str(i) for i in range(14)}
+    get_sink(jsonl_file).write({'opinion_id': '99'})
+
+    assert compact(jsonl_file, json_file) == 15
+    with open(json_file, 'r', encoding='utf-8') as f:
+        assert len(json.load(f)) == 15
+
+
+def test_sink_imports_legacy_items(tmp_path, monkeypatch):
+    jsonl_file, json_file = str(tmp_path / 'items.jsonl'), str(tmp_path / 'items.json')
+    monkeypatch.setattr(config, 'ITEMS_FILE', jsonl_file)
+    monkeypatch.setattr(config, 'ITEMS_JSON', json_file)
+    with open(json_file, 'w', encoding='utf-8') as f:
+        json.dump([{'id': 'a'}, {'id': 'b'}], f)
+
+    get_sink(jsonl_file).write({'id': 'c'})
+    close_sink(jsonl_file)
+
+    assert [item['id'] for item in read_jsonl(jsonl_file)] == ['a', 'b', 'c']
+
+
+def test_compact_keeps_json_with_missing_records(tmp_path):
+    jsonl_file, json_file = str(tmp_path / 'other.jsonl'), str(tmp_path / 'other.json')
+    with open(json_file, 'w', encoding='utf-8') as f:
+        json.dump([{'id': 'a'}, {'id': 'b'}], f)
+    with open(jsonl_file, 'w', encoding='utf-8') as f:
+        f.write('{"id": "a"}\n')
+
+    assert compact(jsonl_file, json_file) == 0
+    with open(json_file, 'r', encoding='utf-8') as f:
+        assert json.load(f) == [{'id': 'a'}, {'id': 'b'}]
+    assert not os.path.exists(json_file + '.tmp')
+    assert jsonSink.legacy_json(jsonl_file) is None
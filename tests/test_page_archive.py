@@ -0,0 +1,66 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from pageArchive import PageArchive, reparse
+
+
+def product_html(product_id, price, name='Ноутбук'):
+    rating = json.dumps({'aggregateRating': {'ratingValue': '4.5', 'reviewCount': '12'}})
+    price_block = f'<div class="product-buy__price product-buy__price_active">{price} ₽</div>' if price else ''
+    return (f'<html><head><script type="application/ld+json">{rating}</script></head><body>'
+            f'<div class="product-card-top__code">{product_id}</div>'
+            f'<div class="product-card-top__name">{name} {product_id}</div>{price_block}</body></html>')
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = PageArchive(str(tmp_path / 'archive'), train_after=1000)
+    yield archive
+    archive.close()
+
+
+def test_same_content_is_stored_once(archive):
+    html = product_html('1', 1000)
+    sha = archive.put('product', 'https://example/1', html, fetched_at='2024-01-01T00:00:00')
+    assert archive.put('product', 'https://example/1', html, fetched_at='2024-02-01T00:00:00') == sha
+    archive.put('product', 'https://example/1', product_html('1', 900), fetched_at='2024-03-01T00:00:00')
+
+    assert archive.get(sha) == html.encode('utf-8')
+    assert [fetched_at for fetched_at, _ in archive.history('https://example/1')] == [
+        '2024-01-01T00:00:00', '2024-02-01T00:00:00', '2024-03-01T00:00:00']
+    assert archive.latest('product', before='2024-02-15')[0][3] == sha
+    kind, pages, objects, *_ = archive.stats()[0]
+    assert (kind, pages, objects) == ('product', 3, 2)
+
+
+def test_dictionary_pages_and_older_pages_read_back(archive):
+    before = [archive.put('product', f'https://example/{i}', product_html(str(i), 1000 + i)) for i in range(40)]
+
+    assert archive.train('product') is not None
+    after = archive.put('product', 'https://example/new', product_html('new', 5))
+
+    assert archive.get(after) == product_html('new', 5).encode('utf-8')
+    assert all(archive.get(sha) == product_html(str(i), 1000 + i).encode('utf-8') for i, sha in enumerate(before))
+    assert archive.train('reviews') is None
+
+
+def test_reparse_prefers_browser_snapshots(archive, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'PARSE_WORKERS', 1)
+    # Both kinds of snapshot for one product; only an HTTP card, without its price, for another
+    archive.put('product', 'https://example/1', product_html('1', 1000))
+    archive.put('product_http', 'https://example/1', product_html('1', None))
+    archive.put('product_http', 'https://example/2', product_html('2', None))
+
+    assert reparse(str(tmp_path / 'out'), archive=archive) == (2, 0)
+
+    with open(tmp_path / 'out' / 'items.json', 'r', encoding='utf-8') as f:
+        items = {item['id']: item for item in json.load(f)}
+    assert items['1']['price_discounted'] == 1000
+    assert items['2'].get('price_discounted') is None
+    assert items['2']['number_of_reviews'] == 12
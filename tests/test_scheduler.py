@@ -0,0 +1,70 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import AdaptiveScheduler, is_blocked
+
+BUDGETS = {'product': (1, 16, 4, 1, 10), 'default': (1, 60, 3, 0.5, 10)}
+
+
+def test_delay_speeds_up_and_backs_off():
+    scheduler = AdaptiveScheduler(BUDGETS, backoff=2)
+
+    for _ in range(2):
+        scheduler.record('product', 0.5)
+    assert scheduler.delay('product') == 2
+    for _ in range(5):
+        scheduler.record('product', 0.5)
+    assert scheduler.delay('product') == 1
+
+    scheduler.record('product', 12)
+    assert scheduler.delay('product') == 2
+    scheduler.record('product', 0.5, status=429)
+    assert scheduler.delay('product') == 4
+    for _ in range(5):
+        scheduler.record('product', 0.5, blocked=True)
+    assert scheduler.delay('product') == 16
+
+
+def test_block_pauses_the_stage():
+    scheduler = AdaptiveScheduler(BUDGETS, backoff=2)
+    scheduler.record('product', 0.5, status=403)
+
+    assert scheduler.reserve('product') > 7
+
+
+def first_waits(pacing, workers=3):
+    """ Wait each of `workers` live threads would get for its first request. """
+    scheduler = AdaptiveScheduler(BUDGETS, pacing=pacing)
+    barrier = threading.Barrier(workers)
+    waits = []
+
+    def worker():
+        waits.append(scheduler.reserve('product'))
+        # Stay alive so the next thread gets another ident
+        barrier.wait()
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(waits)
+
+
+def test_workers_pace_separately():
+    assert first_waits('worker') == [0, 0, 0]
+
+
+def test_stage_pacing_is_one_cap():
+    waits = first_waits('stage')
+    assert waits[0] == 0
+    assert 3 < waits[1] < 5 and 6 < waits[2] < 10
+
+
+def test_is_blocked():
+    assert is_blocked(status=429)
+    assert is_blocked('<html><title>Проверка браузера</title></html>')
+    assert not is_blocked('<html>' + 'x' * 30000 + '<title>Ноутбук</title>captcha</html>')
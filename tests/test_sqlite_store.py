@@ -0,0 +1,31 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqliteStore import SqliteStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def real_item():
+    with open(os.path.join(ROOT, 'items.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)[0]
+
+
+def test_save_item_with_breadcrumb_dicts(tmp_path):
+    item = real_item()
+    assert isinstance(item['categories'][-1], dict)
+    store = SqliteStore(str(tmp_path / 'data.db'))
+    store.save_review({'opinion_id': 'op-1', 'product_url': item['url']})
+
+    store.save_item(item)
+
+    leaf = item['categories'][-1]['name']
+    assert store.product_by_url(item['url']) == (item['id'], leaf)
+    assert store._execute("SELECT product_id, category FROM reviews") == [(item['id'], leaf)]
+    parents = dict(store._execute("SELECT name, parent FROM categories"))
+    names = [category['name'] for category in item['categories']]
+    assert parents[names[0]] is None
+    assert all(parents[child] == parent for parent, child in zip(names, names[1:]))
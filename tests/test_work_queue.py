@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workQueue import WorkQueue
+
+
+def open_queue(tmp_path, visibility=60, max_attempts=2):
+    return WorkQueue(str(tmp_path / 'queue.db'), visibility=visibility, max_attempts=max_attempts)
+
+
+def test_push_ignores_queued_tasks(tmp_path):
+    queue = open_queue(tmp_path)
+
+    assert queue.push('products', ['a', 'b']) == 2
+    assert queue.push('products', ['b', 'c']) == 1
+    assert queue.push('reviews', ['a']) == 1
+
+
+def test_lease_and_ack(tmp_path):
+    queue = open_queue(tmp_path)
+    queue.push('products', ['a', 'b'])
+
+    first = queue.lease('products', 'w1')
+    second = queue.lease('products', 'w2')
+
+    assert first[1] == 'a' and second[1] == 'b'
+    assert queue.lease('products', 'w3') is None
+    assert queue.ack(first[0], 'w1')
+    assert not queue.ack(second[0], 'w1')
+    assert dict(((kind, status), count) for kind, status, count in queue.counts()) == {
+        ('products', 'done'): 1, ('products', 'leased'): 1,
+    }
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    queue = open_queue(tmp_path, visibility=0.01)
+    queue.push('products', ['a'])
+    task_id, _ = queue.lease('products', 'dead')
+    time.sleep(0.02)
+
+    assert queue.lease('products', 'w2') == (task_id, 'a')
+    # The first worker's late ack doesn't count: the task is the second worker's now
+    assert not queue.ack(task_id, 'dead')
+    assert queue.ack(task_id, 'w2')
+
+
+def test_last_expired_attempt_fails(tmp_path):
+    queue = open_queue(tmp_path, visibility=0.01, max_attempts=1)
+    queue.push('products', ['a'])
+    queue.lease('products', 'dead')
+    time.sleep(0.02)
+
+    assert queue.lease('products', 'w2') is None
+    assert not queue.has_work('products')
+    assert queue.counts() == [('products', 'failed', 1)]
+
+
+def test_fail_retries_then_gives_up(tmp_path):
+    queue = open_queue(tmp_path, max_attempts=2)
+    queue.push('products', ['a'])
+
+    task_id, _ = queue.lease('products', 'w1')
+    queue.fail(task_id, 'w1')
+    assert queue.has_work('products')
+    assert queue.lease('products', 'w1') == (task_id, 'a')
+    queue.fail(task_id, 'w1')
+
+    assert queue.lease('products', 'w1') is None
+    assert not queue.has_work('products')
+    assert queue.counts() == [('products', 'failed', 1)]
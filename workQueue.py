@@ -0,0 +1,338 @@
+""" Shared SQLite work queue for crawling with several processes and hosts.
+
+Usage:
+    py workQueue.py seed [categories.json] [urls.txt]    queue category templates and known product links
+    py workQueue.py worker links|products|reviews       take tasks of one kind until the queue is empty
+    py workQueue.py status                              tasks per kind and status
+    py workQueue.py serve                               coordinator: serve QUEUE_DB to other hosts over HTTP
+
+A leased task is hidden from other workers for QUEUE_VISIBILITY seconds. A worker that dies
+leaves its task to reappear after that, so every task is done at least once; a task whose last
+attempt expired is marked failed. Writes are keyed by product id and opinion_id (run workers with
+STORAGE=sqlite), so a repeated task doesn't duplicate data.
+The databases run in WAL mode, which needs shared memory, so they stay on a local disk: WAL doesn't
+work over NFS or SMB. Workers on the coordinator's host may open QUEUE_DB directly; workers on other
+hosts set QUEUE_URL to the coordinator and keep STATE_DB and STORAGE_DB on their own disk.
+"""
+import hmac
+import json
+import logging
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+import requests
+
+import config
+import metrics
+from browserSession import close_pool, get_pool
+from crawlState import get_state
+from httpSession import create_session
+from linksParser import generate_urls_from_json, get_all_category_page_urls
+from parseEngine import get_engine
+from productDetailsParser import close_comments_pool, parse_product, save_products, serializable_item
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_until REAL,
+    updated_at REAL,
+    UNIQUE (kind, payload)
+);
+CREATE INDEX IF NOT EXISTS tasks_kind_status ON tasks (kind, status, lease_until);
+"""
+
+
+class WorkQueue:
+
+    def __init__(self, filename=None, visibility=None, max_attempts=None):
+        self.filename = filename or config.QUEUE_DB
+        self.visibility = visibility or config.QUEUE_VISIBILITY
+        self.max_attempts = max_attempts or config.MAX_RETRIES + 1
+        # Autocommit mode: leases open their own IMMEDIATE transaction so two processes can't take one task
+        self._conn = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def push(self, kind, payloads):
+        """ Queue tasks; ones already queued (in any status) are ignored. Returns how many were added. """
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            added = 0
+            for payload in payloads:
+                added += self._conn.execute(
+                    "INSERT OR IGNORE INTO tasks (kind, payload, updated_at) VALUES (?, ?, ?)", (kind, payload, now),
+                ).rowcount
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def _expire(self, now):
+        # A worker that died on the last attempt leaves nobody to mark its task failed
+        self._conn.execute(
+            "UPDATE tasks SET status = 'failed', lease_until = NULL, updated_at = ? "
+            "WHERE status = 'leased' AND attempts >= ? AND lease_until < ?",
+            (now, self.max_attempts, now),
+        )
+
+    def lease(self, kind, owner):
+        """ Take a pending task or one whose lease expired. Returns (task id, payload) or None. """
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._expire(now)
+            row = self._conn.execute(
+                "SELECT id, payload FROM tasks WHERE kind = ? AND attempts < ? "
+                "AND (status = 'pending' OR (status = 'leased' AND lease_until < ?)) ORDER BY id LIMIT 1",
+                (kind, self.max_attempts, now),
+            ).fetchone()
+            if row:
+                self._conn.execute(
+                    "UPDATE tasks SET status = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1, "
+                    "updated_at = ? WHERE id = ?",
+                    (owner, now + self.visibility, now, row[0]),
+                )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def ack(self, task_id, owner):
+        """ Mark a task done. Returns False if the lease expired and another worker took the task over. """
+        return bool(self._conn.execute(
+            "UPDATE tasks SET status = 'done', lease_until = NULL, updated_at = ? WHERE id = ? AND owner = ?",
+            (time.time(), task_id, owner),
+        ).rowcount)
+
+    def fail(self, task_id, owner):
+        """ Give a task back for another attempt, or mark it failed after the last one. """
+        self._conn.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+            "lease_until = NULL, updated_at = ? WHERE id = ? AND owner = ?",
+            (self.max_attempts, time.time(), task_id, owner),
+        )
+
+    def has_work(self, kind):
+        """ Whether tasks of a kind are pending or leased by a worker that may still give them back. """
+        return bool(self._conn.execute(
+            "SELECT 1 FROM tasks WHERE kind = ? AND ((status = 'pending' AND attempts < ?) "
+            "OR (status = 'leased' AND (attempts < ? OR lease_until >= ?))) LIMIT 1",
+            (kind, self.max_attempts, self.max_attempts, time.time()),
+        ).fetchone())
+
+    def counts(self):
+        self._expire(time.time())
+        return self._conn.execute(
+            "SELECT kind, status, COUNT(*) FROM tasks GROUP BY kind, status ORDER BY kind, status"
+        ).fetchall()
+
+    def close(self):
+        self._conn.close()
+
+
+class RemoteQueue:
+    """ The queue of a coordinator (`py workQueue.py serve`), with the methods of WorkQueue, over HTTP. """
+
+    def __init__(self, url=None, token=None):
+        self.url = (url or config.QUEUE_URL).rstrip('/')
+        self._session = requests.Session()
+        token = token or config.QUEUE_TOKEN
+        if token:
+            self._session.headers['X-Queue-Token'] = token
+
+    def _call(self, method, **params):
+        for attempt in range(config.MAX_RETRIES + 1):
+            try:
+                response = self._session.post(f"{self.url}/{method}", json=params, timeout=30)
+                response.raise_for_status()
+                return response.json()['result']
+            except requests.RequestException as e:
+                # A refused call (bad token, bad arguments) fails the same way again
+                refused = e.response is not None and e.response.status_code < 500
+                if refused or attempt == config.MAX_RETRIES:
+                    raise
+                # A lease whose answer was lost just expires, so every call may be repeated
+                print(f"Queue {self.url}: {method} failed ({e}), retrying")
+                time.sleep(config.QUEUE_IDLE_WAIT)
+
+    def push(self, kind, payloads):
+        return self._call('push', kind=kind, payloads=list(payloads))
+
+    def lease(self, kind, owner):
+        task = self._call('lease', kind=kind, owner=owner)
+        return tuple(task) if task else None
+
+    def ack(self, task_id, owner):
+        return self._call('ack', task_id=task_id, owner=owner)
+
+    def fail(self, task_id, owner):
+        self._call('fail', task_id=task_id, owner=owner)
+
+    def has_work(self, kind):
+        return self._call('has_work', kind=kind)
+
+    def counts(self):
+        return [tuple(row) for row in self._call('counts')]
+
+    def close(self):
+        self._session.close()
+
+
+def open_queue():
+    """ The coordinator's queue when QUEUE_URL is set, the local QUEUE_DB otherwise. """
+    return RemoteQueue() if config.QUEUE_URL else WorkQueue()
+
+
+# Queue methods a coordinator answers
+REMOTE_METHODS = ('push', 'lease', 'ack', 'fail', 'has_work', 'counts')
+
+
+def serve(queue, host=None, port=None):
+    """ Coordinator: answer the queue calls of workers on other hosts, one request at a time,
+    so the SQLite connection stays in this thread and leases are taken in order. """
+    from flask import Flask, abort, jsonify, request
+
+    app = Flask(__name__)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    @app.route('/<method>', methods=['POST'])
+    def call(method):
+        if method not in REMOTE_METHODS:
+            abort(404)
+        if config.QUEUE_TOKEN and not hmac.compare_digest(request.headers.get('X-Queue-Token', ''),
+                                                          config.QUEUE_TOKEN):
+            abort(403)
+        return jsonify(result=getattr(queue, method)(**(request.get_json(silent=True) or {})))
+
+    host, port = host or config.QUEUE_HOST, port or config.QUEUE_PORT
+    if not config.QUEUE_TOKEN:
+        print("Warning: QUEUE_TOKEN is not set, anyone who reaches the port can take and ack tasks")
+    print(f"Serving {queue.filename} on http://{host}:{port}")
+    app.run(host=host, port=port, threaded=False)
+
+
+def seed(queue, categories_file='categories.json', urls_file='urls.txt'):
+    """ Coordinator: queue every leaf category template and the product links collected so far. """
+    with open(categories_file, 'r', encoding='utf-8') as file:
+        print(f"Categories queued: {queue.push('category', generate_urls_from_json(json.load(file)))}")
+
+    if os.path.exists(urls_file):
+        with open(urls_file, 'r') as file:
+            urls = [line.strip() for line in file if line.strip()]
+        print(f"Products queued: {queue.push('product', urls)}, reviews queued: {queue.push('reviews', urls)}")
+
+
+def _handle_category(driver, session, queue, url_template):
+    # Product links become product and review tasks page by page, so a retry resuming after the
+    # last saved page loses none of them; tasks already queued are ignored
+    def push(urls):
+        queue.push('product', urls)
+        queue.push('reviews', urls)
+
+    with metrics.stage('links'):
+        get_all_category_page_urls(driver, url_template, push)
+    # A captcha stops the category early; the retry continues from the last saved page
+    if not get_state().category_progress(url_template)[1]:
+        raise RuntimeError(f"Category {url_template} stopped before its last page")
+
+
+def _handle_product(driver, session, queue, url):
+    item = parse_product(driver, url, session, reviews=False)
+    save_products([(url, serializable_item(item) if item else None)])
+    if not item:
+        raise RuntimeError(f"No product parsed from {url}")
+
+
+def _handle_reviews(driver, session, queue, url):
+    parse_product(driver, url, session, product=False)
+    # An unfinished cursor means the harvest stopped on an error; the retry continues from it
+    if not get_state().review_cursor(url)[2]:
+        raise RuntimeError(f"Reviews of {url} are not complete")
+
+
+# Worker role: (task kind, handler, kinds whose tasks may still add work for it)
+HANDLERS = {
+    'links': ('category', _handle_category, ()),
+    'products': ('product', _handle_product, ('category',)),
+    'reviews': ('reviews', _handle_reviews, ('category',)),
+}
+
+
+def run_worker(role, queue=None, idle_wait=None):
+    """ Take tasks of one kind until none are pending or leased. Returns the number of tasks done. """
+    if config.STORAGE != 'sqlite':
+        print("Warning: with STORAGE=jsonl a task repeated after a lost lease writes its records twice")
+
+    kind, handle, upstream = HANDLERS[role]
+    # The parse engine is set up before the metrics thread starts
+    get_engine()
+    metrics.start()
+    queue = queue or open_queue()
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    idle_wait = idle_wait or config.QUEUE_IDLE_WAIT
+    # A temporary profile, so worker processes on one host don't fight over a profile directory
+    pool = get_pool(1, profile_prefix=None)
+    session = create_session()
+    # HTTP cards and API reviews lease the browser themselves, only for a fallback or images
+    needs_browser = role == 'links' or (config.FETCH_MODE != 'http' if role == 'products'
+                                        else config.REVIEW_SOURCE != 'api')
+
+    done = 0
+    while True:
+        task = queue.lease(kind, owner)
+        if task is None:
+            if not any(queue.has_work(waited) for waited in (kind,) + upstream):
+                break
+            # Other workers hold the remaining tasks or may still queue new ones
+            time.sleep(idle_wait)
+            continue
+
+        task_id, payload = task
+        driver = None
+        try:
+            if needs_browser:
+                driver = pool.lease()
+            handle(driver, session, queue, payload)
+            if queue.ack(task_id, owner):
+                done += 1
+        except Exception as e:
+            print(f"{owner}: {kind} task {payload} failed: {e}")
+            queue.fail(task_id, owner)
+        finally:
+            if driver is not None:
+                pool.release(driver)
+
+    session.close()
+    close_pool()
+    close_comments_pool()
+    print(f"{owner}: {done} {kind} tasks done")
+    return done
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('seed', 'worker', 'status', 'serve'):
+        print(__doc__)
+        sys.exit(1)
+
+    work_queue = WorkQueue() if sys.argv[1] == 'serve' else open_queue()
+    if sys.argv[1] == 'serve':
+        serve(work_queue)
+    elif sys.argv[1] == 'seed':
+        seed(work_queue, *sys.argv[2:4])
+    elif sys.argv[1] == 'worker':
+        run_worker(sys.argv[2], work_queue)
+    else:
+        for kind, status, count in work_queue.counts():
+            print(f"{kind:<10} {status:<8} {count}")
+    work_queue.close()